@@ -89,7 +89,18 @@ ext_modules = [
               libraries=bl_lib,
               library_dirs=bl_lib_path,
               include_dirs=list(set(bl_lib_include+[np.get_include()]))),
-    Extension("testfm.models.cutil.baseline_model", [src % "testfm/models/cutil/baseline_model.pyx"]),
+    Extension("testfm.models.cutil.baseline_model", [src % "testfm/models/cutil/baseline_model.pyx"],
+              include_dirs=[np.get_include()]),
+    Extension("testfm.models.cutil.bpr", [src % "testfm/models/cutil/bpr.pyx"],
+              include_dirs=[np.get_include()],
+              extra_compile_args=["-fopenmp"],
+              extra_link_args=["-fopenmp"],
+              library_dirs=[GCCLIB]),
+    Extension("testfm.models.cutil.svdpp", [src % "testfm/models/cutil/svdpp.pyx"],
+              include_dirs=[np.get_include()],
+              extra_compile_args=["-fopenmp"],
+              extra_link_args=["-fopenmp"],
+              library_dirs=[GCCLIB]),
 ]
 
 setup(
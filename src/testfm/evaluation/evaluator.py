@@ -19,20 +19,31 @@ from testfm.models.cutil.interface import NOGILModel
 from testfm.evaluation.cutil.evaluator import evaluate_model
 
 
+def score_items(factor_model, user, items):
+    """
+    Score the items for the user with one batch call when the model has get_scores
+    """
+    get_scores = getattr(factor_model, "get_scores", None)
+    if get_scores is None:
+        return [factor_model.get_score(user, item) for item in items]
+    return get_scores(user, items)
+
+
 def partial_measure(user, entries, factor_model, all_items, non_relevant_count, measure, k=None):
     #if isinstance(factor_model, IFactorModel):
     #    return factor_model.partial_measure(user, entries, all_items, non_relevant_count, measure)
     if non_relevant_count is None:
         # Add all items except relevant
-        ranked_list = [(False, factor_model.get_score(user, nr)) for nr in all_items if nr not in entries['item']]
+        nr_items = [nr for nr in all_items if nr not in entries['item']]
     else:
         #2. inject #non_relevant random items
         nr_items = [i for i in all_items if i not in entries['item']]
-        ranked_list = [(False, factor_model.get_score(user, nr))
-                       for nr in sample(nr_items, non_relevant_count \
-                if len(nr_items) > non_relevant_count else len(nr_items))]
+        nr_items = sample(nr_items, non_relevant_count if len(nr_items) > non_relevant_count else len(nr_items))
     #2. add all relevant items from the testing_data
-    ranked_list += [(True, factor_model.get_score(user, i)) for i in entries['item']]
+    relevant_items = list(entries['item'])
+    scores = score_items(factor_model, user, nr_items + relevant_items)
+    ranked_list = [(False, score) for score in scores[:len(nr_items)]] + \
+                  [(True, score) for score in scores[len(nr_items):]]
 
         #shuffle(ranked_list)  # Just to make sure we don't introduce any bias (AK: do we need this?)
 
@@ -8,11 +8,247 @@ Base line model
 """
 __author__ = "linas"
 
+import os
+import time
+import shutil
+import resource
+import tempfile
+import multiprocessing
+from collections import OrderedDict
 from random import random
-from testfm.models.cutil.interface import IModel
+from testfm.models.cutil.interface import IModel, top_k
+from testfm.settings import DATE
 from math import log
 import numpy as np
-from testfm.models.cutil.baseline_model import NOGILRandomModel
+import pandas as pd
+import scipy.sparse as sp
+from testfm.models.cutil.baseline_model import NOGILRandomModel, NOGILItemScoreModel, NOGILUserItemScoreModel
+
+
+def interaction_matrix(rows, columns, n_rows, n_columns):
+    """
+    Binary sparse matrix with a 1 in every (row, column) pair. Repeated pairs count once.
+
+    :return: A scipy.sparse.csr_matrix with sorted indices
+    """
+    matrix = sp.csr_matrix((np.ones(len(rows), dtype=np.float32), (np.asarray(rows, dtype=np.int32),
+                                                                  np.asarray(columns, dtype=np.int32))),
+                           shape=(n_rows, n_columns))
+    matrix.sum_duplicates()
+    matrix.data[:] = 1.
+    return matrix
+
+
+def jaccard(co_occurrence, row_counts, column_counts):
+    """
+    |A and B| / |A or B|
+    """
+    union = row_counts[:, np.newaxis] + column_counts[np.newaxis, :] - co_occurrence
+    return co_occurrence / np.maximum(union, 1.)
+
+
+def cosine(co_occurrence, row_counts, column_counts):
+    """
+    |A and B| / sqrt(|A| |B|)
+    """
+    return co_occurrence / np.maximum(np.sqrt(np.outer(row_counts, column_counts)), 1.)
+
+
+def conditional_probability(co_occurrence, row_counts, column_counts):
+    """
+    P(A | B) = |A and B| / |B|
+    """
+    return co_occurrence / np.maximum(column_counts[np.newaxis, :], 1.)
+
+
+def dot(co_occurrence, row_counts, column_counts):
+    """
+    A . B, the cosine when the rows are L2 normalized
+    """
+    return co_occurrence
+
+
+SIMILARITIES = {
+    "jaccard": jaccard,
+    "cosine": cosine,
+    "conditional": conditional_probability,
+    "dot": dot
+}
+
+
+def similarity_block(matrix, counts, similarity, start, stop, n_neighbours, column_block):
+    """
+    Compute the top neighbours of the rows start to stop of a sparse matrix. The columns of the similarity are
+    computed in blocks of column_block and merged with the best neighbours found before, so the memory used is bounded
+    by (stop - start) x column_block.
+
+    :return: The neighbours and the similarities of the rows, as in top_neighbours
+    """
+    measure = SIMILARITIES[similarity]
+    size, rows = matrix.shape[0], np.arange(stop-start)[:, np.newaxis]
+    left = matrix[start:stop]
+    neighbours = np.empty((stop-start, 0), dtype=np.int64)
+    values = np.empty((stop-start, 0), dtype=np.float64)
+    for column_start in xrange(0, size, column_block):
+        column_stop = min(column_start + column_block, size)
+        co_occurrence = left.dot(matrix[column_start:column_stop].transpose()).toarray().astype(np.float64)
+        block = measure(co_occurrence, counts[start:stop], counts[column_start:column_stop])
+        diagonal = np.arange(max(start, column_start), min(stop, column_stop))
+        block[diagonal-start, diagonal-column_start] = 0.
+        candidates = np.hstack((neighbours, np.repeat(np.arange(column_start, column_stop)[np.newaxis, :],
+                                                      stop-start, axis=0)))
+        block = np.hstack((values, block))
+        best = top_k(block, n_neighbours) if n_neighbours else np.empty((stop-start, 0), dtype=int)
+        neighbours, values = candidates[rows, best], block[rows, best]
+    return np.where(values > 0., neighbours, -1).astype(np.int32), values.astype(np.float32)
+
+
+_shared = {}
+
+
+def _share(matrix, counts):
+    """
+    Initializer of the worker processes. The matrix is sent once to each worker instead of once for each block.
+    """
+    _shared["matrix"], _shared["counts"] = matrix, counts
+
+
+def _similarity_block_worker(arguments):
+    return similarity_block(_shared["matrix"], _shared["counts"], *arguments)
+
+
+def top_neighbours(matrix, similarity="jaccard", n_neighbours=100, block_size=1024, n_jobs=1, memory_budget=None,
+                   directory=None):
+    """
+    Compute the most similar rows of each row of a binary sparse matrix. The co-occurrence of the rows is computed in
+    blocks of rows with a sparse matrix product, so only a (block_size, rows) dense matrix is in memory at a time.
+
+    :param matrix: A binary scipy.sparse matrix with an entity in each row (an item with its users for instance). With
+        the dot similarity the matrix can have any weights
+    :param similarity: Name of the similarity in SIMILARITIES
+    :param n_neighbours: Number of neighbours kept for each row
+    :param block_size: Number of rows in each block
+    :param n_jobs: Number of processes that compute the blocks
+    :param memory_budget: Maximum number of bytes of the blocks in memory. The blocks are split by columns to fit in it
+        and, if the result does not fit either, it is written in memory mapped files. None has no limit
+    :param directory: Directory of the memory mapped files, owned by the caller. Default is a temporary directory that
+        is removed before returning: the arrays stay mapped and the disk space is freed when they are released
+    :return: A (rows, n_neighbours) int32 array with the neighbours of each row, from the most similar, and a float32
+        array with their similarities. Missing neighbours are -1 with similarity 0.
+    """
+    matrix = sp.csr_matrix(matrix)
+    size = matrix.shape[0]
+    n_neighbours = max(min(n_neighbours, size-1), 0)
+    counts = np.diff(matrix.indptr).astype(np.float64)
+    column_block = size
+    if memory_budget is not None:
+        # Co-occurrence, similarity and candidate indexes, 8 bytes each, for each process. The blocks get fewer rows
+        # before they are split by columns
+        block_size = max(1, min(block_size, memory_budget // (24 * n_jobs * (size + n_neighbours))))
+        column_block = max(1, min(size, memory_budget // (24 * n_jobs * block_size) - n_neighbours))
+    shape = (size, n_neighbours)
+    temporary = None
+    if memory_budget is not None and size * n_neighbours * 8 > memory_budget:
+        if directory is None:
+            directory = temporary = tempfile.mkdtemp(prefix="neighbours")
+        neighbours = np.memmap(os.path.join(directory, "neighbours.dat"), dtype=np.int32, mode="w+", shape=shape)
+        similarities = np.memmap(os.path.join(directory, "similarities.dat"), dtype=np.float32, mode="w+", shape=shape)
+    else:
+        neighbours, similarities = np.empty(shape, dtype=np.int32), np.empty(shape, dtype=np.float32)
+    blocks = [(similarity, start, min(start + block_size, size), n_neighbours, column_block)
+              for start in xrange(0, size, block_size)]
+    try:
+        if n_jobs > 1:
+            pool = multiprocessing.Pool(n_jobs, initializer=_share, initargs=(matrix, counts))
+            try:
+                results = pool.imap(_similarity_block_worker, blocks, max(1, len(blocks) // (4 * n_jobs)))
+                for (_, start, stop, _, _), (block_neighbours, block_similarities) in zip(blocks, results):
+                    neighbours[start:stop], similarities[start:stop] = block_neighbours, block_similarities
+            finally:
+                pool.terminate()
+        else:
+            for arguments in blocks:
+                _, start, stop, _, _ = arguments
+                neighbours[start:stop], similarities[start:stop] = similarity_block(matrix, counts, *arguments)
+    finally:
+        if temporary is not None:
+            shutil.rmtree(temporary)
+    return neighbours, similarities
+
+
+def peak_memory():
+    """
+    Peak resident set size of this process and of its finished children, in kilobytes
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+
+def neighbour_matrix(neighbours, similarities):
+    """
+    Sparse (rows, rows) matrix with the similarity of each row to its neighbours
+    """
+    rows = np.repeat(np.arange(neighbours.shape[0]), neighbours.shape[1])
+    valid = neighbours.ravel() >= 0
+    return sp.csr_matrix((similarities.ravel()[valid], (rows[valid], neighbours.ravel()[valid])),
+                         shape=(neighbours.shape[0], neighbours.shape[0]))
+
+
+def top_k_row_sums(matrix, k):
+    """
+    Sum the k highest values of each row of a sparse matrix
+    """
+    matrix = matrix.tocoo()
+    order = np.lexsort((-matrix.data, matrix.row))
+    rows, values = matrix.row[order], matrix.data[order]
+    rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+    return np.bincount(rows[rank < k], weights=values[rank < k], minlength=matrix.shape[0])
+
+
+class LRUCache(object):
+    """
+    Least recently used cache of numpy arrays with a limit in bytes
+    """
+
+    def __init__(self, max_bytes=2**26):
+        """
+        Constructor
+
+        :param max_bytes: Maximum number of bytes of the arrays in the cache
+        """
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.entries = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """
+        Return the value of key or None if it is not in the cache
+        """
+        value = self.entries.pop(key, None)
+        if value is not None:
+            self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        """
+        Put a tuple of numpy arrays in the cache. The least recently used entries are dropped to stay under the limit.
+        """
+        if key in self.entries:
+            self.bytes -= sum(array.nbytes for array in self.entries.pop(key))
+        self.entries[key] = value
+        self.bytes += sum(array.nbytes for array in value)
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            _, dropped = self.entries.popitem(last=False)
+            self.bytes -= sum(array.nbytes for array in dropped)
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
 
 
 class RandomModel(NOGILRandomModel):
@@ -68,40 +304,116 @@ class ConstantModel(IModel):
 
 
 class Item2Item(IModel):
+    """
+    Item based neighbourhood model. The score of an item for a user is the sum of the k highest similarities between
+    the item and the items of the user. The similarities are computed from a sparse user x item matrix and only the
+    n_neighbours most similar items of each item are kept.
+    """
 
     k = 5
-    _items = {}
-    _users = {}
+    similarity_name = "jaccard"
+    n_neighbours = 100
+    block_size = 1024
+    fit_time = peak_memory = None
 
-    @staticmethod
-    def compute_jaccard_index(set_1, set_2):
+    def __init__(self, k=5, similarity="jaccard", n_neighbours=100, block_size=1024, n_jobs=1, memory_budget=None):
         """
-        Computes the Jaccard index for similarity measure between set 1 and set
-        2.
+        Constructor
+
+        :param k: How many closest items in the user profile to consider
+        :param similarity: jaccard, cosine or conditional (the probability of the item given an item of the user)
+        :param n_neighbours: Number of neighbours kept for each item
+        :param block_size: Number of items in each block of the co-occurrence computation
+        :param n_jobs: Number of processes that compute the similarities
+        :param memory_budget: Maximum number of bytes for the similarity blocks. See top_neighbours
         """
-        n = len(set_1.intersection(set_2))
-        return n / float(len(set_1) + len(set_2) - n)
+        self.k = k
+        self.similarity_name = similarity
+        self.n_neighbours = n_neighbours
+        self.block_size = block_size
+        self.n_jobs = n_jobs
+        self.memory_budget = memory_budget
+        self.matrix = self.neighbours = self.similarities = self.scores = None
 
     def similarity(self, i1, i2):
         """
-        Measures the similarity between 2 sets
+        Measures the similarity between 2 items
+        """
+        items = self.matrix.transpose().tocsr()
+        item_map = self.data_map[self.get_item_column()]
+        a, b = items[item_map[i1]], items[item_map[i2]]
+        co_occurrence = np.array([[a.multiply(b).sum()]], dtype=np.float64)
+        return float(SIMILARITIES[self.similarity_name](co_occurrence, np.array([a.nnz], dtype=np.float64),
+                                                        np.array([b.nnz], dtype=np.float64))[0, 0])
+
+    def train(self, training_data):
+        """
+        Build the user x item matrix and the neighbours of each item. The seconds it took are in fit_time and the peak
+        resident memory (kilobytes) in peak_memory.
         """
-        return self.compute_jaccard_index(self._items[i1], self._items[i2])
+        start = time.time()
+        self.matrix = interaction_matrix(training_data[:, 0], training_data[:, 1], self.users_size(),
+                                         self.items_size())
+        self.neighbours, self.similarities = top_neighbours(self.item_vectors(), self.similarity_name,
+                                                            self.n_neighbours, self.block_size, self.n_jobs,
+                                                            self.memory_budget)
+        self.scores = None
+        self.neighbour_scores()
+        self.fit_time, self.peak_memory = time.time() - start, peak_memory()
+
+    def item_vectors(self):
+        """
+        Sparse matrix with a row for each item that is compared to find the neighbours: the users of the item
+        """
+        return self.matrix.transpose()
 
-    def fit(self, training_data):
+    def neighbour_scores(self):
         """
-        Stores set of user ids for each item
+        Sparse (items, items) CSR matrix, item major on the neighbours: the row of an item has its similarity to the
+        items it is a neighbour of, so the rows of the items of a user are cheap slices. It is built from the
+        neighbours again when it was reset to None, after items are added for instance.
         """
-        self._items = {item: set(entries) for item, entries in training_data.groupby('item')['user']}
-        self._users = {user: set(entries) for user, entries in training_data.groupby('user')['item']}
+        if self.scores is None:
+            self.scores = neighbour_matrix(self.neighbours, self.similarities).transpose().tocsr()
+        return self.scores
+
+    def user_items(self, user):
+        """
+        Return the items (internal index) of a user (internal index)
+        """
+        return self.matrix.indices[self.matrix.indptr[user]:self.matrix.indptr[user+1]]
 
     def get_score(self, user, item, **context):
         """
         Returns the sum of the list whit self.k elements the sorted similarity between items of the user and item(param)
         excluding the item(param) itself.
         """
-        scores = (self.similarity(i, item) for i in self._users[user] if i != item)
-        return sum(sorted(scores, cmp=lambda x, y: cmp(y, x))[:self.k])
+        u, i = self.data_map[self.get_user_column()][user], self.data_map[self.get_item_column()][item]
+        neighbours = self.neighbours[i]
+        similar = np.in1d(neighbours, self.user_items(u), assume_unique=True)
+        return float(self.similarities[i][similar][:self.k].sum())
+
+    def get_recommendation(self, user, **context):
+        """
+        Return the scores of all the items (in the data map order) for the user
+        """
+        items = self.user_items(self.data_map[self.get_user_column()][user])
+        return top_k_row_sums(self.neighbour_scores()[items].transpose(), self.k)
+
+    def get_scores(self, user, items, **context):
+        """
+        Return the scores of many items for the user. Unknown items get 0.
+        """
+        indexes = self.encode(self.get_item_column(), items)
+        return np.where(indexes >= 0, self.get_recommendation(user)[indexes], 0.)
+
+    def get_top_recommendation(self, user, k=10, **context):
+        """
+        Return the k best items for the user and their scores, from best to worst
+        """
+        scores = self.get_recommendation(user)
+        best = top_k(scores, k)
+        return self.data_map[self.get_item_column()].index.values[best], scores[best]
 
     def set_params(self, k):
         """
@@ -119,75 +431,330 @@ class Item2Item(IModel):
         }
 
 
-class AverageModel(IModel):
-    _avg = {}
+class UserKNN(IModel):
+    """
+    User based neighbourhood model. The score of an item for a user is the sum of the similarities of the k most similar
+    users that consumed the item. The neighbours of a user are computed when the user is first scored and kept in a
+    least recently used cache.
+    """
 
-    def fit(self, training_data):
+    k = 20
+    similarity_name = "cosine"
+
+    def __init__(self, k=20, similarity="cosine", cache_bytes=2**26):
+        """
+        Constructor
+
+        :param k: Number of neighbours of each user
+        :param similarity: jaccard, cosine or conditional (the probability of the user given a neighbour)
+        :param cache_bytes: Maximum number of bytes of the neighbours in the cache
+        """
+        self.k = k
+        self.similarity_name = similarity
+        self.cache = LRUCache(cache_bytes)
+        self.matrix = self.transpose = self.counts = None
+
+    def train(self, training_data):
+        """
+        Build the user x item matrix
+        """
+        self.matrix = interaction_matrix(training_data[:, 0], training_data[:, 1], self.users_size(),
+                                         self.items_size())
+        self.transpose = self.matrix.transpose().tocsr()
+        self.counts = np.diff(self.matrix.indptr).astype(np.float64)
+        self.cache.clear()
+
+    def neighbours(self, user):
+        """
+        Return the k most similar users of a user (internal index) and their similarities
+        """
+        cached = self.cache.get(user)
+        if cached is None:
+            co_occurrence = self.matrix[user].dot(self.transpose).toarray().astype(np.float64)
+            similarities = SIMILARITIES[self.similarity_name](co_occurrence, self.counts[user:user+1], self.counts)[0]
+            similarities[user] = 0.
+            best = top_k(similarities, self.k)
+            best = best[similarities[best] > 0.]
+            cached = best.astype(np.int32), similarities[best].astype(np.float32)
+            self.cache.put(user, cached)
+        return cached
+
+    def get_recommendation(self, user, **context):
+        """
+        Return the scores of all the items (in the data map order) for the user
+        """
+        neighbours, similarities = self.neighbours(self.data_map[self.get_user_column()][user])
+        return self.matrix[neighbours].transpose().dot(similarities.astype(np.float64))
+
+    def get_score(self, user, item, **context):
+        neighbours, similarities = self.neighbours(self.data_map[self.get_user_column()][user])
+        consumed = self.matrix[neighbours, self.data_map[self.get_item_column()][item]].toarray().ravel()
+        return float(np.dot(similarities, consumed))
+
+    def get_scores(self, user, items, **context):
+        """
+        Return the scores of many items for the user. Unknown items get 0.
+        """
+        indexes = self.encode(self.get_item_column(), items)
+        return np.where(indexes >= 0, self.get_recommendation(user)[indexes], 0.)
+
+    def get_top_recommendation(self, user, k=10, **context):
+        """
+        Return the k best items for the user and their scores, from best to worst
+        """
+        scores = self.get_recommendation(user)
+        best = top_k(scores, k)
+        return self.data_map[self.get_item_column()].index.values[best], scores[best]
+
+    def set_params(self, k):
+        """
+        :param k int how many neighbours to consider.
+        """
+        self.k = k
+        self.cache.clear()
+
+    @classmethod
+    def param_details(cls):
+        """
+        Return parameter details for k.
+        """
+        return {
+            'k': (5, 100, 5, 20),
+        }
+
+    def get_name(self):
+        return "UserKNN (k={},similarity={})".format(self.k, self.similarity_name)
+
+
+class AverageModel(NOGILItemScoreModel):
+
+    def train(self, training_data):
         """
         Computes average rating of the item..
-        :param training_data: DataFrame training data
+        :param training_data: numpy array with the item index in the second column and the rating in the last one
         :return:
         """
-        movie_stats = training_data.groupby('item').agg({'rating': [lambda x: np.mean(x.apply(lambda y: float(y)))]})
-        self._avg = {
-            i: m[0]
-            for i, m in movie_stats.iterrows()
-        }
+        items = training_data[:, 1].astype(int)
+        ratings = training_data[:, -1].astype(np.float64)
+        counts = np.bincount(items, minlength=self.items_size())
+        self.set_scores(np.bincount(items, weights=ratings, minlength=self.items_size()) / np.maximum(counts, 1))
 
     def get_score(self, user, item, **context):
-        return self._avg[item]
+        return float(self.get_scores_array()[self.data_map[self.get_item_column()][item]])
 
 
-class Popularity(IModel):
-
-    _counts = {}
-    mn = float("inf")
-    mx = 0.
+class Popularity(NOGILItemScoreModel):
 
     def __init__(self, normalize=True):
         self.normalize = normalize
 
     def get_score(self, user, item, **context):
-        #return self._counts.get(item, 0.0)
-        return self._counts[item]
+        return float(self.get_scores_array()[self.data_map[self.get_item_column()][item]])
 
-    def fit(self, training_data):
+    def train(self, training_data):
         """
         Computes number of times the item was used by a user.
-        :param training_data: DataFrame training data
+        :param training_data: numpy array with the item index in the second column
         :return:
         """
+        counts = np.bincount(training_data[:, 1].astype(int), minlength=self.items_size()).astype(np.float64)
         if self.normalize:
-            self._counts = {i: log(v+1) for i, v in training_data.item.value_counts().iteritems()}
-            s = sorted(self._counts.values())
-            mn, mx = s[0], s[-1]
-            for k in self._counts.keys():
-                self._counts[k] = (self._counts[k]-mn)/(mx-mn)
-        else:
-            self._counts = {i: v for i, v in training_data.item.value_counts().iteritems()}
+            counts = np.log(counts+1)
+            mn, mx = counts.min(), counts.max()
+            counts = (counts-mn)/(mx-mn) if mx > mn else np.zeros_like(counts)
+        self.set_scores(counts)
 
     def get_name(self):
         return "Popularity"
 
 
-class PersonalizedPopularity(IModel):
-
-    _counts = {}
+class PersonalizedPopularity(NOGILUserItemScoreModel):
 
     def get_score(self, user, item, **context):
-        try:
-            return float(self._counts[user][item])
-        except KeyError:
+        user_map, item_map = self.data_map[self.get_user_column()], self.data_map[self.get_item_column()]
+        if user not in user_map or item not in item_map:
             return 0.0
-
-    def fit(self, training_data):
+        indptr, indices, values = self.get_scores_arrays()
+        u, i = user_map[user], item_map[item]
+        position = indptr[u] + np.searchsorted(indices[indptr[u]:indptr[u+1]], i)
+        if position < indptr[u+1] and indices[position] == i:
+            return float(values[position])
+        return 0.0
+
+    def train(self, training_data):
+        """
+        Count the times each user consumed each item
+        :param training_data: numpy array with the user index in the first column and the item index in the second
+        """
         #add date dependency
         # normalize ?
-        for useritem, count in training_data.groupby(['user']).item.value_counts().iteritems():
-            try:
-                self._counts[useritem[0]].update({useritem[1]: count})
-            except KeyError:
-                self._counts.update({useritem[0]: {useritem[1]: count}})
+        counts = sp.csr_matrix((np.ones(len(training_data), dtype=np.float32),
+                                (training_data[:, 0].astype(np.int32), training_data[:, 1].astype(np.int32))),
+                               shape=(self.users_size(), self.items_size()))
+        counts.sum_duplicates()
+        self.set_scores(counts.indptr, counts.indices, counts.data)
+
+    def get_name(self):
+        return "PersonalizedPopularity"
+
+
+class _EveryUser(object):
+    """
+    User map of a model that scores every user the same. Every user has the index 0, so the users are not kept.
+    """
+
+    def __getitem__(self, user):
+        return 0
+
+    def get(self, user, default=None):
+        return 0
+
+    def __contains__(self, user):
+        return True
+
+    def __len__(self):
+        return 1
+
+
+class DecayedPopularity(NOGILItemScoreModel):
+    """
+    Streaming popularity where each interaction counts exp(-decay * age), with the age measured from the newest
+    interaction seen. New batches of interactions are added with partial_fit in time proportional to the batch.
+
+    The weights are kept relative to a reference date, so the decay of the old interactions is a common factor that
+    does not need to be applied to every item (the native evaluator uses these relative weights, which rank the items in
+    the same order). Only the n_top best items are kept sorted for the top queries and, with max_items, the least
+    popular items are dropped to bound the memory. The items are pruned when there are PRUNE_SLACK * max_items, so a
+    partial_fit does not pay for a selection over every item each time, and between prunes the model can keep up to
+    that many items. The users are not kept: every user gets the same scores. With a short half life it ranks the
+    items by recency.
+    """
+
+    # The weights are rebased when the factor of the newest interactions is above exp(REBASE)
+    REBASE = 30.
+    # The items are pruned to max_items when there are more than PRUNE_SLACK * max_items
+    PRUNE_SLACK = 1.25
+
+    def __init__(self, half_life=7*24*3600., max_items=None, n_top=100, date_column=DATE):
+        """
+        Constructor
+
+        :param half_life: Time, in the unit of the date column, for an interaction to count half
+        :param max_items: Number of items kept after a prune, up to PRUNE_SLACK times more between prunes. None
+            keeps every item
+        :param n_top: Number of best items kept sorted
+        :param date_column: Name of the date column
+        """
+        self.half_life = half_life
+        self.decay = log(2.) / half_life
+        self.max_items = max_items
+        self.n_top = n_top
+        self.date_column = date_column
+        self.reset()
+
+    def reset(self):
+        """
+        Forget every interaction
+        """
+        self.reference = self.now = None
+        self.weights = np.zeros(16, dtype=np.float32)
+        self.item_ids, self.item_index = [], {}
+        self.top = np.zeros(0, dtype=np.int64)
+        self._data_map = None
+        self.set_scores(self.weights[:0])
+
+    @property
+    def data_map(self):
+        if self._data_map is None:
+            self._data_map = {
+                self.get_user_column(): _EveryUser(),
+                self.get_item_column(): pd.Series(np.arange(len(self.item_ids)), index=self.item_ids)
+            }
+        return self._data_map
+
+    def fit(self, training_data):
+        """
+        Forget every interaction and add the ones in the training data
+        """
+        self.reset()
+        self.partial_fit(training_data)
+
+    def partial_fit(self, training_data):
+        """
+        Add a batch of interactions
+
+        :param training_data: DataFrame with the user, item and date columns
+        """
+        if len(training_data) == 0:
+            return
+        self.new_fit_version()
+        dates = training_data[self.date_column].values.astype(np.float64)
+        if self.reference is None:
+            self.reference = dates.min()
+        self.now = max(self.now, dates.max()) if self.now is not None else dates.max()
+        if self.decay * (self.now - self.reference) > self.REBASE:
+            self.weights *= np.exp(-self.decay * (self.now - self.reference))
+            self.reference = self.now
+        ids, inverse = np.unique(training_data[self.get_item_column()].values, return_inverse=True)
+        touched = np.array([self.index_of(item) for item in ids], dtype=np.int64)
+        if len(self.item_ids) > len(self.weights):
+            self.weights = np.concatenate((self.weights, np.zeros(max(len(self.item_ids), 2*len(self.weights)) -
+                                                                  len(self.weights), dtype=np.float32)))
+        self.weights[touched] += np.bincount(inverse, weights=np.exp(self.decay * (dates - self.reference)))
+        # The weights only grow, so the new best items are among the old best and the ones in the batch
+        candidates = np.union1d(self.top, touched)
+        self.top = candidates[np.argsort(-self.weights[candidates], kind="mergesort")[:self.n_top]]
+        if self.max_items is not None and len(self.item_ids) > self.max_items * self.PRUNE_SLACK:
+            self.prune()
+        self._data_map = None
+        self.set_scores(self.weights[:len(self.item_ids)])
+
+    def index_of(self, item):
+        """
+        Return the index of an item, adding it if it is new
+        """
+        index = self.item_index.get(item)
+        if index is None:
+            index = self.item_index[item] = len(self.item_ids)
+            self.item_ids.append(item)
+        return index
+
+    def prune(self):
+        """
+        Keep only the max_items most popular items
+        """
+        keep = np.sort(top_k(self.weights[:len(self.item_ids)], self.max_items))
+        new_index = np.full(len(self.item_ids), -1, dtype=np.int64)
+        new_index[keep] = np.arange(len(keep))
+        self.item_ids = [self.item_ids[i] for i in keep]
+        self.item_index = {item: i for i, item in enumerate(self.item_ids)}
+        self.weights = np.concatenate((self.weights[keep], np.zeros(len(keep), dtype=np.float32)))
+        self.top = new_index[self.top]
+        self.top = self.top[self.top >= 0]
+
+    def scale(self):
+        """
+        Factor from the weights to the decayed counts at the newest interaction
+        """
+        return np.exp(-self.decay * (self.now - self.reference)) if self.now is not None else 0.
+
+    def get_score(self, user, item, **context):
+        index = self.item_index.get(item)
+        return 0. if index is None else float(self.weights[index] * self.scale())
+
+    def get_scores(self, user, items, **context):
+        indexes = np.array([self.item_index.get(item, -1) for item in items], dtype=np.int64)
+        return np.where(indexes >= 0, self.weights[indexes] * self.scale(), 0.)
+
+    def get_top_recommendation(self, user=None, k=10, **context):
+        """
+        Return the k most popular items and their decayed counts, from best to worst
+        """
+        if k <= len(self.top) or len(self.top) == len(self.item_ids):
+            best = self.top[:k]
+        else:
+            best = top_k(self.weights[:len(self.item_ids)], k)
+        return np.array([self.item_ids[i] for i in best]), self.weights[best] * self.scale()
 
     def get_name(self):
-        return "PersonalizedPopularity"
\ No newline at end of file
+        return "DecayedPopularity (half_life={})".format(self.half_life)
@@ -10,17 +10,31 @@ __author__ = "alexis"
 
 
 
+import time
 import numpy as np
-import random
 from testfm.models.cutil.interface import IModel
+try:
+    from testfm.models.cutil.bpr import CBPR
+except ImportError:
+    # The native BPR is optional, the python models work without it
+    CBPR = None
+from testfm.models.sampling import UniformSampler, PopularitySampler, AdaptiveSampler
 
 
 class BPR(IModel):
 
-    def __init__(self, eta=0.03, reg=0.0001, dim=20, n_iter=30):
+    def __init__(self, eta=0.03, reg=0.0001, dim=20, n_iter=30, sampler=None, sample_size=256):
+        """
+        Constructor
+
+        :param sampler: A sampler from testfm.models.sampling for the negative items. Default is uniform excluding the
+            items of the user
+        :param sample_size: Number of negative items drawn at once. Adaptive samplers score them against the factors
+            of the moment they are drawn
+        """
         self.set_params(eta, reg, dim, n_iter)
-        self.U = {}
-        self.M = {}
+        self.sampler = sampler or UniformSampler()
+        self.sample_size = sample_size
 
     def set_params(self, eta=0.03, reg=0.0001, dim=20, n_iter=25):
         """
@@ -30,8 +44,8 @@ class BPR(IModel):
         self._n_iter = int(n_iter)
         self._reg = float(reg)
         self._eta = float(eta)
-        self.U = {}
-        self.M = {}
+        self.U = None
+        self.M = None
 
     @classmethod
     def param_details(cls):
@@ -45,43 +59,45 @@ class BPR(IModel):
                 "eta": (0.01, 0.08, 0.005, 0.03)
         }
 
-    def fit(self, data):
+    def train(self, data):
         """
-        Train the model
+        Train the model. The user factors U and the item factors M are matrices indexed by the data map.
         """
-        data_array = data[["user", "item"]]
-        items = data.item.unique()
+        users, items = data[:, 0].astype(int), data[:, 1].astype(int)
+        self.U = self._init_vector(self.users_size())
+        self.M = self._init_vector(self.items_size())
+        self.sampler.fit(users, items, self.users_size(), self.items_size())
 
         for iter in range(self._n_iter):
-            for idx, row in data_array.iterrows():
-                self._additiveupdate(row, items)
+            for start in xrange(0, len(users), self.sample_size):
+                batch_users = users[start:start+self.sample_size]
+                negatives = self.sampler.sample(batch_users, self.U, self.M)
+                for user, item, negative in zip(batch_users, items[start:start+self.sample_size], negatives):
+                    if item != negative:
+                        self._additiveupdate(user, item, negative)
 
-    def _additiveupdate(self, row, items):
+    def _additiveupdate(self, user, item, negative):
 
         #take the factors for user, item and negative item
-        u = self.U.get(row["user"], self._init_vector())
-        m = self.M.get(row["item"], self._init_vector())
-        rand = random.choice(items)
-        m_neg = self.M.get(rand, self._init_vector())
+        u = self.U[user]
+        m = self.M[item]
+        m_neg = self.M[negative]
 
-        #do updates
+        #do updates, the regularization shrinks the factors as in CBPR and MiniBatchBPR
         hscore = np.dot(u, m) - np.dot(u, m_neg)
         ploss = self.compute_partial_loss(0, hscore)
         # update user
-        u -= self._eta * ((ploss * (m - m_neg)) - self._reg * u)
+        u -= self._eta * ((ploss * (m - m_neg)) + self._reg * u)
 
         #update positive item
-        m -= self._eta*((ploss * u) - self._reg * m)
+        m -= self._eta*((ploss * u) + self._reg * m)
 
         #update negative item
-        m_neg -= self._eta*((ploss * (-u)) -  self._reg* m_neg)
-
-        self.U[row["user"]] = u
-        self.M[row["item"]] = m
-        self.M[rand] = m_neg
+        m_neg -= self._eta*((ploss * (-u)) + self._reg * m_neg)
 
     def get_score(self, user, item):
-        return np.dot(self.U[user], self.M[item])
+        return np.dot(self.U[self.data_map[self.get_user_column()][user]],
+                      self.M[self.data_map[self.get_item_column()][item]])
 
     def get_name(self):
         return "BPR (dim={},iter={},reg={},eta={})".format(self._dim, self._n_iter, self._reg, self._eta)
@@ -104,5 +120,68 @@ class BPR(IModel):
         exponential =  np.exp(-score)
         return - exponential/(1.0 + exponential)
 
-    def _init_vector(self):
-        return np.random.normal(0, 2.5/self._dim, size=self._dim)
+    def _init_vector(self, size):
+        return np.random.normal(0, 2.5/self._dim, size=(size, self._dim))
+
+
+class MiniBatchBPR(BPR):
+    """
+    BPR trained with vectorized mini-batches. Each batch is a set of (user, positive item, negative item) triplets as
+    arrays; the gradients are computed for the whole batch and added to the factors with np.add.at, so users and items
+    that repeat in the batch get every update.
+    """
+
+    def __init__(self, eta=0.03, reg=0.0001, dim=20, n_iter=30, sampler=None, batch_size=1000, decay=1.,
+                 callback=None):
+        """
+        Constructor
+
+        :param batch_size: Number of triplets in each batch
+        :param decay: The learning rate is multiplied by decay after each epoch
+        :param callback: Function called after each epoch with the epoch number, the seconds it took and the mean loss
+        """
+        super(MiniBatchBPR, self).__init__(eta, reg, dim, n_iter, sampler, batch_size)
+        self.batch_size = batch_size
+        self.decay = decay
+        self.callback = callback
+        self.history = []
+
+    def train(self, data):
+        """
+        Train the model. The history has the epoch number, the seconds it took and the mean loss of each epoch.
+        """
+        users, items = data[:, 0].astype(int), data[:, 1].astype(int)
+        self.U = self._init_vector(self.users_size())
+        self.M = self._init_vector(self.items_size())
+        self.sampler.fit(users, items, self.users_size(), self.items_size())
+        self.history = []
+        eta = self._eta
+        for epoch in range(self._n_iter):
+            start_time, loss = time.time(), 0.
+            order = np.random.permutation(len(users))
+            for start in xrange(0, len(order), self.batch_size):
+                batch = order[start:start+self.batch_size]
+                loss += self.batch_update(users[batch], items[batch], eta)
+            eta *= self.decay
+            self.history.append((epoch, time.time() - start_time, loss / len(users)))
+            if self.callback is not None:
+                self.callback(*self.history[-1])
+
+    def batch_update(self, users, items, eta):
+        """
+        Do a gradient step for a batch of users and their positive items
+
+        :return: The sum of the loss of the batch triplets
+        """
+        negatives = self.sampler.sample(users, self.U, self.M)
+        u, m, m_neg = self.U[users], self.M[items], self.M[negatives]
+        x = np.sum(u * (m - m_neg), axis=1)
+        gradient = (1. / (1. + np.exp(x)))[:, np.newaxis]
+        np.add.at(self.U, users, eta * (gradient * (m - m_neg) - self._reg * u))
+        np.add.at(self.M, items, eta * (gradient * u - self._reg * m))
+        np.add.at(self.M, negatives, eta * (-gradient * u - self._reg * m_neg))
+        return np.logaddexp(0., -x).sum()
+
+    def get_name(self):
+        return "MiniBatchBPR (dim={},iter={},reg={},eta={},batch_size={})".format(
+            self._dim, self._n_iter, self._reg, self._eta, self.batch_size)
@@ -9,11 +9,21 @@ Content based model
 
 __author__ = "linas"
 
-from math import sqrt
+import os
+import zlib
+import cPickle as pickle
+import multiprocessing
+from itertools import chain
+from collections import deque
+from string import printable
 import numpy as np
+import pandas as pd
+import scipy.sparse as sp
 
-from gensim import corpora, models, similarities
-from testfm.models.cutil.interface import IModel
+from gensim import models, matutils
+from gensim.utils import simple_preprocess
+from testfm.models.cutil.interface import IModel, top_k
+from testfm.models.baseline_model import Item2Item, interaction_matrix
 
 
 stopwords_str = "a,able,about,across,after,all,almost,also,am,among\
@@ -27,6 +37,306 @@ off,often,on,only,or,other,our,own,rather,said,say,says,she,should\
 ,who,whom,why,will,with,would,yet,you,your"
 
 
+_NON_PRINTABLE = "".join(chr(c) for c in xrange(256) if chr(c) not in printable)
+
+
+def clean_text(description, stopwords):
+    """
+    Split a description in lower case words without the non printable characters and the stopwords
+    """
+    if isinstance(description, str):
+        description = description.translate(None, _NON_PRINTABLE)
+    else:
+        description = "".join(e for e in description if e in printable)
+    return [word for word in simple_preprocess(description) if word not in stopwords]
+
+
+_stopwords = {}
+
+
+def _set_stopwords(stopwords):
+    """
+    Initializer of the worker processes. The stopwords are sent once to each worker.
+    """
+    _stopwords.clear()
+    _stopwords.update(stopwords)
+
+
+def _clean_chunk(descriptions):
+    return [clean_text(description, _stopwords) for description in descriptions]
+
+
+class TextPreprocessor(object):
+    """
+    Tokenize each distinct description once. The words are kept as int32 arrays of term ids in a cache, so the user
+    documents are concatenations of the arrays of their items instead of new descriptions to tokenize.
+    """
+
+    def __init__(self, stopwords, n_jobs=1, chunk_size=1000):
+        """
+        Constructor
+
+        :param stopwords: Words that are dropped
+        :param n_jobs: Number of processes that tokenize the descriptions
+        :param chunk_size: Number of descriptions sent to a process at a time
+        """
+        self.stopwords = stopwords
+        self.n_jobs = n_jobs
+        self.chunk_size = chunk_size
+        self.vocabulary, self.terms, self.cache = {}, [], {}
+
+    def _new_chunks(self, descriptions, pending):
+        """
+        Chunks of the descriptions that are not in the cache yet. Each chunk is also appended to pending.
+        """
+        chunk, seen = [], set()
+        for description in descriptions:
+            if description not in self.cache and description not in seen:
+                seen.add(description)
+                chunk.append(description)
+                if len(chunk) == self.chunk_size:
+                    pending.append(chunk)
+                    yield chunk
+                    chunk = []
+        if chunk:
+            pending.append(chunk)
+            yield chunk
+
+    def term_id(self, term):
+        """
+        Return the id of a term, adding it to the vocabulary if it is new
+        """
+        index = self.vocabulary.get(term)
+        if index is None:
+            index = self.vocabulary[term] = len(self.terms)
+            self.terms.append(term)
+        return index
+
+    def update(self, descriptions):
+        """
+        Tokenize the descriptions that are not in the cache. The descriptions are read in chunks, so they can be a
+        generator over a big file, and the chunks are tokenized by n_jobs processes while the next ones are read. The
+        processes are only started when there is more than one chunk of new descriptions.
+        """
+        pending = deque()
+        chunks = self._new_chunks(descriptions, pending)
+        first = next(chunks, None)
+        if first is None:
+            return
+        second = next(chunks, None) if self.n_jobs > 1 else None
+        pool = None
+        if second is not None:
+            pool = multiprocessing.Pool(self.n_jobs, initializer=_set_stopwords, initargs=(self.stopwords,))
+            results = pool.imap(_clean_chunk, chain([first, second], chunks))
+        else:
+            _set_stopwords(self.stopwords)
+            results = (_clean_chunk(chunk) for chunk in chain([first], chunks))
+        try:
+            for words in results:
+                for description, document in zip(pending.popleft(), words):
+                    self.cache[description] = np.array([self.term_id(word) for word in document], dtype=np.int32)
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    def documents(self, descriptions):
+        """
+        Return the term ids of each description, tokenizing the new ones
+        """
+        self.update(descriptions)
+        return [self.cache[description] for description in descriptions]
+
+    def words(self, document):
+        """
+        Return the words of a document of term ids
+        """
+        return [self.terms[i] for i in document]
+
+
+def bag_of_words(document):
+    """
+    Return the (term id, count) pairs of a document of term ids
+    """
+    ids, counts = np.unique(document, return_counts=True)
+    return zip(ids.tolist(), counts.tolist())
+
+
+def term_counts(documents, n_terms):
+    """
+    Count the terms of each document
+
+    :param documents: A list of documents, each an array of term ids
+    :param n_terms: Number of terms
+    :return: A scipy.sparse.csr_matrix (documents, terms) with the counts
+    """
+    indptr = np.zeros(len(documents)+1, dtype=np.int64)
+    np.cumsum([len(document) for document in documents], out=indptr[1:])
+    indices = np.concatenate(documents) if documents else np.zeros(0, dtype=np.int32)
+    counts = sp.csr_matrix((np.ones(len(indices)), indices, indptr), shape=(len(documents), n_terms))
+    counts.sum_duplicates()
+    return counts
+
+
+def normalize_rows(matrix):
+    """
+    Divide each row of a sparse matrix by its L2 norm. Empty rows are left empty.
+    """
+    matrix = sp.csr_matrix(matrix)
+    norms = np.sqrt(np.bincount(np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr)),
+                                weights=matrix.data ** 2, minlength=matrix.shape[0]))
+    return sp.diags(1. / np.maximum(norms, 1e-12), 0).dot(matrix).tocsr()
+
+
+def unit_rows(matrix):
+    """
+    Divide each row of a dense matrix by its L2 norm. Zero rows are left as zeros.
+
+    :return: A float32 numpy array
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    return matrix / np.maximum(np.sqrt((matrix ** 2).sum(axis=1)), 1e-12)[:, np.newaxis]
+
+
+def hash_words(documents, n_features):
+    """
+    Count the words of each document in n_features columns chosen by a hash of the word. Each word also gets a sign
+    from the hash so the collisions cancel on average.
+
+    :param documents: A list of documents, each a list of words
+    :return: A scipy.sparse.csr_matrix (documents, n_features)
+    """
+    indptr = np.zeros(len(documents)+1, dtype=np.int64)
+    np.cumsum([len(document) for document in documents], out=indptr[1:])
+    hashes = np.fromiter((zlib.crc32(word.encode("utf8")) & 0xffffffff for document in documents for word in document),
+                         dtype=np.int64, count=indptr[-1])
+    signs = np.where(hashes & 0x80000000, -1., 1.)
+    matrix = sp.csr_matrix((signs, hashes % n_features, indptr), shape=(len(documents), n_features))
+    matrix.sum_duplicates()
+    return matrix
+
+
+def sparse_random_projection(n_features, dim, n_nonzero=None, seed=0):
+    """
+    Sparse random projection matrix: each row has n_nonzero entries in random columns, +-1/sqrt(n_nonzero) with a
+    random sign, which preserves the distances on average. The default is dim/8 entries.
+
+    :return: A scipy.sparse.csr_matrix (n_features, dim)
+    """
+    n_nonzero = n_nonzero or max(1, dim // 8)
+    random = np.random.RandomState(seed)
+    rows = np.repeat(np.arange(n_features), n_nonzero)
+    values = np.where(random.randint(0, 2, len(rows)), 1., -1.) / np.sqrt(n_nonzero)
+    projection = sp.csr_matrix((values.astype(np.float32), (rows, random.randint(0, dim, len(rows)))),
+                               shape=(n_features, dim))
+    projection.sum_duplicates()
+    return projection
+
+
+class RowBuffer(object):
+    """
+    The rows of a numpy array with spare capacity at the end. Appending rows copies the array only when the capacity is
+    exhausted, and then doubles it, so a stream of appends takes amortized constant time per row.
+    """
+
+    def __init__(self, rows):
+        self.data = rows
+        self.size = len(rows)
+        # The array of the rows, a view of data
+        self.rows = rows
+
+    def append(self, rows):
+        """
+        Append rows and return the array of all the rows
+        """
+        size = self.size + len(rows)
+        if size > len(self.data):
+            data = np.empty((max(size, 2 * len(self.data)),) + self.data.shape[1:], dtype=self.data.dtype)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+        self.data[self.size:size] = rows
+        self.size = size
+        self.rows = self.data[:size]
+        return self.rows
+
+
+class SparseRowBuffer(object):
+    """
+    The rows of a scipy.sparse.csr_matrix with the data, indices and indptr arrays in RowBuffers, so appending rows
+    takes amortized constant time per nonzero. Rows that are replaced are kept apart and merged in the matrix in
+    batches: row_indices reads them before they are merged.
+    """
+
+    def __init__(self, matrix):
+        matrix = sp.csr_matrix(matrix)
+        matrix.sort_indices()
+        self.data = RowBuffer(matrix.data)
+        self.indices = RowBuffer(matrix.indices.astype(np.int32))
+        self.indptr = RowBuffer(matrix.indptr.astype(np.int32))
+        self.n_columns = matrix.shape[1]
+        self.pending = {}
+        self.rows = self._matrix()
+
+    def _matrix(self):
+        return sp.csr_matrix((self.data.rows, self.indices.rows, self.indptr.rows),
+                             shape=(len(self.indptr.rows) - 1, self.n_columns))
+
+    def append(self, rows):
+        """
+        Append the rows of a sparse matrix and return the matrix of all the rows
+        """
+        rows = sp.csr_matrix(rows)
+        indptr = rows.indptr[1:] + self.indptr.rows[-1]
+        self.data.append(rows.data)
+        self.indices.append(rows.indices)
+        self.indptr.append(indptr)
+        self.n_columns = max(self.n_columns, rows.shape[1])
+        self.rows = self._matrix()
+        return self.rows
+
+    def resize(self, n_columns):
+        """
+        Set the number of columns and return the matrix
+        """
+        self.n_columns = n_columns
+        self.rows = self._matrix()
+        return self.rows
+
+    def replace(self, row, values):
+        """
+        Replace a row by a (1, columns) sparse matrix and return the matrix. The replaced rows are merged when they
+        are an eighth of the rows, so each replacement takes amortized constant time.
+        """
+        self.pending[row] = sp.csr_matrix(values)
+        if len(self.pending) * 8 >= self.rows.shape[0]:
+            self.merge()
+        return self.rows
+
+    def row_indices(self, row):
+        """
+        Return the sorted column indexes of a row
+        """
+        if row in self.pending:
+            return self.pending[row].indices
+        return self.rows.indices[self.rows.indptr[row]:self.rows.indptr[row+1]]
+
+    def merge(self):
+        """
+        Rebuild the matrix with the replaced rows
+        """
+        if self.pending:
+            kept = np.ones(self.rows.shape[0], dtype=bool)
+            kept[list(self.pending)] = False
+            coo = self.rows.tocoo()
+            mask = kept[coo.row]
+            pending = self.pending.items()
+            rows = [coo.row[mask]] + [np.repeat(row, values.nnz) for row, values in pending]
+            columns = [coo.col[mask]] + [values.indices for _, values in pending]
+            data = [coo.data[mask]] + [values.data for _, values in pending]
+            self.__init__(sp.csr_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(columns))),
+                                        shape=self.rows.shape))
+        return self.rows
+
+
 class LSIModel(IModel):
     """
     LSI based Content Based Filtering using the app description.
@@ -34,91 +344,145 @@ class LSIModel(IModel):
     Now each user is represented as a concatenation of app descriptions he has
     and projected into LSI space. The nearest app is taken as the
     recommendation.
+
+    The users and the items are the L2 normalized float32 rows of two dense matrices indexed by the data map, so the
+    cosine is a dot product and scoring many items or users is a matrix product.
     """
 
     _dim = 50
     _column_name = "UNDEFINED"  # column name to use for content
     _stopwords = {item: 1 for item in stopwords_str.split(",")}
     lsi = None
+    item_documents = None
 
-    # User representation in LSI space (_dim dimensions vector)
-    _user_representation = {}
-
-    # Item representation in LSI space (_dim dimensions vector)
-    _item_representation = {}
-
-    def __init__(self, description_column_name, dim=50, cold_start_strategy="return0"):
+    def __init__(self, description_column_name, dim=50, cold_start_strategy="return0", n_jobs=1):
         """
         :param description_column_name: str the name for the description column
             used for train the model
         :param dim: LSI dimensionality
+        :param cold_start_strategy: return0 to score 0 the users and items that were not in the training set.
+            Otherwise they raise a ValueError
+        :param n_jobs: Number of processes that tokenize the descriptions
         :return:
         """
         self._dim = dim
         self._column_name = description_column_name
         self._cold_start = cold_start_strategy
+        self.preprocessor = TextPreprocessor(self._stopwords, n_jobs)
+        self.data_map = {}
+        # User and item representation in LSI space ((users, _dim) and (items, _dim) matrices)
+        self.user_factors = self.item_factors = None
+        # Buffers of the matrices that grow as users and items are added, by attribute name
+        self._buffers = {}
 
     def get_name(self):
         return "LSI: dim={}".format(self._dim)
 
+    def _index(self, column, value):
+        """
+        Return the index of a user or an item, or None if it was not in the training set and the cold start strategy
+        is return0
+        """
+        index = self.data_map[column].get(value)
+        if index is None and self._cold_start != "return0":
+            raise ValueError("{} {} was not in the training set".format(column.capitalize(), value))
+        return index
+
     def get_score(self, user, item):
+        u, i = self._index(self.get_user_column(), user), self._index(self.get_item_column(), item)
+        if u is None or i is None:
+            return 0.0
+        return float(np.dot(self.user_factors[u], self.item_factors[i]))
+
+    def get_recommendation(self, user, **context):
         """
-        if not item in self._item_representation:
-            if self._cold_start == "return0":
-                return 0.0
-            else:
-                raise ValueError(
-                    "Item {} was not in the training set".format(item))
+        Return the scores of all the items (in the data map order) for the user
+        """
+        u = self._index(self.get_user_column(), user)
+        if u is None:
+            return np.zeros(len(self.item_factors), dtype=np.float32)
+        return self.item_factors.dot(self.user_factors[u])
 
-        if not user in self._user_representation:
-            if self._cold_start == "return0":
-                return 0.0
-            else:
-                raise ValueError(
-                    "User {} was not in the training set".format(user))
+    def get_scores(self, user, items, **context):
+        """
+        Return the scores of many items for the user. Unknown items get 0.
+        """
+        indexes = self.encode(self.get_item_column(), items)
+        if self._cold_start != "return0" and (indexes < 0).any():
+            raise ValueError("Item {} was not in the training set".format(np.asarray(items)[indexes < 0][0]))
+        return np.where(indexes >= 0, self.get_recommendation(user)[indexes], 0.)
 
-        return self.cosine(self.get_vector(self._user_representation[user]),
-                           self.get_vector(self._item_representation[item]))
+    def get_top_recommendation(self, user, k=10, **context):
         """
-        # This also for Linas analyse
-        try:
-            return self.cosine(self.get_vector(self._user_representation[user]),
-                               self.get_vector(self._item_representation[item]))
-        except KeyError:
-            if self._cold_start == "return0":
-                return 0.0
-            elif not item in self._item_representation:
-                raise ValueError(
-                    "Item {} was not in the training set".format(item))
-            else:
-                raise ValueError(
-                    "User {} was not in the training set".format(user))
+        Return the k best items for the user and their scores, from best to worst
+        """
+        scores = self.get_recommendation(user)
+        best = top_k(scores, k)
+        return self.data_map[self.get_item_column()].index.values[best], scores[best]
+
+    def get_top_recommendations(self, users, k=10):
+        """
+        Return the k best items for each user with one matrix product
+
+        :param users: A list of users. Users that were not in the training set follow the cold start strategy: their
+            scores are 0 with return0, otherwise they raise a ValueError
+        :return: A (users, k) array with the items, from best to worst, and an array with their scores
+        """
+        indexes = self.encode(self.get_user_column(), users)
+        unknown = indexes < 0
+        if unknown.any() and self._cold_start != "return0":
+            raise ValueError("User {} was not in the training set".format(np.asarray(users)[unknown][0]))
+        scores = self.user_factors[np.maximum(indexes, 0)].dot(self.item_factors.T)
+        scores[unknown] = 0.
+        best = top_k(scores, k)
+        return self.data_map[self.get_item_column()].index.values[best], scores[np.arange(len(users))[:, None], best]
 
     def _clean_text(self, item_description):
-        from gensim.utils import simple_preprocess
-        from string import printable
+        return clean_text(item_description, self._stopwords)
+
+    def _item_documents(self, training_data):
+        """
+        Map each item to the term ids of its description
+        """
+        rows = training_data.drop_duplicates(self.get_item_column())
+        descriptions = [str(description) for description in rows[self._column_name].values]
+        return dict(zip(rows[self.get_item_column()].values, self.preprocessor.documents(descriptions)))
 
-        # Filter the string for non printable char and process it to an array
-        # of words.
-        s = simple_preprocess("".join((e for e in item_description if e in printable)))
-        return [i for i in s if i not in self._stopwords]
+    def _user_documents(self, training_data):
+        """
+        Map each user to the concatenation of the term ids of the descriptions of his rows
+        """
+        codes, descriptions = pd.factorize(training_data[self._column_name].astype(str).values)
+        documents = self.preprocessor.documents(list(descriptions))
+        return {
+            user: np.concatenate([documents[code] for code in codes[rows]])
+            for user, rows in training_data.groupby(self.get_user_column()).indices.items()
+        }
 
     def _get_item_models(self, training_data):
         return {
             # Map item to an array of words after processing(relevant words
             # only)
-            item: self._clean_text(str(entries[self._column_name].iget(0))) for item, entries in training_data.groupby("item")
+            item: self.preprocessor.words(document) for item, document in self._item_documents(training_data).items()
         }
 
     def _get_user_models(self, training_data):
         return {
             # Map user to an array of words after processing(relevant words
             # only)
-            user: self._clean_text(" ".join(
-                (str(item_desc) for item_desc in entries[self._column_name])))
-            for user, entries in training_data.groupby("user")
+            user: self.preprocessor.words(document) for user, document in self._user_documents(training_data).items()
         }
 
+    def _representation(self, documents):
+        """
+        Project the documents into the LSI space
+
+        :param documents: A list of documents, each an array of term ids
+        :return: A (documents, _dim) float32 matrix with L2 normalized rows
+        """
+        corpus = self.lsi[[bag_of_words(document[document < self.lsi.num_terms]) for document in documents]]
+        return unit_rows(matutils.corpus2dense(corpus, self._dim, len(documents)).T)
+
     def _fit_users(self, training_data):
         """
         Computes LSI for users
@@ -126,83 +490,372 @@ class LSIModel(IModel):
         :param training_data:
         :return:
         """
-        user_models = self._get_user_models(training_data)
-        dictionary = corpora.Dictionary(user_models.values())
-        corpus = (dictionary.doc2bow(e) for e in user_models.values())
-        self.lsi = models.LsiModel(corpus, id2word=dictionary, num_topics=self._dim)
-        #corpus_lsi = self.lsi[corpus]
-        for user, user_model in user_models.items():
-            self._user_representation[user] = self.lsi[dictionary.doc2bow(user_model)]
-
-        return dictionary
+        user_documents = self._user_documents(training_data)
+        users = self.data_map[self.get_user_column()].index
+        corpus = [bag_of_words(user_documents[user]) for user in users]
+        self.lsi = models.LsiModel(corpus, id2word=dict(enumerate(self.preprocessor.terms)), num_topics=self._dim)
+        self.user_factors = self._representation([user_documents[user] for user in users])
 
-    def _fit_items(self, dictionary, training_data):
+    def _fit_items(self, training_data):
         """
         Computes LSI for items
-        :param dictionary: Dictionary of all the terms available.
         :param training_data:
         :return:
         """
-        item_models = self._get_item_models(training_data)
-        for item, item_model in item_models.items():
-            self._item_representation[item] = self.lsi[dictionary.doc2bow(item_model)]
+        item_documents = self._item_documents(training_data)
+        items = self.data_map[self.get_item_column()].index
+        self.item_documents = [item_documents[item] for item in items]
+        self.item_factors = self._representation(self.item_documents)
 
-    def fit(self, training_data):
-        dictionary = self._fit_users(training_data)
-        self._fit_items(dictionary, training_data)
+    def _new_items(self, items):
+        """
+        Add the items to the data map
+
+        :return: The indexes of the items
+        :raise ValueError: If an item is already in the model
+        """
+        known = self.encode(self.get_item_column(), items)
+        if (known >= 0).any():
+            raise ValueError("Item {} is already in the model".format(np.asarray(items)[known >= 0][0]))
+        return self.encode(self.get_item_column(), items, extend=True)
+
+    def _user_document(self, items):
+        """
+        Concatenate the term ids of the items of a user. Items that are not in the model are skipped.
+        """
+        indexes = self.encode(self.get_item_column(), items)
+        return np.concatenate([np.zeros(0, dtype=np.int32)] + [self.item_documents[i] for i in indexes if i >= 0])
 
-    def cosine(self, v1, v2):
-        return np.dot(v1, v2) / (sqrt(np.dot(v1, v1)) * sqrt(np.dot(v2, v2)))
+    def _buffer(self, name):
+        """
+        Return the buffer of the matrix in the attribute name. A new buffer is made if the matrix was replaced (by fit
+        or load for instance) since the last append.
+        """
+        matrix = getattr(self, name)
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.rows is not matrix:
+            buffer = self._buffers[name] = (SparseRowBuffer if sp.issparse(matrix) else RowBuffer)(matrix)
+        return buffer
 
-    def get_vector(self, factors):
-        ret = [0] * self._dim
-        for idx, f in factors:
-            ret[idx] = f
-        return ret
+    def _append(self, name, rows):
+        """
+        Append rows to the matrix in the attribute name in amortized constant time per row
+        """
+        setattr(self, name, self._buffer(name).append(rows))
 
+    def add_items(self, items, descriptions):
+        """
+        Project new items into the LSI space of the model without fitting it again. Words that were not in the
+        training set are ignored.
 
-class TFIDFModel(LSIModel):
+        :param items: A list of new items
+        :param descriptions: Their descriptions
+        """
+        documents = self.preprocessor.documents([str(description) for description in descriptions])
+        self._new_items(items)
+        self.item_documents.extend(documents)
+        self._append("item_factors", self._representation(documents))
 
-    idmap = {}
-    k = 6
+    def add_user(self, user, items):
+        """
+        Project a new user, or a user with new items, from the items he consumed without fitting the model again
+
+        :param items: The items of the user. Items that are not in the model are ignored
+        """
+        self._set_user(user, self._representation([self._user_document(items)]))
+
+    def _set_user(self, user, factors):
+        """
+        Add or replace the (1, _dim) factors of a user
+        """
+        index = self.encode(self.get_user_column(), [user], extend=True)[0]
+        if index == len(self.user_factors):
+            self._append("user_factors", factors)
+        else:
+            if not self.user_factors.flags.writeable:
+                self.user_factors = np.array(self.user_factors)
+            self.user_factors[index] = factors[0]
 
     def fit(self, training_data):
+        self.data_map = {}
+        self.new_fit_version()
+        for column in (self.get_user_column(), self.get_item_column()):
+            self.encode(column, training_data[column].values, extend=True)
+        self._fit_users(training_data)
+        self._fit_items(training_data)
+
+    def save(self, directory):
+        """
+        Write the model in a directory. The user and item matrices are numpy files that load can memory map.
+        """
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        np.save(os.path.join(directory, "users.npy"), self.user_factors)
+        np.save(os.path.join(directory, "items.npy"), self.item_factors)
+        self.lsi.save(os.path.join(directory, "lsi"))
+        with open(os.path.join(directory, "model.pkl"), "wb") as state:
+            pickle.dump({
+                "dim": self._dim,
+                "column": self._column_name,
+                "cold_start": self._cold_start,
+                "terms": self.preprocessor.terms,
+                "item_documents": self.item_documents,
+                "users": self.data_map[self.get_user_column()].index.values,
+                "items": self.data_map[self.get_item_column()].index.values
+            }, state, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, directory, mmap_mode="r"):
+        """
+        Read a model written by save
 
-        #lets take dictionary of clean item descriptions
-        item_desc = self._get_item_models(training_data)
+        :param mmap_mode: Memory map mode of the user and item matrices (see numpy.load). None reads them in memory
+        """
+        with open(os.path.join(directory, "model.pkl"), "rb") as state:
+            state = pickle.load(state)
+        model = cls(state["column"], state["dim"], state["cold_start"])
+        model.user_factors = np.load(os.path.join(directory, "users.npy"), mmap_mode=mmap_mode)
+        model.item_factors = np.load(os.path.join(directory, "items.npy"), mmap_mode=mmap_mode)
+        model.lsi = models.LsiModel.load(os.path.join(directory, "lsi"))
+        model.item_documents = state["item_documents"]
+        for term in state["terms"]:
+            model.preprocessor.term_id(term)
+        for column, values in ((model.get_user_column(), state["users"]), (model.get_item_column(), state["items"])):
+            model.data_map[column] = pd.Series(np.arange(len(values)), index=values)
+        return model
+
+
+class TFIDFModel(Item2Item, LSIModel):
+    """
+    Item based neighbourhood model where the similarity of two items is the cosine of the TF-IDF vectors of their
+    descriptions. The vectors are the L2 normalized rows of a sparse item x term matrix, with the term frequency times
+    log2(items / items with the term), and only the n_neighbours most similar items of each item are kept.
+    """
 
+    k = 6
+    similarity_name = "dot"
+    idf = tfidf = None
 
-        #create a map from external item id, to the index in list of values
-        idmap = {
-            idx: data[0] for idx, data in enumerate(item_desc.items())
-        }
+    def __init__(self, description_column_name, k=6, n_neighbours=100, block_size=1024, n_jobs=1, memory_budget=None):
+        """
+        :param description_column_name: str the name for the description column used for train the model
+        :param k: How many closest items in the user profile to consider
+        :param n_neighbours: Number of neighbours kept for each item
+        """
+        LSIModel.__init__(self, description_column_name, n_jobs=n_jobs)
+        Item2Item.__init__(self, k, "dot", n_neighbours, block_size, n_jobs, memory_budget)
+        self._descriptions = {}
 
-        #store user data for further use
-        self._users = {
-            user: set(entries)
-            for user, entries in training_data.groupby("user")["item"]
-        }
+    def fit(self, training_data):
+        self._descriptions = self._item_documents(training_data)
+        Item2Item.fit(self, training_data)
+
+    def train(self, training_data):
+        items = self.data_map[self.get_item_column()].index
+        self._dim = len(self.preprocessor.terms)
+        self.item_documents = [self._descriptions[item] for item in items]
+        counts = term_counts(self.item_documents, self._dim)
+        self.idf = np.log2(float(len(items)) / np.maximum(np.bincount(counts.indices, minlength=self._dim), 1))
+        self.tfidf = self._vectors(self.item_documents)
+        self._descriptions = {}
+        Item2Item.train(self, training_data)
+
+    def _vectors(self, documents):
+        """
+        Return the L2 normalized TF-IDF rows of documents of term ids. Terms that were not in the training set are
+        ignored.
+        """
+        weights = term_counts([document[document < len(self.idf)] for document in documents], len(self.idf))
+        weights = weights.dot(sp.diags(self.idf, 0))
+        weights.eliminate_zeros()
+        return normalize_rows(weights)
 
-        #create a tf-idf index
-        dictionary = corpora.Dictionary(item_desc.values())
-        self._dim = len(dictionary)
-        _item_desc_corpus = map(dictionary.doc2bow, item_desc.values())  # <--- HERE
-        tfidf_model = models.TfidfModel(_item_desc_corpus)
-        tfidf_corpus = tfidf_model[_item_desc_corpus]
+    def add_items(self, items, descriptions):
+        """
+        Add new items without fitting the model again. The TF-IDF vectors of the items are computed with the idf of
+        the training set, their neighbours are found with one sparse product and the new items are merged into the
+        neighbours of the old items in place.
 
-        self.tfidf = {
-            idmap[idx]: np.array(self.get_vector(tfidf)) for idx, tfidf in enumerate(tfidf_corpus)
-        }
+        :param items: A list of new items
+        :param descriptions: Their descriptions
+        """
+        documents = self.preprocessor.documents([str(description) for description in descriptions])
+        vectors = self._vectors(documents)
+        old, new = self.tfidf.shape[0], self._new_items(items)
+        self.item_documents.extend(documents)
+        self._append("tfidf", vectors)
+        self.matrix = self._buffer("matrix").resize(self.tfidf.shape[0])
+        similarities = vectors.dot(self.tfidf.transpose()).toarray()
+        similarities[np.arange(len(new)), new] = 0.
+        n_neighbours = self.neighbours.shape[1]
+        rows = np.arange(len(new))[:, np.newaxis]
+        best = top_k(similarities, n_neighbours) if n_neighbours > 0 else np.zeros((len(new), 0), dtype=int)
+        self._append("similarities", similarities[rows, best])
+        self._append("neighbours", np.where(similarities[rows, best] > 0., best, -1))
+        if n_neighbours > 0:
+            # Old items whose worst neighbour is less similar than a new item are updated in place
+            neighbours, values = self.neighbours, self.similarities
+            changed = np.flatnonzero((similarities[:, :old].T > values[:old, -1:]).any(axis=1))
+            candidates = np.hstack((neighbours[changed], np.repeat(new[np.newaxis, :], len(changed), axis=0)))
+            candidate_values = np.hstack((values[changed], similarities[:, changed].T))
+            best = top_k(candidate_values, n_neighbours)
+            rows = np.arange(len(changed))[:, np.newaxis]
+            values[changed] = candidate_values[rows, best]
+            neighbours[changed] = np.where(values[changed] > 0., candidates[rows, best], -1)
+        # The neighbour scores are built again when they are needed
+        self.scores = None
+
+    def add_user(self, user, items):
+        """
+        Add a new user, or replace the items of a user, without fitting the model again
+
+        :param items: The items of the user. Items that are not in the model are ignored
+        """
+        indexes = self.encode(self.get_item_column(), items)
+        indexes = indexes[indexes >= 0]
+        row = interaction_matrix(np.zeros(len(indexes)), indexes, 1, self.matrix.shape[1])
+        index = self.encode(self.get_user_column(), [user], extend=True)[0]
+        buffer = self._buffer("matrix")
+        self.matrix = buffer.append(row) if index == self.matrix.shape[0] else buffer.replace(index, row)
+
+    def user_items(self, user):
+        """
+        Return the items (internal index) of a user (internal index), including the users replaced by add_user that
+        are not merged in the matrix yet
+        """
+        buffer = self._buffers.get("matrix")
+        if buffer is not None and buffer.rows is self.matrix:
+            return buffer.row_indices(user)
+        return Item2Item.user_items(self, user)
+
+    def item_vectors(self):
+        return self.tfidf
+
+    def similarity(self, i1, i2):
+        """
+        Cosine of the TF-IDF vectors of 2 items
+        """
+        item_map = self.data_map[self.get_item_column()]
+        return float(self.tfidf[item_map[i1]].dot(self.tfidf[item_map[i2]].transpose())[0, 0])
 
     def _sim(self, i1, i2):
-        sim = self.cosine(self.tfidf[i1], self.tfidf[i2])
-        return sim
+        return self.similarity(i1, i2)
 
-    def get_score(self, user, item):
-        scores = [self._sim(i, item) for i in self._users[user] if i != item]
-        scores.sort(reverse=True)
-        return sum(scores[:self.k])
-        # return sum(scores[:self._dim])
+    def get_name(self):
+        return "TF/IDF"
+
+
+class HashingModel(LSIModel):
+    """
+    Content model for vocabularies too big for LSI. The words of the descriptions are hashed into n_features columns
+    and the hashed counts are projected to dim dimensions with a sparse random projection. There is no vocabulary and
+    no SVD: the items are projected in chunks of chunk_size in a single pass, and as the projection is linear a user is
+    the sum of the projections of the descriptions of his rows.
+    """
+
+    def __init__(self, description_column_name, dim=50, n_features=2**18, n_nonzero=None, chunk_size=1000, seed=0,
+                 cold_start_strategy="return0"):
+        """
+        :param description_column_name: str the name for the description column used for train the model
+        :param dim: Dimension of the projection
+        :param n_features: Number of hashed columns
+        :param n_nonzero: Number of dimensions of the projection of each hashed column. Default is dim/8
+        :param chunk_size: Number of descriptions in memory at a time
+        :param seed: Seed of the projection
+        """
+        super(HashingModel, self).__init__(description_column_name, dim, cold_start_strategy)
+        self.n_features = n_features
+        self.n_nonzero = n_nonzero
+        self.chunk_size = chunk_size
+        self.seed = seed
+        self.projection = sparse_random_projection(n_features, dim, n_nonzero, seed)
+        # Norm of the projection of each item description
+        self.item_norms = None
 
     def get_name(self):
-        return "TF/IDF"
\ No newline at end of file
+        return "Hashing: dim={},features={}".format(self._dim, self.n_features)
+
+    def _project(self, descriptions):
+        """
+        Return the projections of the descriptions, not normalized
+        """
+        projections = np.empty((len(descriptions), self._dim), dtype=np.float32)
+        for start in xrange(0, len(descriptions), self.chunk_size):
+            chunk = [self._clean_text(str(description)) for description in descriptions[start:start+self.chunk_size]]
+            projections[start:start+len(chunk)] = hash_words(chunk, self.n_features).dot(self.projection).toarray()
+        return projections
+
+    def _norms(self, projections):
+        return np.sqrt((projections ** 2).sum(axis=1))
+
+    def fit(self, training_data):
+        self.data_map = {}
+        self.new_fit_version()
+        users = self.encode(self.get_user_column(), training_data[self.get_user_column()].values, extend=True)
+        items = self.encode(self.get_item_column(), training_data[self.get_item_column()].values, extend=True)
+        rows = training_data.drop_duplicates(self.get_item_column())
+        projections = np.empty((self.items_size(), self._dim), dtype=np.float32)
+        projections[self.encode(self.get_item_column(), rows[self.get_item_column()].values)] = \
+            self._project(rows[self._column_name].values)
+        self.item_norms = self._norms(projections)
+        self.item_factors = unit_rows(projections)
+        counts = sp.csr_matrix((np.ones(len(users), dtype=np.float32), (users, items)),
+                               shape=(self.users_size(), self.items_size()))
+        self.user_factors = unit_rows(counts.dot(projections))
+
+    def add_items(self, items, descriptions):
+        """
+        Project new items without fitting the model again
+
+        :param items: A list of new items
+        :param descriptions: Their descriptions
+        """
+        projections = self._project(list(descriptions))
+        self._new_items(items)
+        self._append("item_norms", self._norms(projections))
+        self._append("item_factors", unit_rows(projections))
+
+    def add_user(self, user, items):
+        """
+        Project a new user, or a user with new items, from the items he consumed without fitting the model again
+
+        :param items: The items of the user. Items that are not in the model are ignored
+        """
+        indexes = self.encode(self.get_item_column(), items)
+        indexes = indexes[indexes >= 0]
+        projection = (self.item_factors[indexes] * self.item_norms[indexes, np.newaxis]).sum(axis=0)
+        self._set_user(user, unit_rows(projection[np.newaxis, :]))
+
+    def save(self, directory):
+        """
+        Write the model in a directory. The user and item matrices are numpy files that load can memory map.
+        """
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        np.save(os.path.join(directory, "users.npy"), self.user_factors)
+        np.save(os.path.join(directory, "items.npy"), self.item_factors)
+        np.save(os.path.join(directory, "norms.npy"), self.item_norms)
+        with open(os.path.join(directory, "model.pkl"), "wb") as state:
+            pickle.dump({
+                "parameters": (self._column_name, self._dim, self.n_features, self.n_nonzero, self.chunk_size,
+                               self.seed, self._cold_start),
+                "users": self.data_map[self.get_user_column()].index.values,
+                "items": self.data_map[self.get_item_column()].index.values
+            }, state, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, directory, mmap_mode="r"):
+        """
+        Read a model written by save
+
+        :param mmap_mode: Memory map mode of the user and item matrices (see numpy.load). None reads them in memory
+        """
+        with open(os.path.join(directory, "model.pkl"), "rb") as state:
+            state = pickle.load(state)
+        model = cls(*state["parameters"])
+        model.user_factors = np.load(os.path.join(directory, "users.npy"), mmap_mode=mmap_mode)
+        model.item_factors = np.load(os.path.join(directory, "items.npy"), mmap_mode=mmap_mode)
+        model.item_norms = np.load(os.path.join(directory, "norms.npy"))
+        for column, values in ((model.get_user_column(), state["users"]), (model.get_item_column(), state["items"])):
+            model.data_map[column] = pd.Series(np.arange(len(values)), index=values)
+        return model
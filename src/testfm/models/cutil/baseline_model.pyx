@@ -1,6 +1,8 @@
 cimport cython
 from libc.stdlib cimport rand, RAND_MAX
 from testfm.models.cutil.interface cimport NOGILModel
+import numpy as np
+cimport numpy as np
 
 cdef class NOGILRandomModel(NOGILModel):
     """
@@ -12,4 +14,96 @@ cdef class NOGILRandomModel(NOGILModel):
         return rand() / <float>RAND_MAX
 
     def get_name(self):
-        return "Random"
\ No newline at end of file
+        return "Random"
+
+cdef class NOGILItemScoreModel(NOGILModel):
+    """
+    Model with a score for each item, the same for every user. The scores are a float32 numpy array indexed by the item
+    index of the data map. Items out of the array score 0.
+    """
+
+    cdef float *c_scores
+    cdef int c_size
+    cdef object scores
+
+    def __cinit__(self, *args, **kwargs):
+        self.c_scores = NULL
+        self.c_size = 0
+
+    def set_scores(self, scores):
+        """
+        Set the score of each item
+        """
+        cdef np.ndarray[float, ndim=1, mode="c"] array = np.ascontiguousarray(scores, dtype=np.float32)
+        self.scores = array
+        self.c_size = len(array)
+        self.c_scores = &array[0] if self.c_size > 0 else NULL
+
+    def get_scores_array(self):
+        """
+        Return the score of each item
+        """
+        return self.scores
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef float nogil_get_score(NOGILItemScoreModel self, int user, int item, int extra_context, int *context) nogil:
+        if 0 <= item < self.c_size:
+            return self.c_scores[item]
+        return 0.
+
+
+cdef class NOGILUserItemScoreModel(NOGILModel):
+    """
+    Model with a score for some (user, item) pairs, kept in compressed sparse rows: the items of the user u are
+    indices[indptr[u]:indptr[u+1]], sorted, with their scores in the same positions of values. Other pairs score 0.
+    """
+
+    cdef int *c_indptr
+    cdef int *c_indices
+    cdef float *c_values
+    cdef int c_users
+    cdef object arrays
+
+    def __cinit__(self, *args, **kwargs):
+        self.c_indptr = self.c_indices = NULL
+        self.c_values = NULL
+        self.c_users = 0
+
+    def set_scores(self, indptr, indices, values):
+        """
+        Set the scores of the (user, item) pairs in compressed sparse rows
+        """
+        cdef np.ndarray[int, ndim=1, mode="c"] c_indptr = np.ascontiguousarray(indptr, dtype=np.int32)
+        cdef np.ndarray[int, ndim=1, mode="c"] c_indices = np.ascontiguousarray(indices, dtype=np.int32)
+        cdef np.ndarray[float, ndim=1, mode="c"] c_values = np.ascontiguousarray(values, dtype=np.float32)
+        self.arrays = c_indptr, c_indices, c_values
+        self.c_users = len(c_indptr) - 1
+        self.c_indptr = &c_indptr[0]
+        self.c_indices = &c_indices[0] if len(c_indices) > 0 else NULL
+        self.c_values = &c_values[0] if len(c_values) > 0 else NULL
+
+    def get_scores_arrays(self):
+        """
+        Return the indptr, indices and values arrays
+        """
+        return self.arrays
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    cdef float nogil_get_score(NOGILUserItemScoreModel self, int user, int item, int extra_context,
+                               int *context) nogil:
+        cdef int low, high, middle
+        if user < 0 or user >= self.c_users:
+            return 0.
+        low, high = self.c_indptr[user], self.c_indptr[user+1]
+        while low < high:
+            middle = (low + high) / 2
+            if self.c_indices[middle] < item:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.c_indptr[user+1] and self.c_indices[low] == item:
+            return self.c_values[low]
+        return 0.
@@ -0,0 +1,220 @@
+"""
+Native Bayesian Personalized Ranking. The factors are trained with lock free (Hogwild) parallel stochastic gradient
+descent: every thread samples its own (user, positive item, negative item) triplets and updates the shared factor
+matrices without locks.
+"""
+cimport cython
+from cython.parallel cimport prange, threadid
+from testfm.models.cutil.interface cimport IFactorModel
+import multiprocessing
+import numpy as np
+cimport numpy as np
+from testfm.models.sampling import UniformSampler
+
+cdef extern from "math.h":
+    double exp(double x) nogil
+
+# Each thread random state is in its own cache line
+DEF STATE_STRIDE = 8
+
+
+cdef inline unsigned long long xorshift(unsigned long long *state) nogil:
+    """
+    Next number of a xorshift64 random generator
+    """
+    cdef unsigned long long x = state[0]
+    x ^= x << 13
+    x ^= x >> 7
+    x ^= x << 17
+    state[0] = x
+    return x
+
+
+cdef inline float random_unit(unsigned long long *state) nogil:
+    """
+    Random number in [0, 1)
+    """
+    return (xorshift(state) >> 11) * (1. / 9007199254740992.)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef inline bint is_positive(int *indptr, int *indices, int user, int item) nogil:
+    """
+    Binary search of the item in the sorted items of the user
+    """
+    cdef int low = indptr[user], high = indptr[user+1], middle
+    while low < high:
+        middle = (low + high) / 2
+        if indices[middle] < item:
+            low = middle + 1
+        else:
+            high = middle
+    return low < indptr[user+1] and indices[low] == item
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef inline int draw_negative(unsigned long long *state, int user, int n_items, int *indptr, int *indices,
+                              float *probability, int *alias, int max_tries) nogil:
+    """
+    Draw a negative item for the user, uniformly or with the alias table. Items of the user are drawn again up to
+    max_tries times.
+    :return: The item or -1 if only items of the user were drawn
+    """
+    cdef int tries, item
+    for tries in range(max_tries):
+        item = <int>(xorshift(state) % n_items)
+        if probability is not NULL and random_unit(state) >= probability[item]:
+            item = alias[item]
+        if indptr is NULL or not is_positive(indptr, indices, user, item):
+            return item
+    return -1
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void bpr_epoch(int *users, int *items, int n_rows, float *user_factors, float *item_factors, int n_items,
+                    int n_factors, float eta, float reg, unsigned long long *states, int n_threads, int *indptr,
+                    int *indices, float *probability, int *alias, int max_tries, int n_candidates) nogil:
+    """
+    Do n_rows stochastic gradient steps. Each step samples a row of the data for the user and the positive item and
+    draws the negative item. With more than one candidate the negative item is the candidate with the highest score.
+    :param user_factors: A C contiguous (users, n_factors) matrix
+    :param item_factors: A C contiguous (items, n_factors) matrix
+    :param states: The random state of each thread, STATE_STRIDE apart
+    :param indptr: NULL or the compressed rows of the items of each user, which are not drawn as negative items
+    :param probability: NULL for uniform negative items or the alias table of the item distribution
+    """
+    cdef int step, row, user, positive, negative, candidate, c, f, thread
+    cdef float x, gradient, u, p, n, best, score
+    for step in prange(n_rows, num_threads=n_threads, schedule="static"):
+        thread = threadid()
+        row = <int>(xorshift(&states[thread*STATE_STRIDE]) % n_rows)
+        user, positive = users[row], items[row]
+        negative, best = -1, 0.
+        for c in range(n_candidates):
+            candidate = draw_negative(&states[thread*STATE_STRIDE], user, n_items, indptr, indices, probability, alias,
+                                      max_tries)
+            if candidate < 0 or candidate == positive:
+                continue
+            if n_candidates > 1:
+                score = 0.
+                for f in range(n_factors):
+                    score = score + user_factors[user*n_factors+f] * item_factors[candidate*n_factors+f]
+                if negative >= 0 and score <= best:
+                    continue
+                best = score
+            negative = candidate
+        if negative < 0:
+            continue
+        x = 0.
+        for f in range(n_factors):
+            x = x + user_factors[user*n_factors+f] * \
+                (item_factors[positive*n_factors+f] - item_factors[negative*n_factors+f])
+        gradient = 1. / (1. + exp(x))
+        for f in range(n_factors):
+            u = user_factors[user*n_factors+f]
+            p = item_factors[positive*n_factors+f]
+            n = item_factors[negative*n_factors+f]
+            user_factors[user*n_factors+f] = u + eta * (gradient * (p - n) - reg * u)
+            item_factors[positive*n_factors+f] = p + eta * (gradient * u - reg * p)
+            item_factors[negative*n_factors+f] = n + eta * (-gradient * u - reg * n)
+
+
+cdef void set_number_of_factors(IFactorModel model, int n_factors):
+    model.c_number_of_factors = n_factors
+
+
+class CBPR(IFactorModel):
+    """
+    Bayesian Personalized Ranking with the factors in contiguous matrices indexed by the data map. The training runs
+    without the GIL in parallel and the model is scored by the native evaluator.
+    """
+
+    def __init__(self, eta=0.03, reg=0.0001, dim=20, n_iter=30, n_jobs=None, sampler=None):
+        """
+        Constructor
+
+        :param eta: Learning rate
+        :param reg: Regularization
+        :param dim: Number of factors
+        :param n_iter: Number of epochs. Each epoch samples as many triplets as rows in the data
+        :param n_jobs: Number of threads. Default is the number of cores
+        :param sampler: A sampler from testfm.models.sampling for the negative items. Default is uniform excluding the
+            items of the user
+        """
+        self.set_params(eta, reg, dim, n_iter)
+        self.n_jobs = n_jobs or multiprocessing.cpu_count()
+        self.sampler = sampler or UniformSampler()
+        self.factors = []
+
+    def set_params(self, eta=0.03, reg=0.0001, dim=20, n_iter=25):
+        """
+        Set the parameters for the BPR model
+        """
+        self._dim = int(dim)
+        self._n_iter = int(n_iter)
+        self._reg = float(reg)
+        self._eta = float(eta)
+        set_number_of_factors(self, self._dim)
+
+    @classmethod
+    def param_details(cls):
+        """
+        Return parameter details for dim, nIter, reg, eta
+        """
+        return {
+            "dim": (10, 40, 4, 20),
+            "n_iter": (10, 35, 3, 15),
+            "reg": (0.0001, 0.01, .001, .0001),
+            "eta": (0.01, 0.08, 0.005, 0.03)
+        }
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def train(self, data):
+        """
+        Train the model
+        """
+        cdef int epoch
+        cdef np.ndarray[int, ndim=1, mode="c"] users = np.ascontiguousarray(data[:, 0], dtype=np.int32)
+        cdef np.ndarray[int, ndim=1, mode="c"] items = np.ascontiguousarray(data[:, 1], dtype=np.int32)
+        cdef np.ndarray[float, ndim=2, mode="c"] user_factors = \
+            np.random.normal(0, 2.5/self._dim, (self.users_size(), self._dim)).astype(np.float32)
+        cdef np.ndarray[float, ndim=2, mode="c"] item_factors = \
+            np.random.normal(0, 2.5/self._dim, (self.items_size(), self._dim)).astype(np.float32)
+        cdef np.ndarray[unsigned long long, ndim=1, mode="c"] states = \
+            np.random.randint(1, 2**62, self.n_jobs * STATE_STRIDE).astype(np.uint64)
+        cdef int n_rows = len(users), n_items = len(item_factors), n_factors = self._dim, n_threads = self.n_jobs
+        cdef int max_tries = self.sampler.max_tries, n_candidates = self.sampler.n_candidates
+        cdef float eta = self._eta, reg = self._reg
+        cdef np.ndarray[int, ndim=1, mode="c"] indptr = None, indices = None, alias = None
+        cdef np.ndarray[float, ndim=1, mode="c"] probability = None
+        cdef int *c_indptr = NULL
+        cdef int *c_indices = NULL
+        cdef int *c_alias = NULL
+        cdef float *c_probability = NULL
+        self.sampler.fit(users, items, len(user_factors), n_items)
+        if self.sampler.index is not None and len(self.sampler.index.indices) > 0:
+            indptr, indices = self.sampler.index.indptr, self.sampler.index.indices
+            c_indptr, c_indices = &indptr[0], &indices[0]
+        if self.sampler.probability is not None:
+            probability, alias = self.sampler.probability, self.sampler.alias
+            c_probability, c_alias = &probability[0], &alias[0]
+        set_number_of_factors(self, self._dim)
+        for epoch in range(self._n_iter):
+            with nogil:
+                bpr_epoch(&users[0], &items[0], n_rows, &user_factors[0, 0], &item_factors[0, 0], n_items, n_factors,
+                          eta, reg, &states[0], n_threads, c_indptr, c_indices, c_probability, c_alias, max_tries,
+                          n_candidates)
+        self.factors = [user_factors, item_factors]
+
+    def get_model(self):
+        return self.factors
+
+    def get_name(self):
+        return "CBPR (dim={},iter={},reg={},eta={})".format(self._dim, self._n_iter, self._reg, self._eta)
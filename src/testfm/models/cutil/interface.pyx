@@ -5,16 +5,34 @@ cimport cython
 from libc.stdlib cimport malloc, free
 import numpy as np
 cimport numpy as np
-from testfm.models.cutil.float_matrix cimport float_matrix, _float_matrix, fm_get, fm_set, fm_destroy
+from testfm.models.cutil.float_matrix cimport float_matrix, _float_matrix, fm_get, fm_destroy
 import pandas as pd
 
 
+def top_k(scores, k):
+    """
+    Return the indexes of the k highest scores in the last axis, sorted from the highest to the lowest score. Only the k
+    best are sorted so it is cheaper than a full argsort.
+
+    :param scores: A numpy array with one or two dimensions
+    :param k: Number of indexes to return
+    """
+    scores = np.asarray(scores)
+    matrix = np.atleast_2d(scores)
+    k = min(k, matrix.shape[1])
+    rows = np.arange(matrix.shape[0])[:, np.newaxis]
+    best = np.argpartition(-matrix, k-1, axis=1)[:, :k]
+    best = best[rows, np.argsort(-matrix[rows, best], axis=1)]
+    return best[0] if scores.ndim == 1 else best
+
+
 cdef class IModel:
     """
     Interface class for model
     """
 
     data_map = {}
+    fit_version = 0
     def __init__(self):
         self.data_map = {}
 
@@ -97,12 +115,37 @@ cdef class IModel:
         columns = [self.get_user_column(), self.get_item_column()] + self.get_context_columns()
         data = []
         self.data_map = {}
+        self.new_fit_version()
         for column in columns:
-            unique_data = training_data[column].unique()
-            self.data_map[column] = pd.Series(xrange(len(unique_data)), unique_data)
-            data.append(map(lambda x: self.data_map[column][x], training_data[column].values))
-        data.append(training_data.get(self.get_rating_column(), np.ones((len(training_data),)).tolist()))
-        self.train(np.array(data).transpose())
+            data.append(self.encode(column, training_data[column].values, extend=True))
+        data.append(training_data.get(self.get_rating_column(), np.ones((len(training_data),))))
+        self.train(np.column_stack(data))
+
+    def new_fit_version(self):
+        """
+        Count one more fit of the model. The score caches keep the version so the scores of a refitted model are not
+        taken from the cache.
+        """
+        self.fit_version += 1
+
+    def encode(self, column, values, extend=False):
+        """
+        Map the values of a column to their internal index.
+
+        :param column: The column name
+        :param values: A sequence of values
+        :param extend: If True, values that are not in the data map are added to it with the next free indexes.
+            Otherwise they are mapped to -1.
+        :return: A numpy array with the indexes
+        """
+        column_map = self.data_map.get(column, pd.Series([], dtype=np.int64))
+        indexes = pd.Index(column_map.index).get_indexer(values)
+        if extend and (indexes < 0).any():
+            new_values = pd.unique(np.asarray(values)[indexes < 0])
+            self.data_map[column] = column_map.append(
+                pd.Series(np.arange(len(column_map), len(column_map)+len(new_values)), new_values))
+            indexes = pd.Index(self.data_map[column].index).get_indexer(values)
+        return indexes
 
     @cython.boundscheck(False)
     @cython.wraparound(False)
@@ -126,6 +169,12 @@ cdef class IModel:
         """
         raise NotImplemented
 
+    def get_scores(self, user, items, **context):
+        """
+        Return the scores of many items for the user as a numpy array. Models that can score items in batch override it
+        """
+        return np.array([self.get_score(user, item, **context) for item in items], dtype=np.float64)
+
     def number_of_context(self):
         """
         Return the number of factors
@@ -161,6 +210,28 @@ cdef class NOGILModel(IModel):
         cdef float result = 0.
         return result
 
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def get_scores(self, user, items, **context):
+        """
+        Return the scores of many items for the user. The items are scored with nogil_get_score without the GIL, so
+        other threads can run meanwhile. Unknown items get 0. Unknown users, contexts and models without a user map
+        (not fitted) are scored with get_score.
+        """
+        cdef int i, c_user, n_items = len(items)
+        user_map = self.data_map.get(self.get_user_column())
+        if context or user_map is None or user not in user_map:
+            return super(NOGILModel, self).get_scores(user, items, **context)
+        c_user = user_map[user]
+        cdef np.ndarray[int, ndim=1, mode="c"] c_items = \
+            np.ascontiguousarray(self.encode(self.get_item_column(), items), dtype=np.int32)
+        cdef np.ndarray[float, ndim=1, mode="c"] scores = np.zeros(n_items, dtype=np.float32)
+        with nogil:
+            for i in range(n_items):
+                if c_items[i] >= 0:
+                    scores[i] = self.nogil_get_score(c_user, c_items[i], 0, NULL)
+        return scores
+
 
 cdef class IFactorModel(NOGILModel):
     """
@@ -196,10 +267,17 @@ cdef class IFactorModel(NOGILModel):
         """
         self.dealloc_factors()
         super(IFactorModel, self).fit(training_data)
+        self.reload_factors()
+
+
+    def reload_factors(self):
+        """
+        Point the native factors to the factor matrices again. It must be called when a factor matrix is replaced.
+        """
+        self.dealloc_factors()
         self.c_number_of_contexts = 2+len(self.get_context_columns())
         self.c_factors = self.get_factors()
 
-
     @cython.boundscheck(False)
     @cython.wraparound(False)
     cdef float_matrix *get_factors(self):
@@ -287,46 +365,145 @@ cdef class IFactorModel(NOGILModel):
             if c_context is not NULL:
                 free(c_context)
 
+    def get_not_mapped_context(self, **context):
+        """
+        Map the context values to the row they have in the context factor matrices. Unknown values are mapped to -1 and
+        are ignored when scoring. Each context can be a single value or a sequence of values.
+        """
+        mapped = {}
+        for column in self.get_context_columns():
+            if column in context:
+                values = context[column]
+                if np.isscalar(values):
+                    mapped[column] = self.data_map[column].get(values, -1)
+                else:
+                    mapped[column] = self.data_map[column].reindex(values).fillna(-1).values.astype(np.int32)
+        return mapped
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def fold_context(self, users, **context):
+        """
+        Fold the user rows with the factor rows of every context given, element-wise. The result can be multiplied by
+        the item matrix to get the scores of all the items at once.
+
+        :param users: A sequence of users in their internal (mapped) index
+        :param context: For each context column, a sequence of mapped context values aligned with users. Values out of
+            the context matrix (like -1) leave the user row as it is.
+        :return: A numpy array with shape (len(users), number of factors)
+        """
+        folded = self.factors[0][np.asarray(users, dtype=np.int32)]
+        for i, column in enumerate(self.get_context_columns(), start=2):
+            if column in context:
+                rows = np.asarray(context[column], dtype=np.int32)
+                valid = (rows >= 0) & (rows < self.factors[i].shape[0])
+                folded[valid] *= self.factors[i][rows[valid]]
+        return folded
+
     @cython.boundscheck(False)
     @cython.wraparound(False)
     @cython.overflowcheck(False)
     @cython.cdivision(False)
     def get_not_mapped_recommendation(self, user, **context):
         """
-        Return the recommendation as a numpy array
-        """
-        #cdef int c_user = user
-        #cdef float_matrix rec = <float_matrix>malloc(sizeof(_float_matrix)), users, items
-        #np_rec = np.zeros((len(self.data_map[self.get_item_column()]),), dtype=np.float32)
-
-        #rec.rows = 1
-        #rec.columns = len(self.data_map[self.get_item_column()])
-        #rec.values = <float *>(<np.ndarray[float, ndim=2, mode="c"]>np_rec).data
-        #if self.c_factors == NULL:
-        #    self.c_number_of_factors = self.dimensions
-        #    self.c_number_of_contexts = 2+len(self.get_context_columns())
-        #    self.c_factors = self.get_factors()
-        #users, items = self.c_factors[0], self.c_factors[1]
-        #fm_static_multiply_row(users, c_user, items, rec)
-        #return np_rec
-        users, items = self.factors
-        return np.squeeze(np.asarray(np.dot(users[user], items.transpose())))
+        Return the recommendation as a numpy array. User and contexts must be in their internal (mapped) index.
+        """
+        users, items = self.factors[0], self.factors[1]
+        user_vector = users[user]
+        for i, column in enumerate(self.get_context_columns(), start=2):
+            if column in context and 0 <= context[column] < self.factors[i].shape[0]:
+                user_vector = user_vector * self.factors[i][context[column]]
+        return np.squeeze(np.asarray(np.dot(user_vector, items.transpose())))
 
     @cython.boundscheck(False)
     @cython.wraparound(False)
     @cython.overflowcheck(False)
     @cython.cdivision(False)
-    def get_recommendation(self, user, **context):
-        return self.get_not_mapped_recommendation(self.data_map[self.get_user_column()][user], **context)
-
+    def get_not_mapped_recommendations(self, users, **context):
+        """
+        Return the recommendation for many (user, context) requests as a numpy array with shape
+        (len(users), number of items). Users and contexts must be in their internal (mapped) index.
+        """
+        return np.dot(self.fold_context(users, **context), self.factors[1].transpose())
 
     @cython.boundscheck(False)
     @cython.wraparound(False)
-    def update_user_factors(self, int user, list factors):
-        cdef int i
-        cdef float f
-        for i, f in enumerate(factors):
-            fm_set(self.c_factors[0], user, i, f)
+    @cython.overflowcheck(False)
+    @cython.cdivision(False)
+    def get_recommendation(self, user, **context):
+        return self.get_not_mapped_recommendation(self.data_map[self.get_user_column()][user],
+                                                  **self.get_not_mapped_context(**context))
+
+    def get_recommendations(self, users, **context):
+        """
+        Return the recommendation for many (user, context) requests. Each context is a sequence aligned with users.
+        """
+        mapped_users = self.data_map[self.get_user_column()][users].values
+        return self.get_not_mapped_recommendations(mapped_users, **self.get_not_mapped_context(**context))
+
+    def get_top_recommendation(self, user, k=10, **context):
+        """
+        Return the k best items for the user in the context and their scores, from best to worst
+        """
+        scores = self.get_recommendation(user, **context)
+        best = top_k(scores, k)
+        return self.data_map[self.get_item_column()].index.values[best], scores[best]
+
+    def get_top_recommendations(self, users, k=10, **context):
+        """
+        Return the k best items for each (user, context) request and their scores. Both are numpy arrays with shape
+        (len(users), k), from best to worst
+        """
+        scores = self.get_recommendations(users, **context)
+        best = top_k(scores, k)
+        return self.data_map[self.get_item_column()].index.values[best], \
+            scores[np.arange(scores.shape[0])[:, np.newaxis], best]
+
+
+    def update_user_factors(self, users, factors):
+        """
+        Overwrite the factors of one or many users (internal index). The native factors share the memory of
+        self.factors so both are updated.
+
+        :param users: A user or a sequence of users
+        :param factors: A factor vector for a single user or a matrix with a row for each user
+        """
+        self.factors[0][users] = np.asarray(factors, dtype=np.float32)
+
+    def add_users(self, users, factors):
+        """
+        Put users and their factors in the model. Users that are not in the model are added to the user map and to the
+        end of the user matrix. The others are updated.
+
+        :param users: A sequence of users (original ids). If a user is repeated the last row of factors is kept
+        :param factors: A matrix with a row for each user
+        """
+        user_map = self.data_map.get(self.get_user_column(), pd.Series([], dtype=np.int64))
+        users = pd.Index(users)
+        new_users = pd.unique(users[~users.isin(user_map.index)])
+        if len(new_users) > 0:
+            self.data_map[self.get_user_column()] = \
+                user_map.append(pd.Series(np.arange(len(user_map), len(user_map)+len(new_users)), new_users))
+            self.factors[0] = self._user_rows(self.factors[0].shape[0] + len(new_users))
+            self.reload_factors()
+        self.update_user_factors(self.data_map[self.get_user_column()][users].values, factors)
+
+    def _user_rows(self, rows):
+        """
+        Return the user matrix with more rows. The new rows are zeros. The matrix is a view of a buffer that doubles its
+        capacity when it is full, so adding users one at a time does not copy the whole matrix each time.
+
+        :param rows: The number of rows of the new matrix
+        """
+        users = self.factors[0]
+        buffer = getattr(self, "_user_buffer", None)
+        if buffer is None or users.base is not buffer or rows > buffer.shape[0]:
+            buffer = np.zeros((max(rows, 2*users.shape[0]), users.shape[1]), dtype=np.float32)
+            buffer[:users.shape[0]] = users
+            self._user_buffer = buffer
+        else:
+            buffer[users.shape[0]:rows] = 0.
+        return buffer[:rows]
 
     def set_params(self, n_factors, *args, **kwargs):
         """
@@ -0,0 +1,245 @@
+"""
+Native biased matrix factorization and SVD++. The model is trained in process with lock free (Hogwild) parallel
+stochastic gradient descent: every thread takes the ratings of a user at a time and updates the shared biases and
+factors without locks. The implicit feedback of SVD++ are the items rated by the user.
+"""
+cimport cython
+from cython.parallel cimport prange, threadid
+from testfm.models.cutil.interface cimport NOGILModel
+import multiprocessing
+import numpy as np
+cimport numpy as np
+from scipy import sparse
+
+cdef extern from "math.h":
+    double sqrt(double x) nogil
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void svdpp_epoch(int *order, int n_users, int *indptr, int *indices, float *ratings, float global_mean,
+                      float *user_bias, float *item_bias, float *user_factors, float *item_factors,
+                      float *implicit_factors, int n_factors, float gamma, float reg, float min_value,
+                      float max_value, float *buffers, int n_threads) nogil:
+    """
+    Do a stochastic gradient step for each rating, user by user in the given order. The implicit term of the user is
+    computed before its ratings and the gradient of the implicit factors is applied after them.
+    :param indptr: The ratings of user u are in the positions indptr[u]:indptr[u+1] of indices and ratings
+    :param user_factors: A C contiguous (users, n_factors) matrix
+    :param item_factors: A C contiguous (items, n_factors) matrix
+    :param implicit_factors: NULL for biased matrix factorization or a C contiguous (items, n_factors) matrix
+    :param buffers: Scratch space of 2 * n_factors floats for each thread
+    """
+    cdef int o, user, row, item, f, thread
+    cdef float norm, prediction, error, p, q, y
+    cdef float *implicit
+    cdef float *gradient
+    for o in prange(n_users, num_threads=n_threads, schedule="dynamic", chunksize=64):
+        thread = threadid()
+        user = order[o]
+        if indptr[user] == indptr[user+1]:
+            continue
+        implicit = &buffers[2*thread*n_factors]
+        gradient = &buffers[(2*thread+1)*n_factors]
+        norm = 1. / sqrt(indptr[user+1] - indptr[user])
+        for f in range(n_factors):
+            implicit[f] = 0.
+            gradient[f] = 0.
+        if implicit_factors != NULL:
+            for row in range(indptr[user], indptr[user+1]):
+                for f in range(n_factors):
+                    implicit[f] = implicit[f] + norm * implicit_factors[indices[row]*n_factors+f]
+        for row in range(indptr[user], indptr[user+1]):
+            item = indices[row]
+            prediction = global_mean + user_bias[user] + item_bias[item]
+            for f in range(n_factors):
+                prediction = prediction + \
+                    (user_factors[user*n_factors+f] + implicit[f]) * item_factors[item*n_factors+f]
+            if prediction < min_value:
+                prediction = min_value
+            elif prediction > max_value:
+                prediction = max_value
+            error = ratings[row] - prediction
+            user_bias[user] = user_bias[user] + gamma * (error - reg * user_bias[user])
+            item_bias[item] = item_bias[item] + gamma * (error - reg * item_bias[item])
+            for f in range(n_factors):
+                p = user_factors[user*n_factors+f]
+                q = item_factors[item*n_factors+f]
+                user_factors[user*n_factors+f] = p + gamma * (error * q - reg * p)
+                item_factors[item*n_factors+f] = q + gamma * (error * (p + implicit[f]) - reg * q)
+                gradient[f] = gradient[f] + error * q
+        if implicit_factors != NULL:
+            for row in range(indptr[user], indptr[user+1]):
+                for f in range(n_factors):
+                    y = implicit_factors[indices[row]*n_factors+f]
+                    implicit_factors[indices[row]*n_factors+f] = y + gamma * (norm * gradient[f] - reg * y)
+
+
+cdef class NOGILBiasedFactorModel(NOGILModel):
+    """
+    Model that scores global mean + user bias + item bias + the product of the user and item factors. The biases and
+    factors are float32 numpy arrays indexed by the data map.
+    """
+
+    cdef float *c_user_bias
+    cdef float *c_item_bias
+    cdef float *c_user_factors
+    cdef float *c_item_factors
+    cdef float c_global_mean
+    cdef int c_users, c_items, c_dim
+    cdef object arrays
+
+    def __cinit__(self, *args, **kwargs):
+        self.c_user_bias = self.c_item_bias = self.c_user_factors = self.c_item_factors = NULL
+        self.c_global_mean = 0.
+        self.c_users = self.c_items = self.c_dim = 0
+
+    def set_factors(self, global_mean, user_bias, item_bias, user_factors, item_factors):
+        """
+        Set the global mean, the bias of each user and item and the (users, dim) and (items, dim) factor matrices
+        """
+        cdef np.ndarray[float, ndim=1, mode="c"] c_user_bias = np.ascontiguousarray(user_bias, dtype=np.float32)
+        cdef np.ndarray[float, ndim=1, mode="c"] c_item_bias = np.ascontiguousarray(item_bias, dtype=np.float32)
+        cdef np.ndarray[float, ndim=2, mode="c"] c_user_factors = \
+            np.ascontiguousarray(user_factors, dtype=np.float32)
+        cdef np.ndarray[float, ndim=2, mode="c"] c_item_factors = \
+            np.ascontiguousarray(item_factors, dtype=np.float32)
+        self.arrays = c_user_bias, c_item_bias, c_user_factors, c_item_factors
+        self.c_global_mean = global_mean
+        self.c_users, self.c_items, self.c_dim = len(c_user_bias), len(c_item_bias), c_user_factors.shape[1]
+        if self.c_users > 0 and self.c_items > 0:
+            self.c_user_bias, self.c_item_bias = &c_user_bias[0], &c_item_bias[0]
+            self.c_user_factors, self.c_item_factors = &c_user_factors[0, 0], &c_item_factors[0, 0]
+
+    def get_factors(self):
+        """
+        Return the global mean, the user and item biases and the user and item factors
+        """
+        return (self.c_global_mean,) + tuple(self.arrays)
+
+    def get_score(self, user, item, **context):
+        """
+        Return the score of the item for the user. Unknown users and items raise KeyError
+        """
+        cdef int c_user = self.data_map[self.get_user_column()][user], \
+            c_item = self.data_map[self.get_item_column()][item]
+        return float(self.nogil_get_score(c_user, c_item, 0, NULL))
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef float nogil_get_score(NOGILBiasedFactorModel self, int user, int item, int extra_context,
+                               int *context) nogil:
+        cdef int f
+        cdef float result = self.c_global_mean
+        if 0 <= user < self.c_users:
+            result = result + self.c_user_bias[user]
+        if 0 <= item < self.c_items:
+            result = result + self.c_item_bias[item]
+            if 0 <= user < self.c_users:
+                for f in range(self.c_dim):
+                    result = result + self.c_user_factors[user*self.c_dim+f] * self.c_item_factors[item*self.c_dim+f]
+        return result
+
+
+class CSVDpp(NOGILBiasedFactorModel):
+    """
+    SVD++ trained in process. It is an alternative to the GraphChi SVDpp with the same parameters and scores that
+    needs neither the svdpp binary nor temporary files.
+    """
+
+    implicit = True
+
+    def __init__(self, n_iterations=5, c_lambda=.05, c_gamma=.01, dim=20, decay=.9, min_value=1., max_value=5.,
+                 n_jobs=None):
+        """
+        Constructor
+
+        :param dim: Number of factors
+        :param decay: The learning rate is multiplied by decay after each iteration
+        :param min_value: The predictions are clipped to [min_value, max_value] while training
+        :param n_jobs: Number of threads. Default is the number of cores
+        """
+        self.set_params(n_iterations, c_lambda, c_gamma)
+        self._dim = int(dim)
+        self._decay = float(decay)
+        self._min_value, self._max_value = float(min_value), float(max_value)
+        self.n_jobs = n_jobs or multiprocessing.cpu_count()
+
+    def set_params(self, n_iterations=5, c_lambda=.05, c_gamma=.01):
+        """
+        Set the number of iterations, the regularization and the learning rate
+        """
+        self._n_iterations = int(n_iterations)
+        self._c_lambda = float(c_lambda)
+        self._c_gamma = float(c_gamma)
+
+    @classmethod
+    def param_details(cls):
+        """
+        Return parameter details for n_iterations, c_lambda and c_gamma
+        """
+        return {
+            'n_iterations': (1, 20, 2, 5),
+            'c_lambda': (.1, 1., .1, .05),
+            'c_gamma': (0.001, 1.0, 0.1, 0.01)
+        }
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def train(self, data):
+        """
+        Train the model
+        """
+        cdef int epoch
+        cdef int n_users = self.users_size(), n_items = self.items_size(), n_factors = self._dim
+        cdef int n_threads = self.n_jobs
+        users = data[:, 0].astype(np.int32)
+        rows = np.argsort(users, kind="mergesort")
+        cdef np.ndarray[int, ndim=1, mode="c"] indptr = np.zeros(n_users+1, dtype=np.int32)
+        np.cumsum(np.bincount(users, minlength=n_users), out=indptr[1:])
+        cdef np.ndarray[int, ndim=1, mode="c"] indices = np.ascontiguousarray(data[rows, 1], dtype=np.int32)
+        cdef np.ndarray[float, ndim=1, mode="c"] ratings = np.ascontiguousarray(data[rows, 2], dtype=np.float32)
+        cdef np.ndarray[float, ndim=1, mode="c"] user_bias = np.zeros(n_users, dtype=np.float32)
+        cdef np.ndarray[float, ndim=1, mode="c"] item_bias = np.zeros(n_items, dtype=np.float32)
+        cdef np.ndarray[float, ndim=2, mode="c"] user_factors = \
+            np.random.normal(0, .1, (n_users, n_factors)).astype(np.float32)
+        cdef np.ndarray[float, ndim=2, mode="c"] item_factors = \
+            np.random.normal(0, .1, (n_items, n_factors)).astype(np.float32)
+        cdef np.ndarray[float, ndim=2, mode="c"] implicit_factors = np.zeros((n_items, n_factors), dtype=np.float32)
+        cdef np.ndarray[float, ndim=1, mode="c"] buffers = np.zeros(2 * n_threads * n_factors, dtype=np.float32)
+        cdef np.ndarray[int, ndim=1, mode="c"] order
+        cdef float *c_implicit_factors = &implicit_factors[0, 0] if self.implicit else NULL
+        cdef float global_mean = ratings.mean(), gamma = self._c_gamma, reg = self._c_lambda
+        cdef float min_value = self._min_value, max_value = self._max_value
+        for epoch in range(self._n_iterations):
+            order = np.random.permutation(n_users).astype(np.int32)
+            with nogil:
+                svdpp_epoch(&order[0], n_users, &indptr[0], &indices[0], &ratings[0], global_mean, &user_bias[0],
+                            &item_bias[0], &user_factors[0, 0], &item_factors[0, 0], c_implicit_factors, n_factors,
+                            gamma, reg, min_value, max_value, &buffers[0], n_threads)
+            gamma *= self._decay
+        if self.implicit:
+            # Fold the implicit term into the user factors so the score is a single dot product
+            counts = np.diff(indptr).astype(np.float32)
+            norm = 1. / np.sqrt(np.maximum(counts, 1.))
+            rated = sparse.csr_matrix((np.ones(len(indices), dtype=np.float32), indices, indptr),
+                                      shape=(n_users, n_items))
+            user_factors += norm[:, np.newaxis] * rated.dot(implicit_factors)
+        self.set_factors(global_mean, user_bias, item_bias, user_factors, item_factors)
+
+    def get_name(self):
+        return "CSVDpp (dim={},iter={},lambda={},gamma={})".format(self._dim, self._n_iterations, self._c_lambda,
+                                                                 self._c_gamma)
+
+
+class CBiasedMF(CSVDpp):
+    """
+    Biased matrix factorization trained in process: SVD++ without the implicit feedback term
+    """
+
+    implicit = False
+
+    def get_name(self):
+        return "CBiasedMF (dim={},iter={},lambda={},gamma={})".format(self._dim, self._n_iterations,
+                                                                    self._c_lambda, self._c_gamma)
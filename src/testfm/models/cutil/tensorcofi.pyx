@@ -2,33 +2,68 @@
 cimport cython
 from libc.stdlib cimport malloc, free
 from libc.stdio cimport printf
-from testfm.models.cutil.float_matrix cimport float_matrix, fm_create_diagonal, fm_new, fm_new_init, fm_create_random, \
-    fm_get, fm_set, fm_destroy, fm_transpose, fm_multiply, fm_static_element_wise_multiply, fm_static_multiply_column, \
+from testfm.models.cutil.float_matrix cimport float_matrix, _float_matrix, fm_create_diagonal, fm_new, fm_new_init, \
+    fm_create_random, fm_get, fm_set, fm_destroy, fm_transpose, fm_multiply, fm_static_element_wise_multiply, fm_static_multiply_column, \
     fm_static_multiply, fm_static_multiply_scalar, fm_static_add, fm_solve
 
 from testfm.models.cutil.int_array cimport *
 from testfm.models.cutil.interface import IFactorModel
+import time
 import numpy as np
 cimport numpy as np
+from scipy.linalg import cho_factor, cho_solve
 
 cdef extern from "math.h":
     double log(double n) nogil
     double fabs(double score) nogil
-    double copysign(double x, float y) nogil
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef api int_array **tensorcofi_index(float_matrix data_array, int n_dimensions, int *dimensions) nogil:
+    """
+    Index the rows of the data for every entity of every dimension
+    :param data_array: Data with a column for each dimension and the score in the last column
+    :return: An array for each dimension with the list of data rows of each entity
+    """
+    cdef int i, j, data_row
+    cdef int_array **tensor = <int_array **>malloc(sizeof(int_array *) * n_dimensions)  # Tensor (array)
+    for i in range(n_dimensions):  # Fill the tensor with information
+        tensor[i] = <int_array *>malloc(sizeof(int_array) * dimensions[i])
+        for j in range(dimensions[i]):
+            tensor[i][j] = ia_new()
+        for data_row in range(data_array.rows):
+            ia_add(tensor[i][<int>fm_get(data_array, data_row, i)], data_row)  # Populate tensor
+    return tensor
+
+
+cdef api void tensorcofi_destroy_index(int_array **tensor, int n_dimensions, int *dimensions) nogil:
+    """
+    Free the memory of a tensor index
+    """
+    cdef int i, j
+    for i in range(n_dimensions):
+        for j in range(dimensions[i]):
+            if tensor[i][j] is not NULL:
+                ia_destroy(tensor[i][j])  # Destroy every int_array
+        free(tensor[i])  # Destroy the array of int_array
+    free(tensor)
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.overflowcheck(False)
 @cython.cdivision(False)
-cdef api float_matrix *tensorcofi_train(float_matrix data_array, int n_factors, int n_iterations, float c_lambda,
-                                        float c_alpha, int n_dimensions, int *dimensions) nogil:
+cdef api void tensorcofi_sweep(float_matrix data_array, float_matrix *factors, int_array **tensor, int n_factors,
+                               float c_lambda, float c_alpha, int n_dimensions, int *dimensions, int **active) nogil:
     """
-    Train a set of float_matrices with tensor values for a set of contexts
-    :param data_array:
-    :return:
+    Do one iteration of alternating least squares over every dimension. The factors are updated in place.
+    :param factors: A (n_factors, dimension) matrix for each dimension
+    :param tensor: The data index from tensorcofi_index
+    :param active: NULL to update every entity. Otherwise, for each dimension, NULL or a flag for each entity telling
+        if it is updated
     """
-    cdef int i, j, k, iteration, index, data_row, current_dimension, matrix_index, data_entry, data_column
+    cdef int i, j, k, data_row, current_dimension, matrix_index, data_entry, data_column
     cdef int *ipiv = <int *>malloc(sizeof(int) * n_factors)
     cdef float weight, score
     cdef int_array data_row_list = NULL
@@ -42,100 +77,79 @@ cdef api float_matrix *tensorcofi_train(float_matrix data_array, int n_factors,
     cdef float_matrix invertible = fm_new_init(n_factors, n_factors, 0.), \
          invertible_tmp = fm_new(n_factors, n_factors) # Invertible Matrix
     cdef float_matrix base = NULL, base_transpose = NULL, base_tmp = NULL
-    cdef float_matrix *factors = <float_matrix *>malloc(sizeof(float_matrix) * n_dimensions)  # Factors
-    cdef int_array **tensor = <int_array **>malloc(sizeof(int_array *) * n_dimensions)  # Tensor (array)
-    for i in range(n_dimensions):  # Fill the tensor with information
-        factors[i] = fm_create_random(n_factors, dimensions[i])
-        tensor[i] = <int_array *>malloc(sizeof(int_array) * dimensions[i])
 
-        for j in range(dimensions[i]):
-            tensor[i][j] = ia_new()
-        for data_row in range(data_array.rows):
-            ia_add(tensor[i][<int>fm_get(data_array, data_row, i)], data_row)  # Populate tensor
-    # Tensor created
-    # Factors created
-    # Start Iteration ##################################################################################################
-
-    for iteration in range(n_iterations):
-        for current_dimension in range(n_dimensions):
-            fm_destroy(base)
-            # Initiate base
-            if n_dimensions == 2:
-                base_transpose = fm_transpose(factors[1-current_dimension])  # New memory was allocated
-                base = fm_multiply(factors[1-current_dimension], base_transpose)  # New memory was allocated
-                fm_destroy(base_transpose)  # Memory from base_transpose released
-            else:
-                base = fm_new_init(n_factors, n_factors, 1.)  # New memory was allocated
-                for matrix_index in range(n_dimensions):
-                    if matrix_index != current_dimension:
-                        base_transpose =  fm_transpose(factors[matrix_index])  # New memory was allocated
-                        base_tmp = fm_multiply(factors[matrix_index], base_transpose)  # New memory was allocated
-                        base = fm_static_element_wise_multiply(base, base_tmp, base)  # No new memory is allocated
-                        fm_destroy(base_transpose)  # Memory from base_transpose released
-                        fm_destroy(base_tmp)  # Memory from base_tmp released
-            # Base created
-
-            for data_entry in range(dimensions[current_dimension]):
-                data_row_list = tensor[current_dimension][data_entry]
-                for i in range(ia_size(data_row_list)):
-                    data_row = data_row_list.values[i]
-                    # Initialize temporary matrix
-                    #  No new memory is allocated
-                    for j in range(tmp.size):
-                        tmp.values[j] = 1.
-                    # Done
-                    for data_column in range(n_dimensions):
-                        if data_column != current_dimension:
-                            fm_static_multiply_column(tmp, factors[data_column],
-                                                      <int>fm_get(data_array, data_row, data_column),
-                                                      tmp)  # No new memory is allocated
-                    score = fm_get(data_array, data_row, data_array.columns-1)
-                    weight = c_lambda * log(1.+fabs(score))
-                    # Start calculation of rank one update in invertible
-                    tmp_transpose = fm_transpose(tmp)  # Memory allocated
-                    fm_static_multiply(tmp, tmp_transpose, invertible_tmp)  # No new memory allocated
-                    fm_static_multiply_scalar(invertible_tmp, weight, invertible_tmp)  # No new memory allocated
-                    fm_static_add(invertible, invertible_tmp, invertible)  # No new memory allocated
-                    fm_destroy(tmp_transpose)  # Free memory from tmp_transpose
-                    # End calculation of rank one update in invertible
-                    # Start calculate matrix vector product
-                    fm_static_multiply_scalar(tmp, copysign(score, 1.) * (1.+weight), tmp)  # No new memory allocated
-                    fm_static_add(matrix_vector_product, tmp, matrix_vector_product)  # No new memory allocated
-                    # End calculate matrix vector product
-                fm_static_add(invertible, base, invertible)  # No new memory allocated
-                fm_static_multiply_scalar(regularizer, 1. / dimensions[current_dimension],
-                                          regularizer)  # No new memory allocated
-                fm_static_add(invertible, regularizer, invertible)  # No new memory allocated
-
-                solution = fm_solve(invertible, one, ipiv)  # New memory allocated
-
-                one_tmp = fm_multiply(solution, matrix_vector_product)  # New memory allocated
-                for k in range(n_factors):
-                    fm_set(factors[current_dimension], k, data_entry, fm_get(one_tmp, k, 0))
-                fm_destroy(one_tmp)
-                fm_destroy(solution)
-
-                # Reset variables
-                fm_static_multiply_scalar(one, 0., one)
-                fm_static_multiply_scalar(regularizer, 0., regularizer)
-                for k in range(one.rows):
-                    fm_set(one, k, k, 1.)
-                    fm_set(regularizer, k, k, c_lambda)
-                fm_static_multiply_scalar(invertible, 0., invertible)
-                fm_static_multiply_scalar(matrix_vector_product, 0., matrix_vector_product)
-                # End reset
-
-    # Stop Iteration ###################################################################################################
-    # Destroy the tensor and variables
-    for i in range(n_dimensions):
-        #printf(">>> %d\n", i)
-        for j in range(dimensions[i]):
-            if tensor[i][j] is not NULL:
-                #printf(">>> %d/%d\n", tensor[i][j]._size, tensor[i][j]._max_size)
-                ia_destroy(tensor[i][j])  # Destroy every int_array
-    for i in range(n_dimensions):
-        free(tensor[i])  # Destroy the array of int_array
-    free(tensor)  # If I continue with the explanation it will be hilarious
+    for current_dimension in range(n_dimensions):
+        fm_destroy(base)
+        # Initiate base
+        if n_dimensions == 2:
+            base_transpose = fm_transpose(factors[1-current_dimension])  # New memory was allocated
+            base = fm_multiply(factors[1-current_dimension], base_transpose)  # New memory was allocated
+            fm_destroy(base_transpose)  # Memory from base_transpose released
+        else:
+            base = fm_new_init(n_factors, n_factors, 1.)  # New memory was allocated
+            for matrix_index in range(n_dimensions):
+                if matrix_index != current_dimension:
+                    base_transpose =  fm_transpose(factors[matrix_index])  # New memory was allocated
+                    base_tmp = fm_multiply(factors[matrix_index], base_transpose)  # New memory was allocated
+                    base = fm_static_element_wise_multiply(base, base_tmp, base)  # No new memory is allocated
+                    fm_destroy(base_transpose)  # Memory from base_transpose released
+                    fm_destroy(base_tmp)  # Memory from base_tmp released
+        # Base created
+
+        for data_entry in range(dimensions[current_dimension]):
+            if active is not NULL and active[current_dimension] is not NULL and \
+                    active[current_dimension][data_entry] == 0:
+                continue
+            data_row_list = tensor[current_dimension][data_entry]
+            for i in range(ia_size(data_row_list)):
+                data_row = data_row_list.values[i]
+                # Initialize temporary matrix
+                #  No new memory is allocated
+                for j in range(tmp.size):
+                    tmp.values[j] = 1.
+                # Done
+                for data_column in range(n_dimensions):
+                    if data_column != current_dimension:
+                        fm_static_multiply_column(tmp, factors[data_column],
+                                                  <int>fm_get(data_array, data_row, data_column),
+                                                  tmp)  # No new memory is allocated
+                score = fm_get(data_array, data_row, data_array.columns-1)
+                weight = c_alpha * log(1.+fabs(score))
+                # Start calculation of rank one update in invertible
+                tmp_transpose = fm_transpose(tmp)  # Memory allocated
+                fm_static_multiply(tmp, tmp_transpose, invertible_tmp)  # No new memory allocated
+                fm_static_multiply_scalar(invertible_tmp, weight, invertible_tmp)  # No new memory allocated
+                fm_static_add(invertible, invertible_tmp, invertible)  # No new memory allocated
+                fm_destroy(tmp_transpose)  # Free memory from tmp_transpose
+                # End calculation of rank one update in invertible
+                # Start calculate matrix vector product
+                fm_static_multiply_scalar(tmp, ((score > 0) - (score < 0)) * (1.+weight),
+                                          tmp)  # No new memory allocated
+                fm_static_add(matrix_vector_product, tmp, matrix_vector_product)  # No new memory allocated
+                # End calculate matrix vector product
+            fm_static_add(invertible, base, invertible)  # No new memory allocated
+            fm_static_multiply_scalar(regularizer, 1. / dimensions[current_dimension],
+                                      regularizer)  # No new memory allocated
+            fm_static_add(invertible, regularizer, invertible)  # No new memory allocated
+
+            solution = fm_solve(invertible, one, ipiv)  # New memory allocated
+
+            one_tmp = fm_multiply(solution, matrix_vector_product)  # New memory allocated
+            for k in range(n_factors):
+                fm_set(factors[current_dimension], k, data_entry, fm_get(one_tmp, k, 0))
+            fm_destroy(one_tmp)
+            fm_destroy(solution)
+
+            # Reset variables
+            fm_static_multiply_scalar(one, 0., one)
+            fm_static_multiply_scalar(regularizer, 0., regularizer)
+            for k in range(one.rows):
+                fm_set(one, k, k, 1.)
+                fm_set(regularizer, k, k, c_lambda)
+            fm_static_multiply_scalar(invertible, 0., invertible)
+            fm_static_multiply_scalar(matrix_vector_product, 0., matrix_vector_product)
+            # End reset
+
     free(ipiv)  # Free ipiv
     fm_destroy(tmp)  # Free tmp
     fm_destroy(regularizer)
@@ -144,8 +158,187 @@ cdef api float_matrix *tensorcofi_train(float_matrix data_array, int n_factors,
     fm_destroy(invertible)
     fm_destroy(invertible_tmp)
     fm_destroy(base)
-    # Return the factors
-    return factors
+
+
+cdef float_matrix fm_from_array(np.ndarray[float, ndim=2, mode="c"] array) except NULL:
+    """
+    Wrap the memory of a C contiguous float32 numpy array in a float_matrix. The values are not copied so they must be
+    set to NULL before the float_matrix is destroyed.
+    """
+    cdef float_matrix fm = <float_matrix>malloc(sizeof(_float_matrix))
+    if fm is NULL:
+        raise MemoryError()
+    fm.values = <float *>array.data
+    fm.rows, fm.columns = array.shape[0], array.shape[1]
+    fm.size = fm.rows * fm.columns
+    fm.transpose = 0
+    return fm
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def tensorcofi_sweeps(data, factors, int n_iterations, float c_lambda, float c_alpha, active=None, callback=None):
+    """
+    Run iterations of alternating least squares starting from the factors given. The factors are updated in place.
+
+    :param data: A numpy array with a column for each dimension (internal index) and the score in the last column
+    :param factors: A list with a (dimension, n_factors) float32 numpy array in Fortran order for each dimension. Arrays
+        in other layouts are replaced in the list.
+    :param n_iterations: Number of iterations
+    :param active: None to update every entity. Otherwise a list with None or a boolean numpy array for each dimension
+        telling which entities are updated
+    :param callback: Function called with the iteration number after each iteration. If it returns True the training
+        stops.
+    :return: A list with the relative change of the factors in each iteration
+    """
+    cdef int i, iteration, n_dimensions = len(factors), n_factors
+    cdef float_matrix fm_data = NULL
+    cdef float_matrix *c_factors = NULL
+    cdef int_array **tensor = NULL
+    cdef int *dimensions = NULL
+    cdef int **c_active = NULL
+    convergence = []
+    for i in range(n_dimensions):
+        factors[i] = np.asfortranarray(factors[i], dtype=np.float32)
+    n_factors = factors[0].shape[1]
+    data = np.ascontiguousarray(data, dtype=np.float32)
+    active = None if active is None else [None if a is None else np.ascontiguousarray(a, dtype=np.int32)
+                                          for a in active]
+    try:
+        fm_data = fm_from_array(data)
+        dimensions = <int *>malloc(sizeof(int) * n_dimensions)
+        c_factors = <float_matrix *>malloc(sizeof(float_matrix) * n_dimensions)
+        if dimensions is NULL or c_factors is NULL:
+            raise MemoryError()
+        for i in range(n_dimensions):
+            c_factors[i] = NULL
+        for i in range(n_dimensions):
+            dimensions[i] = factors[i].shape[0]
+            c_factors[i] = fm_from_array(factors[i].transpose())
+        if active is not None:
+            c_active = <int **>malloc(sizeof(int *) * n_dimensions)
+            if c_active is NULL:
+                raise MemoryError()
+            for i in range(n_dimensions):
+                c_active[i] = NULL if active[i] is None else <int *>(<np.ndarray>active[i]).data
+        with nogil:
+            tensor = tensorcofi_index(fm_data, n_dimensions, dimensions)
+        for iteration in range(n_iterations):
+            previous = [factor.copy() for factor in factors]
+            with nogil:
+                tensorcofi_sweep(fm_data, c_factors, tensor, n_factors, c_lambda, c_alpha, n_dimensions, dimensions,
+                                 c_active)
+            change = sum(np.sum((factor - old) ** 2) for factor, old in zip(factors, previous))
+            size = sum(np.sum(old ** 2) for old in previous)
+            convergence.append(float(np.sqrt(change / size)) if size > 0. else 0.)
+            if callback is not None and callback(iteration):
+                break
+        return convergence
+    finally:
+        if tensor is not NULL:
+            tensorcofi_destroy_index(tensor, n_dimensions, dimensions)
+        if c_active is not NULL:
+            free(c_active)
+        if c_factors is not NULL:
+            for i in range(n_dimensions):
+                if c_factors[i] is not NULL:
+                    c_factors[i].values = NULL
+                    fm_destroy(c_factors[i])
+            free(c_factors)
+        if dimensions is not NULL:
+            free(dimensions)
+        if fm_data is not NULL:
+            fm_data.values = NULL
+            fm_destroy(fm_data)
+
+
+def weighted_loss(data, factors, c_lambda, c_alpha):
+    """
+    Weighted squared error of the factors over the data entries plus the regularization of the factors. Only the
+    entries in the data are used so it is an estimate of the TensorCoFi objective that is cheap to compute.
+
+    :param data: A numpy array with a column for each dimension (internal index) and the score in the last column
+    :param factors: A list with a (dimension, n_factors) numpy array for each dimension
+    """
+    prediction = np.ones((len(data), factors[0].shape[1]))
+    for i, factor in enumerate(factors):
+        prediction *= factor[data[:, i].astype(np.int32)]
+    score = data[:, -1]
+    weight = 1. + c_alpha * np.log(1. + np.fabs(score))
+    error = np.mean(weight * (np.sign(score) - prediction.sum(axis=1)) ** 2)
+    return float(error + c_lambda * sum(np.mean(np.sum(factor ** 2, axis=1)) for factor in factors))
+
+
+class ConvergenceMonitor(object):
+    """
+    Follow the objective of a TensorCoFi model between training iterations. The objective is the weighted loss over a
+    sample of the training data (lower is better) or, when validation data is given, the MAP of the model on it (higher
+    is better). Training stops early when the objective improves less than the tolerance.
+    """
+
+    def __init__(self, tolerance=None, validation=None, callback=None, sample_size=10000, non_relevant_count=100):
+        """
+        Constructor
+
+        :param tolerance: Minimum relative improvement of the objective to continue training. None never stops early
+        :param validation: DataFrame with held out data to compute MAP
+        :param callback: Function called after each iteration with the iteration number, the seconds it took and the
+            objective
+        :param sample_size: Number of training entries to compute the weighted loss
+        :param non_relevant_count: Number of non relevant items for the validation MAP
+        """
+        self.tolerance = tolerance
+        self.validation = validation
+        self.callback = callback
+        self.sample_size = sample_size
+        self.non_relevant_count = non_relevant_count
+        self.model = self.sample = self.start_time = None
+        self.history = []
+
+    def start(self, model, data):
+        """
+        Start to monitor the training of model with data
+        """
+        self.model = model
+        self.sample = data if len(data) <= self.sample_size else \
+            data[np.random.randint(0, len(data), self.sample_size)]
+        self.history = []
+        self.start_time = time.time()
+
+    def objective(self):
+        """
+        Compute the objective for the current factors of the model
+        """
+        if self.validation is not None:
+            from testfm.evaluation.evaluator import Evaluator
+            self.model.reload_factors()
+            return Evaluator().evaluate_model(self.model, self.validation,
+                                              non_relevant_count=self.non_relevant_count)[0]
+        return weighted_loss(self.sample, self.model.factors, self.model.constant_lambda, self.model.constant_alpha)
+
+    def step(self, iteration):
+        """
+        Register an iteration
+
+        :return: True if the training should stop
+        """
+        seconds = time.time() - self.start_time
+        objective = self.objective()
+        self.history.append((iteration, seconds, objective))
+        if self.callback is not None:
+            self.callback(iteration, seconds, objective)
+        self.start_time = time.time()
+        return self.converged()
+
+    def converged(self):
+        """
+        Return True if the last iteration improved the objective less than the tolerance
+        """
+        if self.tolerance is None or len(self.history) < 2:
+            return False
+        previous, current = self.history[-2][2], self.history[-1][2]
+        improvement = current - previous if self.validation is not None else previous - current
+        return improvement < self.tolerance * abs(previous)
 
 
 class CTensorCoFi(IFactorModel):
@@ -156,7 +349,8 @@ class CTensorCoFi(IFactorModel):
     constant_alpha = 40
     context_columns = []
 
-    def __init__(self, n_factors=None, n_iterations=None, c_lambda=None, c_alpha=None, other_context=None):
+    def __init__(self, n_factors=None, n_iterations=None, c_lambda=None, c_alpha=None, other_context=None,
+                 monitor=None):
         """
         Constructor
 
@@ -164,10 +358,12 @@ class CTensorCoFi(IFactorModel):
         :param n_iterations: Number of iteration in the matrices construction
         :param c_lambda: I came back when I find it out
         :param c_alpha: Constant important in weight calculation
+        :param monitor: A ConvergenceMonitor to follow the training and stop it early
         """
         self.set_params(n_factors, n_iterations, c_lambda, c_alpha)
         self.factors = []
         self.context_columns = other_context or []
+        self.monitor = monitor
 
     @classmethod
     def param_details(cls):
@@ -189,57 +385,62 @@ class CTensorCoFi(IFactorModel):
         return self.context_columns
 
 
-    @cython.boundscheck(False)
-    @cython.wraparound(False)
-    @cython.overflowcheck(False)
-    @cython.cdivision(False)
     def train(self, data):
         """
         Train the model
         """
-        cdef float_matrix *tensor = NULL
-        cdef int i, j, row, column, number_of_factors = <int>self.number_of_factors, \
-            number_of_iterations = <int>self.number_of_iterations
-        cdef float constant_lambda = <float>self.constant_lambda, constant_alpha = <float>self.constant_alpha
-        cdef float_matrix fm_data = NULL
-        cdef int *dimensions = NULL
-        cdef int number_of_dimensions = <int>len(self.data_map)
-        try:
-            fm_data = fm_new(data.shape[0], data.shape[1])
-            if fm_data is NULL:
-                raise MemoryError()
-            dimensions = <int *>malloc(sizeof(int) * number_of_dimensions)
-            if dimensions is NULL:
-                raise MemoryError()
-            for i in range(fm_data.size):
-                row = i / fm_data.columns
-                column = i % fm_data.columns
-                fm_set(fm_data, row, column, <float>data[row, column])
-            dimensions[0] = <int>self.users_size()
-            dimensions[1] = <int>self.items_size()
-
-            for i, in range(len(self.get_context_columns())):
-                dimensions[i+2] = <int>len(self.data_map[self.get_context_columns()[i]])
-            with nogil:
-                tensor = tensorcofi_train(fm_data, number_of_factors, number_of_iterations, constant_lambda,
-                                          constant_alpha, number_of_dimensions, dimensions)
-            if tensor is NULL:
-                raise RuntimeError
-            for i in range(len(self.data_map)):
-                tmp = np.empty(tensor[i].size, dtype=np.float32)
-                for j in range(tensor[i].size):
-                    tmp[j] = tensor[i].values[j]
-                tmp.shape = tensor[i].rows, tensor[i].columns
-                self.factors.append(tmp.transpose())
-        finally:
-            if dimensions is not NULL:
-                free(dimensions)
-            fm_destroy(fm_data)
-            if tensor is not NULL:
-                for i in range(number_of_dimensions):
-                    fm_destroy(tensor[i])
-                free(tensor)
+        self.training_data = np.ascontiguousarray(data, dtype=np.float32)
+        self.factors = [np.asfortranarray(np.random.rand(dimension, self.number_of_factors), dtype=np.float32)
+                        for dimension in self.get_dimensions()]
+        if self.monitor is not None:
+            self.monitor.start(self, self.training_data)
+        self.convergence = tensorcofi_sweeps(self.training_data, self.factors, self.number_of_iterations,
+                                             self.constant_lambda, self.constant_alpha,
+                                             callback=None if self.monitor is None else self.monitor.step)
 
+    def get_dimensions(self):
+        """
+        Return the number of entities in each dimension (users, items and then the other contexts)
+        """
+        return [len(self.data_map[column]) for column in
+                [self.get_user_column(), self.get_item_column()] + self.get_context_columns()]
+
+    def partial_fit(self, training_data, n_iterations=None, only_touched=False):
+        """
+        Train the model with new data, starting from the current factors instead of random ones. The new data is
+        appended to the data the model was trained with. New users, items and contexts are added to the data map and
+        get random factors.
+
+        :param training_data: DataFrame with the new entries
+        :param n_iterations: Number of iterations. Default is the number of iterations of the model
+        :param only_touched: If True only the entities in the new data are updated
+        :return: A list with the relative change of the factors in each iteration
+        """
+        if not self.factors:
+            self.fit(training_data)
+            return self.convergence
+        self.new_fit_version()
+        columns = [self.get_user_column(), self.get_item_column()] + self.get_context_columns()
+        data = [self.encode(column, training_data[column].values, extend=True) for column in columns]
+        data.append(training_data.get(self.get_rating_column(), np.ones((len(training_data),))))
+        data = np.column_stack(data).astype(np.float32)
+        for i, dimension in enumerate(self.get_dimensions()):
+            if dimension > self.factors[i].shape[0]:
+                new_factors = np.random.rand(dimension - self.factors[i].shape[0], self.number_of_factors)
+                self.factors[i] = np.vstack((self.factors[i], new_factors))
+        self.training_data = np.vstack((self.training_data, data))
+        active = None
+        if only_touched:
+            active = [np.bincount(data[:, i].astype(np.int32), minlength=dimension) > 0
+                      for i, dimension in enumerate(self.get_dimensions())]
+        if self.monitor is not None:
+            self.monitor.start(self, self.training_data)
+        self.convergence = tensorcofi_sweeps(self.training_data, self.factors,
+                                             n_iterations or self.number_of_iterations, self.constant_lambda,
+                                             self.constant_alpha, active,
+                                             callback=None if self.monitor is None else self.monitor.step)
+        self.reload_factors()
+        return self.convergence
 
     @cython.boundscheck(False)
     @cython.wraparound(False)
@@ -256,13 +457,11 @@ class CTensorCoFi(IFactorModel):
         :param p_param: p parameter
         :param lambda_param: regularizer
         """
-        y = matrix_y[user_item_ids]
-        base1 = matrix_y.transpose().dot(matrix_y)
-        base2 = y.transpose().dot(np.diag([p_param - 1] * y.shape[0])).dot(y)
-        base = base1 + base2 + np.diag([lambda_param] * base1.shape[0])
-        u_factors = np.linalg.inv(base).dot(y.transpose()).dot(np.diag([p_param] * y.shape[0]))
-        u_factors = u_factors.dot(np.ones(y.shape[0]).transpose())
-        return u_factors
+        y = np.asarray(matrix_y[user_item_ids], dtype=np.float64)
+        base = np.asarray(matrix_y, dtype=np.float64)
+        base = base.transpose().dot(base) + (p_param - 1) * y.transpose().dot(y)
+        base.flat[::base.shape[0]+1] += lambda_param
+        return cho_solve(cho_factor(base), p_param * y.sum(axis=0))
 
     def set_params(self, int n_factors, int n_iterations, float c_lambda, float c_alpha):
         """
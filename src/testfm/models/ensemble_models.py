@@ -10,20 +10,192 @@ them into a single model.
 
 __author__ = "linas"
 
+import time
+import hashlib
+import multiprocessing
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 
-from testfm.models.cutil.interface import IModel
+from testfm.models.cutil.interface import IModel, NOGILModel
+from testfm.models.baseline_model import LRUCache
 
 
-class LinearEnsemble(IModel):
+def batch_scores(model, users, items):
+    """
+    Score (user, item) pairs with one get_scores call for each user
+
+    :return: A float32 numpy array with the score of each pair
+    """
+    scores = np.empty(len(users), dtype=np.float32)
+    for user, rows in pd.DataFrame({"user": users}).groupby("user").indices.items():
+        scores[rows] = model.get_scores(user, items[rows])
+    return scores
+
+
+def pairs_key(users, items):
+    """
+    Digest of arrays of (user, item) pairs
+    """
+    return len(users), hashlib.sha1(pd.util.hash_array(np.asarray(users)).tostring() +
+                                    pd.util.hash_array(np.asarray(items)).tostring()).hexdigest()
+
+
+class ScoreCache(object):
+    """
+    Score columns of the models for arrays of (user, item) pairs. Ensembles that share a cache and are fitted on the
+    same pairs (the same data and seed) score them only once. The fit version of the model is part of the key, so
+    the columns of a refitted model are computed again. The least recently used columns are dropped to stay
+    under a limit of bytes.
+    """
+
+    def __init__(self, max_bytes=2**28):
+        """
+        Constructor
+
+        :param max_bytes: Maximum number of bytes of the score columns in the cache
+        """
+        self.columns = LRUCache(max_bytes)
+        self.hits = self.misses = 0
+
+    def scores(self, model, users, items):
+        """
+        Return the scores of the pairs for the model, computing them if they are not in the cache
+        """
+        key = (model, getattr(model, "fit_version", 0), pairs_key(users, items))
+        column = self.columns.get(key)
+        if column is not None:
+            self.hits += 1
+            return column[0]
+        self.misses += 1
+        column = batch_scores(model, users, items)
+        self.columns.put(key, (column,))
+        return column
+
+    def clear(self):
+        self.columns.clear()
+
+
+_members = []
+
+
+def _share_models(models):
+    """
+    Initializer of the worker processes. With fork the models are inherited, not pickled.
+    """
+    _members[:] = models
+
+
+def _timed_scores(model, user, items):
+    start = time.time()
+    scores = np.asarray(model.get_scores(user, items), dtype=np.float32)
+    return scores, time.time() - start
+
+
+def _score_member(arguments):
+    index, user, items = arguments
+    return _timed_scores(_members[index], user, items)
+
+
+class Ensemble(IModel):
+    """
+    Base of the ensembles. The models score the items of a user in batch into a (models, items) matrix and, with a
+    user cache, the scores of the last users are kept so the next calls for the same user only score the new items.
+
+    With n_jobs > 1 the models score at the same time: the NOGILModel members in threads (they score without the GIL)
+    and the others in worker processes. The processes get a copy of the models when they start, so call close after
+    fitting the members again. The seconds spent by each model are in timings.
+    """
+
+    _models = []
+    user_cache = None
+    n_jobs = 1
+    _threads = _processes = None
+
+    def cache_users(self, max_bytes=2**26):
+        """
+        Keep the scores of the models for the last users, up to max_bytes. None disables the cache
+        """
+        self.user_cache = LRUCache(max_bytes) if max_bytes else None
+
+    def set_jobs(self, n_jobs=1):
+        """
+        Set the number of threads and processes that score the models
+        """
+        self.close()
+        self.n_jobs = n_jobs
+        self.timings = [[0, 0.] for _ in self._models]
+
+    def close(self):
+        """
+        Stop the threads and processes that score the models
+        """
+        if self._threads is not None:
+            self._threads.shutdown()
+        if self._processes is not None:
+            self._processes.terminate()
+        self._threads = self._processes = None
+
+    def model_timings(self):
+        """
+        Return (name, calls, seconds) for each model, from the slowest
+        """
+        return sorted(((m.get_name(), calls, seconds) for m, (calls, seconds) in zip(self._models, self.timings)),
+                      key=lambda timing: -timing[2])
+
+    def _score_models(self, user, items):
+        if self.n_jobs <= 1 or len(self._models) <= 1:
+            results = [_timed_scores(m, user, items) for m in self._models]
+        else:
+            native = [isinstance(m, NOGILModel) for m in self._models]
+            if not all(native) and self._processes is None:
+                self._processes = multiprocessing.Pool(min(self.n_jobs, native.count(False)),
+                                                       initializer=_share_models, initargs=(self._models,))
+            if any(native) and self._threads is None:
+                self._threads = ThreadPoolExecutor(max_workers=min(self.n_jobs, native.count(True)))
+            results = [self._processes.apply_async(_score_member, ((i, user, items),)) if not is_native else
+                       self._threads.submit(_timed_scores, m, user, items)
+                       for i, (m, is_native) in enumerate(zip(self._models, native))]
+            results = [result.result() if is_native else result.get() for result, is_native in zip(results, native)]
+        for timing, (_, seconds) in zip(self.timings, results):
+            timing[0] += 1
+            timing[1] += seconds
+        return np.vstack([scores for scores, _ in results])
+
+    def model_scores(self, user, items):
+        """
+        Return the scores of the items for the user by each model
+
+        :return: A float32 numpy array (models, items)
+        """
+        items = np.asarray(items)
+        if self.user_cache is None:
+            return self._score_models(user, items)
+        known, scores = self.user_cache.get(user) or (items[:0], np.empty((len(self._models), 0), dtype=np.float32))
+        positions = pd.Index(known).get_indexer(items)
+        if (positions < 0).any():
+            new = pd.unique(items[positions < 0])
+            known, scores = np.concatenate((known, new)), np.hstack((scores, self._score_models(user, new)))
+            self.user_cache.put(user, (known, scores))
+            positions = pd.Index(known).get_indexer(items)
+        return scores[:, positions]
+
+    def get_score(self, user, item):
+        return float(self.get_scores(user, [item])[0])
+
+
+class LinearEnsemble(Ensemble):
 
     _models = []
     _weights = []
 
-    def __init__(self, models, weights=None):
+    def __init__(self, models, weights=None, user_cache_bytes=None, n_jobs=1):
         """
         :param models: list of ModelInterface subclasses
         :param weights: list of floats with weights telling how to combine the 
             models
+        :param user_cache_bytes: Bytes of the cache of the model scores of the last users. None has no cache
+        :param n_jobs: Number of threads or processes that score the models at the same time
         :return:
         """
 
@@ -34,6 +206,8 @@ class LinearEnsemble(IModel):
 
         self._weights = weights
         self._models = models
+        self.cache_users(user_cache_bytes)
+        self.set_jobs(n_jobs)
 
     def fit(self, training_data):
         pass
@@ -54,8 +228,13 @@ class LinearEnsemble(IModel):
         factor)*0.5
 
         """
-        predictions = (m.get_score(user, item) for m in self._models)
-        return sum((w*p for w, p in zip(self._weights, predictions)))
+        return super(LinearEnsemble, self).get_score(user, item)
+
+    def get_scores(self, user, items, **context):
+        """
+        Return the weighted sum of the scores of the models, computed in batch
+        """
+        return np.dot(self._weights, self.model_scores(user, items))
 
     def get_name(self):
         models = ",".join((m.getName() for m in self._models))
@@ -63,65 +242,113 @@ class LinearEnsemble(IModel):
         return "Linear Ensemble ("+models+"|"+weights+")"
 
 
-class LogisticEnsemble(IModel):
+class LogisticEnsemble(Ensemble):
     """
     A linear ensemble model which is learned using logistic regression.
     """
 
-    _user_count = {}
     _item_features = None
     model = None
+    # Coefficients of the features and intercept of the fitted model
+    weights = intercept = None
+    # Features of each pair: a constant, the item features
+    _constant = False
+    _use_item_features = True
 
-    def get_score(self, user, item):
-        x, y = self._extract_features(user, item)
-        return float(self.model.predict(x))
+    def get_scores(self, user, items, **context):
+        """
+        Return the decision function of the fitted model for the items, with one matrix-vector product
+        """
+        features = self.feature_matrix(np.repeat([user], len(items)), items, scores=self.model_scores(user, items))
+        return features.dot(self.weights) + self.intercept
 
     def get_name(self):
         models = ",".join([m.get_name() for m in self._models])
         return "Logistic Ensemble ("+models+")"
 
-    def __init__(self, models, item_features_column=[]):
+    def __init__(self, models, item_features_column=[], score_cache=None, seed=None, user_cache_bytes=None,
+                 n_jobs=1):
+        """
+        :param models: The models to combine
+        :param item_features_column: Columns of the training data used as item features
+        :param score_cache: A ScoreCache for the scores of the models. Share it between ensembles of the same models
+            to score the training pairs once. None scores the models without a cache
+        :param seed: Seed of the negative items. Ensembles with the same seed are trained on the same pairs. Without
+            a seed the negative pairs are new in each fit so their scores are not cached
+        :param user_cache_bytes: Bytes of the cache of the model scores of the last users. None has no cache
+        :param n_jobs: Number of threads or processes that score the models at the same time
+        """
         self._models = models
         self.item_features_column = item_features_column
+        self.score_cache = score_cache
+        self.seed = seed
+        self.cache_users(user_cache_bytes)
+        self.set_jobs(n_jobs)
+        self._user_count = {}
+        self._user_counts = self._item_frame = None
 
     def _prepare_feature_extraction(self, df):
         """
         Extracts size of user profile info and item price
         """
-        grouped = df.groupby("user")
-        for user, entries in grouped:
-            self._user_count[user] = len(entries)
+        self._user_counts = df.groupby("user").size()
+        self._user_count = self._user_counts.to_dict()
 
         if self.item_features_column:
-            self._item_features = {
-                item[0]: item[1:] for item, entries in df.groupby(["item"] + self.item_features_column)
-            }
+            self._item_frame = df.drop_duplicates("item", keep="last").set_index("item")[self.item_features_column]
+            self._item_features = {item: tuple(row) for item, row in zip(self._item_frame.index, self._item_frame.values)}
+
+    def feature_matrix(self, users, items, cached=True, scores=None):
+        """
+        Features of (user, item) pairs: a constant (if the ensemble uses it), the size of the user profile, the item
+        features and the score of each model. The columns are filled in place, the scores with batch scoring.
+
+        :param cached: Take the scores of the models from the score cache, if the ensemble has one
+        :param scores: The (models, pairs) scores of the models, if they are already computed
+        :return: A float32 numpy array (pairs, features)
+        """
+        users, items = np.asarray(users), np.asarray(items)
+        item_features = self._item_frame is not None and self._use_item_features
+        n_item_features = len(self.item_features_column) if item_features else 0
+        features = np.empty((len(users), self._constant + 1 + n_item_features + len(self._models)), dtype=np.float32)
+        column = 0
+        if self._constant:
+            features[:, 0] = 1.
+            column += 1
+        features[:, column] = self._user_counts.reindex(users).fillna(0).values
+        column += 1
+        if item_features:
+            features[:, column:column+n_item_features] = self._item_frame.reindex(items).fillna(0).values
+            column += n_item_features
+        if scores is not None:
+            features[:, column:] = scores.T
+            return features
+        for model in self._models:
+            features[:, column] = self.score_cache.scores(model, users, items) \
+                if cached and self.score_cache is not None else batch_scores(model, users, items)
+            column += 1
+        return features
 
     def _extract_features(self, user, item, relevant=True):
         """
         Gives proper feature for the logistic function to train on.
         """
-        features = [self._user_count.get(user, 0)]
-        if self._item_features:
-            features += [f for f in self._item_features[item]]
-        features += [m.get_score(user, item) for m in self._models]
-        return features, 1 if relevant else 0
+        return self.feature_matrix([user], [item], cached=False)[0].tolist(), 1 if relevant else 0
 
-    def prepare_data(self, df):
-        from random import choice
-        _X = []
-        _Y = []
+    def _sample_pairs(self, df):
+        """
+        The (user, item) pairs of the data and the same users with a random item
+        """
         items = df.item.unique()
-        self._prepare_feature_extraction(df)
+        negatives = items[np.random.RandomState(self.seed).randint(0, len(items), len(df))]
+        return df.user.values, df.item.values, negatives
 
-        for _, t in df.iterrows():
-            x, y = self._extract_features(t["user"], t["item"], relevant=True)
-            _X.append(x)
-            _Y.append(y)
-            bad_item = choice(items)
-            x, y = self._extract_features(t["user"], bad_item, relevant=False)
-            _X.append(x)
-            _Y.append(y)
+    def prepare_data(self, df):
+        self._prepare_feature_extraction(df)
+        users, positives, negatives = self._sample_pairs(df)
+        _X = np.vstack((self.feature_matrix(users, positives),
+                        self.feature_matrix(users, negatives, cached=self.seed is not None)))
+        _Y = np.repeat([1, 0], len(users))
         return _X, _Y
 
     def fit(self, df):
@@ -130,11 +357,22 @@ class LogisticEnsemble(IModel):
         _X, _Y = self.prepare_data(df)
         self.model = LogisticRegression(C=10, penalty="l1", tol=0.1)
         self.model.fit(_X, _Y)
+        self._set_weights()
+
+    def _set_weights(self):
+        """
+        Keep the coefficients of the fitted model to score with a matrix-vector product
+        """
+        self.new_fit_version()
+        self.weights = np.ravel(self.model.coef_).astype(np.float32)
+        self.intercept = float(np.ravel(self.model.intercept_)[0])
 
 
 class LinearFit(LogisticEnsemble):
 
     model = None
+    _constant = True
+    _use_item_features = False
 
     def fit(self, df):
         from sklearn.linear_model import LinearRegression
@@ -142,18 +380,9 @@ class LinearFit(LogisticEnsemble):
         _X, _Y = self.prepare_data(df)
         self.model = LinearRegression(copy_X=False)
         self.model.fit(_X, _Y)
+        self._set_weights()
         #print self.model.coef_
 
-    def _extract_features(self, user, item, relevant=True):
-        """
-        Gives proper feature for the logistic function to train on.
-        """
-
-        features = [1, self._user_count.get(user, 0)] + \
-                   [m.get_score(user, item) for m in self._models]
-
-        return features, 1 if relevant else 0
-
     def get_name(self):
         models = ",".join([m.getName() for m in self._models])
         return "Linear Ensemble ("+models+")"
@@ -163,8 +392,9 @@ class LinearRank(LogisticEnsemble):
 
     model = None
 
-    def __init__(self, models, item_features_column=[]):
-        super(LinearRank, self).__init__(models, item_features_column)
+    def __init__(self, models, item_features_column=[], score_cache=None, seed=None, user_cache_bytes=None,
+                 n_jobs=1):
+        super(LinearRank, self).__init__(models, item_features_column, score_cache, seed, user_cache_bytes, n_jobs)
 
     def fit(self, df):
         from sklearn.linear_model import LinearRegression
@@ -172,6 +402,7 @@ class LinearRank(LogisticEnsemble):
         _X, _Y = self.prepare_data(df)
         self.model = LinearRegression(copy_X=False)
         self.model.fit(_X, _Y)
+        self._set_weights()
         #print self.model.coef_
 
     def get_name(self):
@@ -179,22 +410,96 @@ class LinearRank(LogisticEnsemble):
         return "LinearRank Ensemble ("+models+")"
 
     def prepare_data(self, df):
-        from random import choice
-        _X = []
-        _Y = []
-        items = df.item.unique()
         self._prepare_feature_extraction(df)
+        users, positives, negatives = self._sample_pairs(df)
+        difference = self.feature_matrix(users, positives)
+        difference -= self.feature_matrix(users, negatives, cached=self.seed is not None)
+        _X = np.vstack((difference, -difference))
+        _Y = np.repeat([1, -1], len(users))
+        return _X, _Y
 
-        for _, tuple in df.iterrows():
-            x, y = self._extract_features(tuple["user"], tuple["item"], relevant=True)
-            bad_item = choice(items)
-            x2, y2 = self._extract_features(tuple["user"], bad_item, relevant=False)
-            _X.append([a-b for a,b in zip(x,x2)])
-            _Y.append(1)
-            _X.append([b-a for a,b in zip(x,x2)])
-            _Y.append(-1)
 
-        return _X, _Y
+class PairwiseRank(LogisticEnsemble):
+    """
+    Linear ensemble trained to rank the items of the user above random items with the pairwise logistic loss
+    log(1 + exp(-w.(x_positive - x_negative))). Each mini-batch draws n_negatives items for each (user, item) row as
+    arrays, computes the features of the batch only and does a vectorized gradient step, so the features of the whole
+    data are never in memory. The features are divided by their standard deviation in the first batch (scale) for
+    the training; weights has the coefficients of the raw features.
+    """
+
+    scale = None
+
+    def __init__(self, models, item_features_column=[], n_negatives=5, batch_size=1000, n_iter=5, eta=0.1,
+                 reg=0.0001, decay=1., seed=None, callback=None, user_cache_bytes=None, n_jobs=1):
+        """
+        :param n_negatives: Number of random items for each row
+        :param batch_size: Number of rows in each batch
+        :param n_iter: Number of epochs
+        :param eta: Learning rate
+        :param reg: Regularization of the weights
+        :param decay: The learning rate is multiplied by decay after each epoch
+        :param callback: Function called after each epoch with the epoch number, the seconds it took and the mean loss
+        """
+        super(PairwiseRank, self).__init__(models, item_features_column, seed=seed, user_cache_bytes=user_cache_bytes,
+                                           n_jobs=n_jobs)
+        self.n_negatives = n_negatives
+        self.batch_size = batch_size
+        self.n_iter = n_iter
+        self.eta = eta
+        self.reg = reg
+        self.decay = decay
+        self.callback = callback
+        self.history = []
+
+    def get_name(self):
+        models = ",".join([m.get_name() for m in self._models])
+        return "PairwiseRank Ensemble ("+models+")"
+
+    def batch_differences(self, users, items, negatives):
+        """
+        Return the features of the items minus the features of the negative items of each row
+
+        :param negatives: A (rows, n_negatives) array of items
+        :return: A float32 array (rows, n_negatives, features)
+        """
+        positive = self.feature_matrix(users, items, cached=False)
+        negative = self.feature_matrix(np.repeat(users, negatives.shape[1]), negatives.ravel(), cached=False)
+        return positive[:, np.newaxis, :] - negative.reshape(negatives.shape + (positive.shape[1],))
+
+    def fit(self, df):
+        """
+        Train the weights. The history has the epoch number, the seconds it took and the mean loss of each epoch.
+        """
+        self._prepare_feature_extraction(df)
+        users, items, catalogue = df.user.values, df.item.values, df.item.unique()
+        random = np.random.RandomState(self.seed)
+        weights = self.scale = None
+        self.history = []
+        eta = self.eta
+        for epoch in xrange(self.n_iter):
+            start_time, loss = time.time(), 0.
+            order = random.permutation(len(users))
+            for start in xrange(0, len(order), self.batch_size):
+                batch = order[start:start+self.batch_size]
+                negatives = catalogue[random.randint(0, len(catalogue), (len(batch), self.n_negatives))]
+                differences = self.batch_differences(users[batch], items[batch], negatives)
+                if self.scale is None:
+                    self.scale = np.maximum(differences.reshape(-1, differences.shape[2]).std(axis=0), 1e-6)
+                    weights = np.zeros(differences.shape[2])
+                differences = differences / self.scale
+                margin = differences.dot(weights)
+                gradient = (1. / (1. + np.exp(margin)))[:, :, np.newaxis]
+                weights += eta * ((gradient * differences).mean(axis=(0, 1)) - self.reg * weights)
+                loss += np.logaddexp(0., -margin).mean(axis=1).sum()
+            eta *= self.decay
+            self.history.append((epoch, time.time() - start_time, loss / len(users)))
+            if self.callback is not None:
+                self.callback(*self.history[-1])
+        self.new_fit_version()
+        self.weights = (weights / self.scale).astype(np.float32)
+        self.intercept = 0.
+
 
 if __name__ == "__main__":
     import doctest
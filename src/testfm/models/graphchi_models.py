@@ -8,7 +8,6 @@ import datetime
 import numpy as np
 from testfm.models.cutil.interface import IModel
 logger = logging.getLogger(__name__)
-from scipy.io.mmio import mminfo, mmread, mmwrite
 
 
 class SVDpp(IModel):
@@ -47,6 +46,7 @@ class SVDpp(IModel):
         }
 
     def fit(self, training_data):
+        self.new_fit_version()
         training_filename = self.dump_data(training_data)
         logger.debug("Started training model {}".format(__name__))
         cmd = " ".join(["svdpp",
@@ -68,29 +68,26 @@ class SVDpp(IModel):
         self.V_bias = self.read_matrix(training_filename+"_V_bias.mm")
 
     def dump_data(self, df):
-        #first we need to reindex user and item and store their new ids
-        _, df['u'] = np.unique(df.user, return_inverse=True)
-        _, df['i'] = np.unique(df.item, return_inverse=True)
-
-        self.umap = {
-            key[0]: key[1] for key, _ in df.groupby(['user', 'u'])
-        }
+        """
+        Write the ratings in a MatrixMarket coordinate file for GraphChi. Users and items are reindexed from 1 and
+        their indexes from 0 are stored in umap and imap. The data frame is not modified.
 
-        self.imap = {
-            key[0]: key[1] for key, _ in df.groupby(['item', 'i'])
-        }
+        :param df: pandas.DataFrame with user, item and rating columns
+        :return: The name of the file
+        """
+        users, u = np.unique(df.user.values, return_inverse=True)
+        items, i = np.unique(df.item.values, return_inverse=True)
+        self.umap = dict(zip(users.tolist(), xrange(len(users))))
+        self.imap = dict(zip(items.tolist(), xrange(len(items))))
+        ratings = df.rating.values.astype(np.int64)
+        ratings[ratings == 0] = 1
 
         filename = tempfile.mkstemp(prefix='graphchi', dir=self.tmp_dir, suffix=".mtx")
         f = os.fdopen(filename[0], "w")
-        #print filename[1]
         f.write("%%MatrixMarket matrix coordinate real general\n")
         f.write("% Generated {}\n".format(datetime.datetime.now()))
-        f.write("{} {} {}\n".format(len(df.user.unique()), len(df.item.unique()), len(df)))
-        for idx, row in df.iterrows():
-            r = int(row['rating'])
-            if r == 0:
-                r = 1
-            f.write("{} {} {}\n".format(row['u']+1,row['i']+1,r))
+        f.write("{} {} {}\n".format(len(users), len(items), len(df)))
+        np.savetxt(f, np.column_stack((u+1, i+1, ratings)), fmt="%d")
         f.close()
         return filename[1]
 
@@ -103,25 +100,18 @@ class SVDpp(IModel):
 
     def read_matrix(self, filename):
         """
-        reads grapchi format in the numpy array. The order is wrong in grapchi, therefore, we play tricks.
+        Read a dense matrix written by GraphChi into a float32 numpy array. GraphChi writes the array MatrixMarket
+        format by rows (the standard is by columns), one row per user or item node, so the values are reshaped in
+        row order.
 
-        About the second (order of rows vs. columns), we have a problem that in distributed graphlab we
-        output the matrix by rows, since each node is a row, and nodes are on different machines.
-        So to be compatible I left GraphChi code to confirm to GraphLab. In case it helps, here is a matlab mmread.m
-        function which switches the order to be sorted by rows http://select.cs.cmu.edu/code/graphlab/mmread.m
-        I am not sure if it is easy to fix it in python or not. [...]
-        You are definitely right the the standard describes column
-        order and not row order.
+        :param filename: The name of the file
+        :return: A (rows, columns) numpy array
         """
-
         logger.debug("Loading matrix market matrix ")
-        f = open(filename, "rb")
-        r = mmread(f)
-        m = np.array(r.ravel())
-        m = m.reshape(r.shape, order='F')
-        # print "mmread", r.ravel(), r.shape
-        # print "trans", m.ravel(), m.shape
-        # if m.shape[0] > 1:
-        #     print m[1]
-        f.close()
-        return m
+        with open(filename, "rb") as f:
+            line = f.readline()
+            while line.startswith("%") or not line.strip():
+                line = f.readline()
+            rows, columns = [int(v) for v in line.split()[:2]]
+            values = np.fromstring(f.read(), dtype=np.float32, sep=" ")
+        return values.reshape((rows, columns))
@@ -0,0 +1,172 @@
+"""
+Negative item samplers for pairwise ranking models such as BPR. A sampler is fitted with the (user, item) pairs of the
+training data, in the internal indexes of the data map, and then draws a negative item for each user of a batch.
+"""
+
+import numpy as np
+
+
+def alias_table(weights):
+    """
+    Build the table of the alias method to draw indexes with probability proportional to the weights in constant time
+
+    :param weights: A numpy array with non negative weights
+    :return: A float32 array with the probability to keep each index and an int32 array with the alias of each index
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    n = len(weights)
+    scaled = weights * n / weights.sum()
+    probability = np.ones(n, dtype=np.float32)
+    alias = np.arange(n, dtype=np.int32)
+    small = list(np.flatnonzero(scaled < 1.))
+    large = list(np.flatnonzero(scaled >= 1.))
+    while small and large:
+        less, more = small.pop(), large.pop()
+        probability[less], alias[less] = scaled[less], more
+        scaled[more] -= 1. - scaled[less]
+        (small if scaled[more] < 1. else large).append(more)
+    return probability, alias
+
+
+class PositiveIndex(object):
+    """
+    Compact index of the items of each user in compressed sparse rows: the items of user u are
+    indices[indptr[u]:indptr[u+1]], sorted.
+    """
+
+    def __init__(self, users, items, n_users, n_items):
+        """
+        Constructor
+
+        :param users: The user index of each pair
+        :param items: The item index of each pair
+        :param n_users: Number of users
+        :param n_items: Number of items
+        """
+        users, items = np.asarray(users, dtype=np.int64), np.asarray(items, dtype=np.int64)
+        self.n_items = n_items
+        self.keys = np.unique(users * n_items + items)
+        self.indices = (self.keys % n_items).astype(np.int32)
+        self.indptr = np.zeros(n_users+1, dtype=np.int32)
+        np.cumsum(np.bincount(self.keys // n_items, minlength=n_users), out=self.indptr[1:])
+
+    def items_of(self, user):
+        """
+        Return the items of the user
+        """
+        return self.indices[self.indptr[user]:self.indptr[user+1]]
+
+    def contains(self, users, items):
+        """
+        Return a boolean numpy array telling which pairs are in the index
+        """
+        keys = np.asarray(users, dtype=np.int64) * self.n_items + np.asarray(items, dtype=np.int64)
+        if len(self.keys) == 0:
+            return np.zeros(len(keys), dtype=bool)
+        position = np.minimum(np.searchsorted(self.keys, keys), len(self.keys)-1)
+        return self.keys[position] == keys
+
+
+class UniformSampler(object):
+    """
+    Draw the negative items uniformly. Items the user consumed are drawn again.
+    """
+
+    n_candidates = 1
+    probability = alias = None
+
+    def __init__(self, exclude_positives=True, max_tries=10):
+        """
+        Constructor
+
+        :param exclude_positives: If True the items of the user are not used as negative items
+        :param max_tries: Number of times a positive item is drawn again before it is accepted
+        """
+        self.exclude_positives = exclude_positives
+        self.max_tries = max_tries
+        self.index = None
+        self.n_items = 0
+
+    def fit(self, users, items, n_users, n_items):
+        """
+        Prepare the sampler for the training data
+
+        :param users: The user index of each training pair
+        :param items: The item index of each training pair
+        """
+        self.n_items = n_items
+        self.index = PositiveIndex(users, items, n_users, n_items) if self.exclude_positives else None
+
+    def draw(self, size):
+        """
+        Draw size items without looking at the users
+        """
+        return np.random.randint(0, self.n_items, size)
+
+    def sample(self, users, user_factors=None, item_factors=None):
+        """
+        Draw a negative item for each user
+
+        :param users: A numpy array with user indexes
+        :param user_factors: The current user factors. Only used by adaptive samplers
+        :param item_factors: The current item factors. Only used by adaptive samplers
+        :return: A numpy array with an item index for each user
+        """
+        negatives = self.draw(len(users))
+        if self.index is not None:
+            for _ in xrange(self.max_tries):
+                positive = self.index.contains(users, negatives)
+                if not positive.any():
+                    break
+                negatives[positive] = self.draw(positive.sum())
+        return negatives
+
+
+class PopularitySampler(UniformSampler):
+    """
+    Draw the negative items with probability proportional to a power of their popularity with an alias table
+    """
+
+    def __init__(self, exponent=1., exclude_positives=True, max_tries=10):
+        """
+        Constructor
+
+        :param exponent: The popularity is raised to this exponent. 0 is uniform sampling
+        """
+        super(PopularitySampler, self).__init__(exclude_positives, max_tries)
+        self.exponent = exponent
+
+    def fit(self, users, items, n_users, n_items):
+        super(PopularitySampler, self).fit(users, items, n_users, n_items)
+        self.probability, self.alias = \
+            alias_table(np.bincount(np.asarray(items, dtype=np.int64), minlength=n_items) ** self.exponent)
+
+    def draw(self, size):
+        candidates = np.random.randint(0, self.n_items, size)
+        return np.where(np.random.random_sample(size) < self.probability[candidates], candidates,
+                        self.alias[candidates])
+
+
+class AdaptiveSampler(UniformSampler):
+    """
+    Oversample candidates for each user and keep the one with the highest score in the current factors. The hard
+    negatives have bigger gradients so the training converges in fewer epochs.
+    """
+
+    def __init__(self, n_candidates=5, exclude_positives=True, max_tries=10):
+        """
+        Constructor
+
+        :param n_candidates: Number of candidates drawn for each negative item
+        """
+        super(AdaptiveSampler, self).__init__(exclude_positives, max_tries)
+        self.n_candidates = n_candidates
+
+    def sample(self, users, user_factors=None, item_factors=None):
+        users = np.asarray(users)
+        candidates = super(AdaptiveSampler, self).sample(np.repeat(users, self.n_candidates))
+        candidates = candidates.reshape((len(users), self.n_candidates))
+        if user_factors is None:
+            return candidates[:, 0]
+        scores = np.einsum("ij,ikj->ik", user_factors[users], item_factors[candidates])
+        return candidates[np.arange(len(users)), scores.argmax(axis=1)]
@@ -2,7 +2,7 @@
 """
 Created on 16 January 2014
 
-Connector for the tensor CoFi Java implementation
+TensorCoFi models. The native implementation trains in process, the Java one is still available as an option
 
 .. moduleauthor:: joaonrb <joaonrb@gmail.com>
 """
@@ -18,22 +18,21 @@ from pkg_resources import resource_filename
 import testfm
 import os
 import numpy as np
+import pandas as pd
 import shutil
-import datetime
+import tempfile
 import subprocess
-import math
+from scipy.linalg import cho_factor, cho_solve
 from testfm.models.cutil.interface import IFactorModel
-from testfm.models.cutil.tensorcofi import CTensorCoFi
+from testfm.models.cutil.tensorcofi import CTensorCoFi, ConvergenceMonitor
 
 
-class TensorCoFi(IFactorModel):
-
-    number_of_factors = 20
-    number_of_iterations = 5
-    constant_lambda = .05
-    constant_alpha = 40
+class TensorCoFi(CTensorCoFi):
+    """
+    TensorCoFi trained in process by the native implementation of CTensorCoFi or, if asked, by the java one
+    """
 
-    def __init__(self, n_factors=20, n_iterations=5, c_lambda=0.05, c_alpha=40, other_context=None):
+    def __init__(self, n_factors=20, n_iterations=5, c_lambda=0.05, c_alpha=40, other_context=None, java=False):
         """
         Constructor
 
@@ -41,10 +40,10 @@ class TensorCoFi(IFactorModel):
         :param n_iterations: Number of iteration in the matrices construction
         :param c_lambda: I came back when I find it out
         :param c_alpha: Constant important in weight calculation
+        :param java: If True the model is trained by the java implementation in a subprocess instead of the native one
         """
-        self.set_params(n_factors, n_iterations, c_lambda, c_alpha)
-        self.factors = []
-        self.context_columns = other_context
+        super(TensorCoFi, self).__init__(n_factors, n_iterations, c_lambda, c_alpha, other_context)
+        self.java = java
 
     @classmethod
     def param_details(cls):
@@ -58,53 +57,50 @@ class TensorCoFi(IFactorModel):
             "c_alpha": (30, 50, 5, 40)
         }
 
-    def get_context_columns(self):
+    def train(self, data):
         """
-        Get a list of names of all the context column names for this model
-        :return:
+        Train the model in process with the native implementation or, if java was asked, with the java one
         """
-        return self.context_columns or []
+        if self.java:
+            self.factors = self.java_train(data)
+        else:
+            super(TensorCoFi, self).train(data)
 
-    def train(self, data):
+    def java_train(self, data):
+        """
+        Train the factors with the java implementation. The data and the factors are exchanged in csv files in a
+        temporary directory.
+
+        :return: A list with a (dimension, n_factors) numpy array for each dimension
         """
-        Train the model
-        """
-        directory = "log/" + datetime.datetime.now().isoformat("_")
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-        with open(directory+"/train.csv", "w") as datafile:
-            np.savetxt(datafile, data, delimiter=", ")
-            name = os.path.dirname(datafile.name)+"/"
-        parameters = [
-            "java",
-            "-Ddirectory=%s" % name,
-            "-Dn_factors=%d" % self.number_of_factors,
-            "-Dn_iterations=%d" % self.number_of_iterations,
-            "-Dlambda=%f" % self.constant_lambda,
-            "-Dalpha=%f" % self.constant_alpha,
-            "-Dn_contexts=%d" % (2 + len(self.get_context_columns())),
-            "-Dcontext0=%s" % self.get_user_column(),
-            "-Ddimension0=%d" % self.users_size(),
-            "-Dcontext1=%s" % self.get_item_column(),
-            "-Ddimension1=%d" % self.items_size(),
-        ]
-        for i, context in enumerate(self.get_context_columns(), start=2):
-            parameters.append("-Dcontext%d=%s" % (i, context))
-            parameters.append("-Ddimension%d=%d" % (i, len(self.data_map[context])))
-        java_jar = resource_filename(testfm.__name__, "lib/algorithm-1.0-SNAPSHOT-jar-with-dependencies.jar")
-        sub = subprocess.Popen(parameters + ["-cp", java_jar, "es.tid.frappe.python.TensorCoPy"],
-                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out, err = sub.communicate()
-        if err:
-            #os.remove(name)
-            print out
-            raise Exception(err)
-        self.factors = [np.genfromtxt(open(path, "r"), delimiter=",",
-                                      dtype=np.float32).transpose() for path in out.split(" ")]
-        shutil.rmtree("log")
-
-    def get_model(self):
-        return self.factors
+        directory = tempfile.mkdtemp(prefix="tensorcofi")
+        try:
+            fmt = ["%d"] * (data.shape[1] - 1) + ["%.8g"]
+            np.savetxt(os.path.join(directory, "train.csv"), data, fmt=fmt, delimiter=", ")
+            parameters = [
+                "java",
+                "-Ddirectory=%s" % os.path.join(directory, ""),
+                "-Dn_factors=%d" % self.number_of_factors,
+                "-Dn_iterations=%d" % self.number_of_iterations,
+                "-Dlambda=%f" % self.constant_lambda,
+                "-Dalpha=%f" % self.constant_alpha,
+                "-Dn_contexts=%d" % (2 + len(self.get_context_columns())),
+            ]
+            columns = [self.get_user_column(), self.get_item_column()] + self.get_context_columns()
+            for i, (context, dimension) in enumerate(zip(columns, self.get_dimensions())):
+                parameters.append("-Dcontext%d=%s" % (i, context))
+                parameters.append("-Ddimension%d=%d" % (i, dimension))
+            java_jar = resource_filename(testfm.__name__, "lib/algorithm-1.0-SNAPSHOT-jar-with-dependencies.jar")
+            sub = subprocess.Popen(parameters + ["-cp", java_jar, "es.tid.frappe.python.TensorCoPy"],
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = sub.communicate()
+            if err:
+                print out
+                raise Exception(err)
+            return [pd.read_csv(path, header=None, dtype=np.float32).values.transpose()
+                    for path in out.strip().split(" ")]
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
 
     #def get_score(self, user, item):
     #    user_vec = self.factors[0][:, self.data_map[self.get_user_column()][user]-1].transpose()
@@ -113,28 +109,23 @@ class TensorCoFi(IFactorModel):
 
     def online_user_factors(self, user_item_ids, p_param=10, lambda_param=0.01):
         """
-        :param matrix_y: application matrix Y.shape = (#apps, #factors)
+        Compute the factors of a user that is not in the model. To fold in many users use OnlineUserFactors, which
+        computes the item Gram matrix only once.
+
         :param user_item_ids: the rows that correspond to installed applications in Y matrix
         :param p_param: p parameter
         :param lambda_param: regularizer
         """
-        y = self.factors[1][user_item_ids]
-        base1 = self.factors[1].transpose().dot(self.factors[1])
-        base2 = y.transpose().dot(np.diag([p_param - 1] * y.shape[0])).dot(y)
-        base = base1 + base2 + np.diag([lambda_param] * base1.shape[0])
-        u_factors = np.linalg.inv(base).dot(y.transpose()).dot(np.diag([p_param] * y.shape[0]))
-        u_factors = u_factors.dot(np.ones(y.shape[0]).transpose())
-        return u_factors
+        return OnlineUserFactors(self, p_param, lambda_param).user_factors(user_item_ids)
 
     def set_params(self, n_factors=None, n_iterations=None, c_lambda=None, c_alpha=None):
         """
         Set the parameters for the TensorCoFi
         """
-        super(TensorCoFi, self).set_params(n_factors, n_iterations, c_lambda, c_alpha)
-        self.number_of_factors = n_factors or self.number_of_factors
-        self.number_of_iterations = n_iterations or self.number_of_iterations
-        self.constant_lambda = c_lambda or self.constant_lambda
-        self.constant_alpha = c_alpha or self.constant_alpha
+        super(TensorCoFi, self).set_params(n_factors or self.number_of_factors,
+                                           n_iterations or self.number_of_iterations,
+                                           c_lambda or self.constant_lambda, c_alpha or self.constant_alpha)
+        IFactorModel.set_params(self, self.number_of_factors)
 
     def get_name(self):
         return "TensorCoFi(n_factors=%s, n_iterations=%s, c_lambda=%s, c_alpha=%s)" % \
@@ -143,10 +134,19 @@ class TensorCoFi(IFactorModel):
 
 class PyTensorCoFi(TensorCoFi):
     """
-    Python implementation of tensorCoFi algorithm based on the java version from Alexandros Karatzoglou
+    Python implementation of tensorCoFi algorithm based on the java version from Alexandros Karatzoglou. It is the
+    vectorized reference for the native implementation: the factors of every entity of a dimension are the solution of
+
+        (B + sum_r w_r t_r t_r' + lambda / dimension I) x = sum_r sign(s_r) (1 + w_r) t_r
+
+    where B is the element wise product of the Gram matrices of the other dimensions, r are the data rows of the entity,
+    s_r the score, w_r = alpha log(1 + |s_r|) and t_r the element wise product of the factors of the other entities in
+    the row.
     """
 
-    def __init__(self, n_factors=20, n_iterations=5, c_lambda=0.05, c_alpha=40):
+    chunk_size = 2**14
+
+    def __init__(self, n_factors=20, n_iterations=5, c_lambda=0.05, c_alpha=40, monitor=None):
         """
         Constructor
 
@@ -154,13 +154,10 @@ class PyTensorCoFi(TensorCoFi):
         :param n_iterations: Number of iteration in the matrices construction
         :param c_lambda: I came back when I find it out
         :param c_alpha: Constant important in weight calculation
+        :param monitor: A ConvergenceMonitor to follow the training and stop it early
         """
         super(PyTensorCoFi, self).__init__(n_factors, n_iterations, c_lambda, c_alpha)
-        self.dimensions = None
-        self.base = self.tmp_calc = None
-        self.tmp = np.ones((self.number_of_factors, 1))
-        self.invertible = np.zeros((self.number_of_factors, self.number_of_factors))
-        self.matrix_vector_product = np.zeros((self.number_of_factors, 1))
+        self.monitor = monitor
 
     def set_params(self, n_factors=None, n_iterations=None, c_lambda=None, c_alpha=None):
         """
@@ -171,99 +168,157 @@ class PyTensorCoFi(TensorCoFi):
         self.number_of_iterations = int(n_iterations or self.number_of_iterations)
         self.constant_lambda = float(c_lambda or self.constant_lambda)
         self.constant_alpha = float(c_alpha or self.constant_alpha)
-        self.dimensions = None
-        self.base = self.tmp_calc = None
-        self.tmp = np.ones((self.number_of_factors, 1))
-        self.invertible = np.zeros((self.number_of_factors, self.number_of_factors))
-        self.matrix_vector_product = np.zeros((self.number_of_factors, 1))
-
-    def base_for_2_dimensions(self, current_dimension):
-        """
-        Calculation of base matrix for 2 dimension tensor
-        :param current_dimension: dimension to calculate
-        :return: A base matrix
-        """
-        base = self.factors[1 - current_dimension]
-        return np.dot(base, base.transpose())
 
-    def standard_base(self, current_dimension):
+    def base(self, factors, current_dimension):
         """
-        Standard base matrix calculation
+        Element wise product of the Gram matrices of the factors of every dimension except the current one
+        :param factors: A (dimension, n_factors) matrix for each dimension
         :param current_dimension: dimension to calculate
         :return: A base matrix
         """
         base = np.ones((self.number_of_factors, self.number_of_factors))
-        for matrixIndex in range(len(self.dimensions)):
-            if matrixIndex != current_dimension:
-                base = np.multiply(base, np.dot(self.factors[matrixIndex], self.factors[matrixIndex].transpose()))
+        for i, factor in enumerate(factors):
+            if i != current_dimension:
+                base *= factor.transpose().dot(factor)
         return base
 
-    def tmp_or_2_dimensions(self, current_dimension, training_data, row):
+    def tmp(self, factors, current_dimension, training_data):
         """
-        Calculate the tmp matrix for 2 dimension tensor
+        Element wise product of the factors of the entities in each row, leaving the current dimension out
+        :param factors: A (dimension, n_factors) matrix for each dimension
         :param current_dimension: dimension to calculate
         :param training_data: Matrix with the training data
-        :param row: Working row
-        :return: A tmp matrix
+        :return: A (rows, n_factors) matrix
         """
-        column = int(training_data[row, 1-current_dimension])
-        return self.tmp * self.factors[1-current_dimension][:, column].reshape(self.number_of_factors, 1)
+        tmp = np.ones((training_data.shape[0], self.number_of_factors))
+        for i, factor in enumerate(factors):
+            if i != current_dimension:
+                tmp *= factor[training_data[:, i].astype(int)]
+        return tmp
 
-    def standard_tmp(self, current_dimension, training_data, row):
+    def weighted_systems(self, entities, tmp, score, dimension):
         """
-        Standard tmp calculator
-        :param current_dimension: dimension to calculate
-        :param training_data: Matrix with the training data
-        :param row: Working row
-        :return: A tmp matrix
+        Accumulate the weighted Gram matrix and the right hand side of every entity. The rows are sorted by entity and
+        processed in chunks so the outer products of one chunk are in memory at a time.
+        :param entities: The entity of each row in the current dimension
+        :param tmp: The tmp matrix of the rows
+        :param score: The score of the rows
+        :param dimension: Number of entities in the current dimension
+        :return: A (dimension, n_factors, n_factors) array and a (dimension, n_factors) array
         """
-        self.tmp = np.add(np.multiply(self.tmp, 0.), 1.0)
-        for column in range(len(self.dimensions)):
-            if column != current_dimension:
-                self.tmp = \
-                    self.tmp * self.factors[column][:, training_data[row, column]-1].reshape(self.number_of_factors, 1)
-        return self.tmp
+        weight = self.constant_alpha * np.log(1. + np.fabs(score))
+        order = np.argsort(entities, kind="mergesort")
+        entities, tmp, weight, score = entities[order], tmp[order], weight[order], score[order]
+        gram = np.zeros((dimension, self.number_of_factors, self.number_of_factors))
+        rhs = np.zeros((dimension, self.number_of_factors))
+        for start in xrange(0, len(entities), self.chunk_size):
+            chunk = slice(start, start + self.chunk_size)
+            chunk_entities, chunk_tmp = entities[chunk], tmp[chunk]
+            starts = np.flatnonzero(np.concatenate(([True], chunk_entities[1:] != chunk_entities[:-1])))
+            outer = np.einsum("ij,ik->ijk", chunk_tmp * weight[chunk, np.newaxis], chunk_tmp)
+            gram[chunk_entities[starts]] += np.add.reduceat(outer, starts, axis=0)
+            product = chunk_tmp * (np.sign(score[chunk]) * (1. + weight[chunk]))[:, np.newaxis]
+            rhs[chunk_entities[starts]] += np.add.reduceat(product, starts, axis=0)
+        return gram, rhs
 
     def train(self, training_data):
-        self.dimensions = [self.users_size(), self.items_size()]
-        self.base = self.base_for_2_dimensions if len(self.dimensions) == 2 else self.standard_base
-        self.tmp_calc = self.tmp_or_2_dimensions if len(self.dimensions) == 2 else self.standard_tmp
-        self.factors = [np.random.rand(self.number_of_factors, i) for i in self.dimensions]
-
-        regularizer = np.multiply(np.eye(self.number_of_factors), self.constant_lambda)
-        one = np.eye(self.number_of_factors)
-        tensor = [[[] for _ in xrange(dim)] for dim in self.dimensions]
-        for index, dimension in enumerate(self.dimensions):
-            for row in xrange(training_data.shape[0]):
-                tensor[index][int(training_data[row, index])].append(row)
+        dimensions = self.get_dimensions()
+        factors = [np.random.rand(dimension, self.number_of_factors) for dimension in dimensions]
+        training_data = np.asarray(training_data, dtype=np.float64)
+        score = training_data[:, -1]
 
+        if self.monitor is not None:
+            self.monitor.start(self, training_data)
         for iteration in range(self.number_of_iterations):
-            for current_dimension, dimension in enumerate(self.dimensions):
-                base = self.base(current_dimension)
-
-                for entry in range(dimension):
-                    matrix_vector_product = self.matrix_vector_product
-                    invertible = self.invertible
-                    for row in tensor[current_dimension][entry]:
-                        tmp = self.tmp_calc(current_dimension, training_data, row)
-                        score = training_data[row, -1]
-                        weight = self.constant_alpha * math.log(1. + math.fabs(score))
-
-                        invertible = np.add(invertible, weight * (tmp * tmp.transpose()))
-                        matrix_vector_product = \
-                            np.add(matrix_vector_product, np.multiply(tmp, math.copysign(1, score) * (1. + weight)))
-
-                    invertible += base
-                    regularizer /= dimension
-                    invertible += regularizer
-                    invertible = np.linalg.solve(invertible, one)
-                    self.factors[current_dimension][:, entry] = \
-                        np.dot(invertible, matrix_vector_product).reshape(self.number_of_factors)
-
-        self.base = self.tmp_calc = None
-        for i, factor in enumerate(self.factors):
-            self.factors[i] = factor.transpose().astype(np.float32)
+            for current_dimension, dimension in enumerate(dimensions):
+                gram, rhs = self.weighted_systems(training_data[:, current_dimension].astype(int),
+                                                  self.tmp(factors, current_dimension, training_data), score,
+                                                  dimension)
+                gram += self.base(factors, current_dimension)
+                gram += np.eye(self.number_of_factors) * (self.constant_lambda / dimension)
+                factors[current_dimension] = np.linalg.solve(gram, rhs[:, :, np.newaxis])[:, :, 0]
+
+            if self.monitor is not None:
+                self.factors = [factor.astype(np.float32) for factor in factors]
+                if self.monitor.step(iteration):
+                    break
+
+        self.factors = [factor.astype(np.float32) for factor in factors]
 
     def get_name(self):
         return "Python TensorCoFi(n_factors=%s, n_iterations=%s, c_lambda=%s, c_alpha=%s)" % \
                (self.number_of_factors, self.number_of_iterations, self.constant_lambda, self.constant_alpha)
+
+
+class OnlineUserFactors(object):
+    """
+    Fold new users in a trained factor model without training it again. The factors of a user that consumed the items
+    Yu are the solution of
+
+        (Y'Y + (p - 1) Yu'Yu + lambda I) x = p Yu'1
+
+    Y'Y + lambda I is the same for every user so it is computed once for the model. Each user system only needs the
+    rows of the items the user consumed and is solved with a Cholesky factorization.
+    """
+
+    def __init__(self, model, p_param=10, lambda_param=0.01):
+        """
+        Constructor
+
+        :param model: A trained IFactorModel
+        :param p_param: p parameter
+        :param lambda_param: regularizer
+        """
+        self.model = model
+        self.p_param = p_param
+        self.lambda_param = lambda_param
+        self.gram = None
+        self.refresh()
+
+    def refresh(self):
+        """
+        Compute the item Gram matrix again. It must be called when the model is trained again.
+        """
+        items = np.asarray(self.model.factors[1], dtype=np.float64)
+        self.gram = items.transpose().dot(items)
+        self.gram.flat[::self.gram.shape[0]+1] += self.lambda_param
+
+    def user_factors(self, item_ids):
+        """
+        Compute the factors of a user
+
+        :param item_ids: The rows of the items the user consumed in the item matrix
+        :return: A numpy array with the user factors
+        """
+        y = np.asarray(self.model.factors[1][item_ids], dtype=np.float64)
+        base = self.gram + (self.p_param - 1) * y.transpose().dot(y)
+        return cho_solve(cho_factor(base), self.p_param * y.sum(axis=0))
+
+    def users_factors(self, items_per_user):
+        """
+        Compute the factors of many users. The Gram matrix of each user is accumulated from its own item rows, so only
+        one (n_factors, n_factors) system is in memory at a time.
+
+        :param items_per_user: A sequence with the rows of the items consumed by each user
+        :return: A numpy array with shape (number of users, number of factors). Users without items get zeros.
+        """
+        factors = np.zeros((len(items_per_user), self.gram.shape[0]))
+        for user, items in enumerate(items_per_user):
+            if len(items) > 0:
+                factors[user] = self.user_factors(np.asarray(items, dtype=int))
+        return factors
+
+    def fold_in(self, users, items_per_user):
+        """
+        Compute the factors of the users and write them in the model. Users that are not in the model are added to it.
+        Items that are not in the model are ignored.
+
+        :param users: A sequence of users (original ids)
+        :param items_per_user: A sequence with the items (original ids) consumed by each user
+        :return: A numpy array with the factors of the users
+        """
+        item_map = self.model.data_map[self.model.get_item_column()]
+        rows = [item_map.reindex(items).dropna().values.astype(int) for items in items_per_user]
+        factors = self.users_factors(rows)
+        self.model.add_users(users, factors)
+        return factors
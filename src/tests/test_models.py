@@ -2,16 +2,26 @@
 __author__ = "linas"
 
 import os
+import shutil
+import tempfile
 import unittest
 import pandas as pd
 import numpy as np
+import scipy.sparse as sp
 from pkg_resources import resource_filename
 import testfm
 from testfm.models.graphchi_models import SVDpp
-from testfm.models.tensorcofi import TensorCoFi, PyTensorCoFi
-from testfm.models.baseline_model import IdModel, Item2Item, AverageModel
-from testfm.models.ensemble_models import LogisticEnsemble
-from testfm.models.content_based import TFIDFModel, LSIModel
+from testfm.models.cutil.svdpp import CSVDpp, CBiasedMF
+from testfm.models.tensorcofi import TensorCoFi, PyTensorCoFi, CTensorCoFi, OnlineUserFactors, ConvergenceMonitor
+from testfm.models.baseline_model import IdModel, ConstantModel, Item2Item, AverageModel, RandomModel, top_neighbours, \
+    similarity_block, UserKNN, LRUCache, Popularity, PersonalizedPopularity, DecayedPopularity
+from testfm.models.bpr import BPR, CBPR, MiniBatchBPR, UniformSampler, PopularitySampler, AdaptiveSampler
+from testfm.models.sampling import alias_table, PositiveIndex
+from testfm.models.ensemble_models import LogisticEnsemble, LinearFit, LinearRank, ScoreCache, LinearEnsemble, \
+    PairwiseRank
+from testfm.models import content_based
+from testfm.models.content_based import TFIDFModel, LSIModel, TextPreprocessor, HashingModel, RowBuffer, \
+    SparseRowBuffer
 from testfm.evaluation.evaluator import Evaluator
 
 
@@ -148,6 +158,373 @@ class TestTensorCoFi(unittest.TestCase):
         tf.factors[1][iid, 1] = 5
         self.assertEqual(0*1+1*5, tf.get_score(10, 100))
 
+    def test_python_version_against_native(self):
+        """
+        [TensorCoFi] Test the python reference and the native implementation train the same factors
+        """
+        np.random.seed(7)
+        py_tf = PyTensorCoFi(n_factors=3, n_iterations=2, c_lambda=.05, c_alpha=40)
+        py_tf.fit(self.df)
+        np.random.seed(7)
+        tf = CTensorCoFi(n_factors=3, n_iterations=2, c_lambda=.05, c_alpha=40)
+        tf.fit(self.df)
+        for py_factor, factor in zip(py_tf.factors, tf.factors):
+            np.testing.assert_allclose(py_factor, factor, rtol=1e-2, atol=1e-3)
+
+    def test_signed_scores_against_native(self):
+        """
+        [TensorCoFi] Test the native objective is the one of the python reference for negative and zero scores
+        """
+        df = self.df.assign(rating=self.df.rating - 3)
+        np.random.seed(11)
+        py_tf = PyTensorCoFi(n_factors=3, n_iterations=2, c_lambda=.05, c_alpha=10)
+        py_tf.fit(df)
+        np.random.seed(11)
+        tf = CTensorCoFi(n_factors=3, n_iterations=2, c_lambda=.05, c_alpha=10)
+        tf.fit(df)
+        for py_factor, factor in zip(py_tf.factors, tf.factors):
+            np.testing.assert_allclose(py_factor, factor, rtol=1e-2, atol=1e-3)
+
+
+class TestContextRecommendation(unittest.TestCase):
+
+    def setUp(self):
+        self.df = pd.read_csv(resource_filename(testfm.__name__, "data/movielenshead.dat"), sep="::", header=None,
+                              names=["user", "item", "rating", "date", "title"])
+        self.df["hour"] = self.df.date % 4
+        self.tf = CTensorCoFi(n_factors=4, n_iterations=5, c_lambda=.05, c_alpha=40, other_context=["hour"])
+        self.tf.fit(self.df)
+        self.items = self.tf.data_map[self.tf.get_item_column()].index.values
+
+    def test_recommendation_with_context(self):
+        """
+        [TensorCoFi] Test recommendation with context is the same as the score for every item
+        """
+        rec = self.tf.get_recommendation(1, hour=2)
+        scores = [self.tf.get_score(1, item, hour=2) for item in self.items]
+        np.testing.assert_array_almost_equal(rec, scores, decimal=4)
+        self.assertFalse(np.allclose(rec, self.tf.get_recommendation(1)))
+
+    def test_batch_recommendation(self):
+        """
+        [TensorCoFi] Test batch recommendation is the same as a single recommendation per request
+        """
+        users, hours = [1, 93, 1], [0, 3, 3]
+        recs = self.tf.get_recommendations(users, hour=hours)
+        self.assertEqual(recs.shape, (3, len(self.items)))
+        for rec, user, hour in zip(recs, users, hours):
+            np.testing.assert_array_almost_equal(rec, self.tf.get_recommendation(user, hour=hour), decimal=4)
+
+    def test_top_recommendation(self):
+        """
+        [TensorCoFi] Test the top k recommendation is sorted and has the best items
+        """
+        rec = self.tf.get_recommendation(1, hour=1)
+        items, scores = self.tf.get_top_recommendation(1, k=5, hour=1)
+        self.assertEqual(len(items), 5)
+        np.testing.assert_array_almost_equal(scores, np.sort(rec)[::-1][:5])
+        self.assertEqual(list(items), list(self.items[np.argsort(-rec)[:5]]))
+        batch_items, batch_scores = self.tf.get_top_recommendations([1, 1], k=5, hour=[1, 1])
+        self.assertEqual(list(batch_items[1]), list(items))
+
+
+class TestPartialFit(unittest.TestCase):
+
+    def setUp(self):
+        self.df = pd.read_csv(resource_filename(testfm.__name__, "data/movielenshead.dat"), sep="::", header=None,
+                              names=["user", "item", "rating", "date", "title"])
+        self.old, self.new = self.df.iloc[:400], self.df.iloc[400:]
+        self.tf = CTensorCoFi(n_factors=4, n_iterations=5, c_lambda=.05, c_alpha=40)
+
+    def test_partial_fit(self):
+        """
+        [TensorCoFi] Test partial fit adds the new entities and keeps the old ones
+        """
+        self.tf.fit(self.old)
+        old_user_map = self.tf.data_map["user"].copy()
+        convergence = self.tf.partial_fit(self.new, n_iterations=2)
+        self.assertEqual(len(convergence), 2)
+        self.assertEqual(self.tf.users_size(), len(self.df.user.unique()))
+        self.assertEqual(self.tf.items_size(), len(self.df.item.unique()))
+        self.assertEqual(self.tf.factors[0].shape, (len(self.df.user.unique()), 4))
+        self.assertEqual(self.tf.factors[1].shape, (len(self.df.item.unique()), 4))
+        self.assertTrue((self.tf.data_map["user"][old_user_map.index] == old_user_map).all())
+        self.assertEqual(len(self.tf.training_data), len(self.df))
+        user, item = self.new.user.iloc[0], self.new.item.iloc[0]
+        self.assertAlmostEqual(self.tf.get_score(user, item), self.tf.get_recommendation(user)[
+            self.tf.data_map["item"][item]], places=4)
+
+    def test_only_touched(self):
+        """
+        [TensorCoFi] Test partial fit only over the entities in the new data
+        """
+        self.tf.fit(self.old)
+        old_factors = self.tf.factors[0].copy()
+        self.tf.partial_fit(self.new, n_iterations=1, only_touched=True)
+        touched = self.tf.data_map["user"][self.new.user.unique()].values
+        untouched = np.setdiff1d(np.arange(old_factors.shape[0]), touched)
+        np.testing.assert_array_equal(self.tf.factors[0][untouched], old_factors[untouched])
+        self.assertFalse(np.allclose(self.tf.factors[0][touched[touched < old_factors.shape[0]]],
+                                     old_factors[touched[touched < old_factors.shape[0]]]))
+
+
+class TestConvergenceMonitor(unittest.TestCase):
+
+    def setUp(self):
+        self.df = pd.read_csv(resource_filename(testfm.__name__, "data/movielenshead.dat"), sep="::", header=None,
+                              names=["user", "item", "rating", "date", "title"])
+
+    def test_callback(self):
+        """
+        [ConvergenceMonitor] Test the callback is called after every iteration with time and objective
+        """
+        calls = []
+        monitor = ConvergenceMonitor(callback=lambda *args: calls.append(args))
+        CTensorCoFi(n_factors=4, n_iterations=4, c_lambda=.05, c_alpha=40, monitor=monitor).fit(self.df)
+        self.assertEqual([c[0] for c in calls], [0, 1, 2, 3])
+        self.assertEqual(calls, monitor.history)
+        self.assertTrue(all(seconds >= 0. and np.isfinite(objective) for _, seconds, objective in calls))
+
+    def test_early_stop(self):
+        """
+        [ConvergenceMonitor] Test the training stops when the objective does not improve enough
+        """
+        monitor = ConvergenceMonitor(tolerance=1e10)
+        tf = CTensorCoFi(n_factors=4, n_iterations=10, c_lambda=.05, c_alpha=40, monitor=monitor)
+        tf.fit(self.df)
+        self.assertEqual(len(monitor.history), 2)
+        self.assertEqual(len(tf.convergence), 2)
+        monitor = ConvergenceMonitor(tolerance=1e10)
+        PyTensorCoFi(n_factors=2, n_iterations=10, monitor=monitor).fit(self.df)
+        self.assertEqual(len(monitor.history), 2)
+
+    def test_validation(self):
+        """
+        [ConvergenceMonitor] Test the objective is the validation MAP when validation data is given
+        """
+        training, validation = testfm.split.holdoutByRandom(self.df, 0.8)
+        monitor = ConvergenceMonitor(validation=validation)
+        tf = CTensorCoFi(n_factors=4, n_iterations=2, c_lambda=.05, c_alpha=40, monitor=monitor)
+        tf.fit(training)
+        self.assertEqual(len(monitor.history), 2)
+        self.assertTrue(all(0. <= objective <= 1. for _, _, objective in monitor.history))
+        self.assertAlmostEqual(monitor.history[-1][2], Evaluator().evaluate_model(tf, validation)[0], places=1)
+
+
+class TestOnlineUserFactors(unittest.TestCase):
+
+    def setUp(self):
+        self.df = pd.read_csv(resource_filename(testfm.__name__, "data/movielenshead.dat"), sep="::", header=None,
+                              names=["user", "item", "rating", "date", "title"])
+        self.tf = CTensorCoFi(n_factors=4, n_iterations=5, c_lambda=.05, c_alpha=40)
+        self.tf.fit(self.df)
+
+    def test_user_factors(self):
+        """
+        [OnlineUserFactors] Test the Cholesky solution is the same as the inverse solution
+        """
+        y = self.tf.factors[1].astype(np.float64)
+        items = [1, 3, 4]
+        yu = y[items]
+        base = y.T.dot(y) + 9 * yu.T.dot(yu) + 0.01 * np.eye(y.shape[1])
+        expected = np.linalg.inv(base).dot(yu.T).dot(10 * np.ones(len(items)))
+        online = OnlineUserFactors(self.tf, p_param=10, lambda_param=0.01)
+        np.testing.assert_array_almost_equal(online.user_factors(items), expected)
+        np.testing.assert_array_almost_equal(CTensorCoFi.online_user_factors(y, items, 10, 0.01), expected)
+
+    def test_users_factors(self):
+        """
+        [OnlineUserFactors] Test batch of users is the same as user by user
+        """
+        online = OnlineUserFactors(self.tf)
+        items_per_user = [[1, 3, 4], [], [2], [0, 5, 6, 7]]
+        factors = online.users_factors(items_per_user)
+        self.assertEqual(factors.shape, (4, 4))
+        self.assertTrue((factors[1] == 0).all())
+        for items, user_factors in zip(items_per_user, factors):
+            if items:
+                np.testing.assert_array_almost_equal(user_factors, online.user_factors(items))
+
+    def test_fold_in(self):
+        """
+        [OnlineUserFactors] Test fold in of known, new and repeated users
+        """
+        online = OnlineUserFactors(self.tf)
+        users_size = self.tf.users_size()
+        factors = online.fold_in([1, "new user"], [[122, 185], [122, 231, 292]])
+        self.assertEqual(self.tf.users_size(), users_size + 1)
+        self.assertEqual(self.tf.factors[0].shape[0], users_size + 1)
+        for user, user_factors in zip([1, "new user"], factors):
+            self.assertAlmostEqual(self.tf.get_score(user, 122),
+                                   np.dot(user_factors, self.tf.factors[1][self.tf.data_map["item"][122]]), places=4)
+        user_factors = self.tf.factors[0]
+        self.tf.add_users(["other user", "other user"], np.ones((2, self.tf.number_of_factors)))
+        self.assertEqual(self.tf.users_size(), users_size + 2)
+        self.assertEqual(self.tf.factors[0].shape[0], users_size + 2)
+        self.assertTrue(np.may_share_memory(self.tf.factors[0], user_factors))
+        item_factors = self.tf.factors[1][self.tf.data_map["item"][122]]
+        self.assertAlmostEqual(self.tf.get_score("other user", 122), item_factors.sum(), places=4)
+
+
+class TestCBPR(unittest.TestCase):
+
+    def setUp(self):
+        self.df = pd.read_csv(resource_filename(testfm.__name__, "data/movielenshead.dat"), sep="::", header=None,
+                              names=["user", "item", "rating", "date", "title"])
+
+    def test_fit(self):
+        """
+        [CBPR] Test the factors are matrices indexed by the data map
+        """
+        model = CBPR(dim=5, n_iter=2, n_jobs=2)
+        model.fit(self.df)
+        self.assertEqual(model.factors[0].shape, (len(self.df.user.unique()), 5))
+        self.assertEqual(model.factors[1].shape, (len(self.df.item.unique()), 5))
+        uid = model.data_map[model.get_user_column()][1]
+        iid = model.data_map[model.get_item_column()][1193]
+        self.assertAlmostEqual(model.get_score(1, 1193), np.dot(model.factors[0][uid], model.factors[1][iid]),
+                               places=5)
+
+    def test_ranking(self):
+        """
+        [CBPR] Test the trained model ranks the held out items better than random
+        """
+        training, testing = testfm.split.holdoutByRandom(self.df, 0.8)
+        model = CBPR(eta=0.05, dim=10, n_iter=50)
+        model.fit(training)
+        random_model = RandomModel()
+        random_model.fit(training)
+        evaluator = Evaluator()
+        self.assertGreater(evaluator.evaluate_model(model, testing)[0],
+                           evaluator.evaluate_model(random_model, testing)[0])
+
+
+class TestMiniBatchBPR(unittest.TestCase):
+
+    def setUp(self):
+        self.df = pd.read_csv(resource_filename(testfm.__name__, "data/movielenshead.dat"), sep="::", header=None,
+                              names=["user", "item", "rating", "date", "title"])
+
+    def test_fit(self):
+        """
+        [MiniBatchBPR] Test the loss goes down and every epoch is reported
+        """
+        epochs = []
+        model = MiniBatchBPR(eta=0.1, dim=8, n_iter=10, batch_size=50, decay=.95,
+                             callback=lambda *args: epochs.append(args))
+        model.fit(self.df)
+        self.assertEqual(epochs, model.history)
+        self.assertEqual([epoch for epoch, _, _ in epochs], range(10))
+        self.assertLess(epochs[-1][2], epochs[0][2])
+        self.assertEqual(model.U.shape, (len(self.df.user.unique()), 8))
+
+    def test_ranking(self):
+        """
+        [MiniBatchBPR] Test the trained model ranks the held out items better than random
+        """
+        training, testing = testfm.split.holdoutByRandom(self.df, 0.8)
+        model = MiniBatchBPR(eta=0.1, dim=10, n_iter=30, batch_size=100)
+        model.fit(training)
+        random_model = RandomModel()
+        random_model.fit(training)
+        evaluator = Evaluator()
+        self.assertGreater(evaluator.evaluate_model(model, testing)[0],
+                           evaluator.evaluate_model(random_model, testing)[0])
+
+    def test_without_extension(self):
+        """
+        [MiniBatchBPR] Test the python models are imported and trained without the native BPR
+        """
+        import sys
+        from testfm.models import bpr
+        extension = sys.modules["testfm.models.cutil.bpr"]
+        sys.modules["testfm.models.cutil.bpr"] = None
+        try:
+            python_bpr = reload(bpr)
+            self.assertIsNone(python_bpr.CBPR)
+            model = python_bpr.MiniBatchBPR(dim=4, n_iter=1, batch_size=50)
+            model.fit(self.df)
+            self.assertEqual(model.U.shape, (len(self.df.user.unique()), 4))
+        finally:
+            sys.modules["testfm.models.cutil.bpr"] = extension
+            reload(bpr)
+        self.assertIs(bpr.CBPR, extension.CBPR)
+
+
+    def test_regularization(self):
+        """
+        [BPR] Test the regularization shrinks the factors of every BPR variant
+        """
+        for model in (BPR(eta=.1, reg=5., dim=4, n_iter=2),
+                      MiniBatchBPR(eta=.1, reg=5., dim=4, n_iter=2, batch_size=10),
+                      CBPR(eta=.1, reg=5., dim=4, n_iter=2, n_jobs=1)):
+            model.fit(self.df)
+            factors = model.factors if isinstance(model, CBPR) else [model.U, model.M]
+            for matrix in factors:
+                # The factors start with a mean absolute value of about 0.5
+                self.assertLess(np.abs(matrix).mean(), .1)
+
+
+class TestSampling(unittest.TestCase):
+
+    def setUp(self):
+        self.users = np.array([0, 0, 1, 2, 2, 2])
+        self.items = np.array([1, 3, 0, 0, 1, 2])
+
+    def test_positive_index(self):
+        """
+        [Sampling] Test the index has the sorted items of each user, also when it is empty
+        """
+        index = PositiveIndex(self.users, self.items, 4, 5)
+        self.assertEqual(list(index.items_of(0)), [1, 3])
+        self.assertEqual(list(index.items_of(3)), [])
+        self.assertEqual(list(index.contains([0, 0, 2, 3], [3, 4, 2, 0])), [True, False, True, False])
+        empty = PositiveIndex([], [], 4, 5)
+        self.assertEqual(list(empty.items_of(0)), [])
+        self.assertEqual(list(empty.contains([0, 3], [1, 4])), [False, False])
+
+    def test_alias_table(self):
+        """
+        [Sampling] Test the alias table draws with the probability of the weights
+        """
+        sampler = PopularitySampler(exclude_positives=False)
+        sampler.fit(self.users, self.items, 3, 4)
+        frequency = np.bincount(sampler.draw(60000), minlength=4) / 60000.
+        np.testing.assert_allclose(frequency, [2/6., 2/6., 1/6., 1/6.], atol=.01)
+        probability, alias = alias_table([0., 1., 1.])
+        self.assertEqual(probability[0], 0.)
+
+    def test_exclude_positives(self):
+        """
+        [Sampling] Test the samplers do not draw items of the user
+        """
+        users = np.repeat([0, 1, 2], 100)
+        for sampler in (UniformSampler(max_tries=100), PopularitySampler(max_tries=100),
+                        AdaptiveSampler(max_tries=100)):
+            sampler.fit(self.users, self.items, 3, 5)
+            negatives = sampler.sample(users, np.ones((3, 2)), np.ones((5, 2)))
+            self.assertFalse(PositiveIndex(self.users, self.items, 3, 5).contains(users, negatives).any())
+
+    def test_adaptive(self):
+        """
+        [Sampling] Test the adaptive sampler keeps the candidate with the highest score
+        """
+        sampler = AdaptiveSampler(n_candidates=20, exclude_positives=False)
+        sampler.fit(self.users, self.items, 3, 5)
+        negatives = sampler.sample(np.zeros(50, dtype=int), np.ones((3, 1)), np.arange(5.).reshape((5, 1)))
+        self.assertGreater(np.mean(negatives == 4), .9)
+
+    def test_bpr_samplers(self):
+        """
+        [Sampling] Test the python and the native BPR train with every sampler
+        """
+        df = pd.read_csv(resource_filename(testfm.__name__, "data/movielenshead.dat"), sep="::", header=None,
+                         names=["user", "item", "rating", "date", "title"])
+        for sampler in (UniformSampler(), PopularitySampler(exponent=.5), AdaptiveSampler(n_candidates=3)):
+            for model in (BPR(dim=4, n_iter=1, sampler=sampler), CBPR(dim=4, n_iter=5, sampler=sampler)):
+                model.fit(df)
+                self.assertTrue(np.isfinite(model.get_score(1, 1193)))
+
 
 class LogisticTest(unittest.TestCase):
 
@@ -176,10 +553,144 @@ class LogisticTest(unittest.TestCase):
         self.le.fit(self.df)
         self.assertIsNotNone(self.le.model)
 
+    def test_feature_matrix(self):
+        """
+        [Ensemble] Test the features are computed in batch and the scores are cached between ensembles
+        """
+        class CountingModel(IdModel):
+            calls = 0
+
+            def get_scores(self, user, items, **context):
+                CountingModel.calls += 1
+                return super(CountingModel, self).get_scores(user, items)
+
+        model, cache = CountingModel(), ScoreCache()
+        le = LogisticEnsemble([model], score_cache=cache, seed=1)
+        X, Y = le.prepare_data(self.df)
+        self.assertEqual(X.dtype, np.float32)
+        np.testing.assert_array_equal(X[:3], [[2, 100], [2, 110], [1, 120]])
+        self.assertListEqual(list(Y), [1, 1, 1, 0, 0, 0])
+        calls = CountingModel.calls
+        rank = LinearRank([model], score_cache=cache, seed=1)
+        X_rank, Y_rank = rank.prepare_data(self.df)
+        self.assertEqual(CountingModel.calls, calls)
+        np.testing.assert_array_equal(X_rank[:3], X[:3] - X[3:])
+        self.assertListEqual(list(Y_rank), [1, 1, 1, -1, -1, -1])
+        X_fit, _ = LinearFit([model], score_cache=cache, seed=1).prepare_data(self.df)
+        np.testing.assert_array_equal(X_fit[:, 0], 1.)
+        self.assertEqual(cache.misses, 2)
+        LogisticEnsemble([model], score_cache=cache).prepare_data(self.df)
+        self.assertEqual(len(cache.columns), 2)
+        small = ScoreCache(max_bytes=2 * 4 * len(self.df))
+        for seed in range(4):
+            LogisticEnsemble([model], score_cache=small, seed=seed).prepare_data(self.df)
+        self.assertEqual(len(small.columns), 2)
+
+    def test_refit_score_cache(self):
+        """
+        [Ensemble] Test the scores of a refitted model are not taken from the cache and there is no cache by default
+        """
+        model, cache = Popularity(normalize=False), ScoreCache()
+        model.fit(self.df)
+        X, _ = LogisticEnsemble([model], score_cache=cache, seed=1).prepare_data(self.df)
+        model.fit(pd.concat([self.df, self.df[self.df.item == 120]]))
+        X_refit, _ = LogisticEnsemble([model], score_cache=cache, seed=1).prepare_data(self.df)
+        self.assertEqual(cache.misses, 4)
+        np.testing.assert_array_equal(X[:3, 1], [1, 1, 1])
+        np.testing.assert_array_equal(X_refit[:3, 1], [1, 1, 2])
+        self.assertIsNone(LogisticEnsemble([model]).score_cache)
+
     def test_predict(self):
         self.le.fit(self.df)
         self.assertIsInstance(self.le.get_score(10, 110), float)
 
+    def test_batch_scores(self):
+        """
+        [Ensemble] Test the batch scores are the decision function of the fitted model and the user cache is used
+        """
+        le = LogisticEnsemble([IdModel(), ConstantModel(2.)], user_cache_bytes=2**20)
+        le.fit(self.df)
+        items = [100, 120, 5]
+        scores = le.get_scores(10, items)
+        expected = le.model.decision_function([le._extract_features(10, item)[0] for item in items])
+        np.testing.assert_allclose(scores, expected, rtol=1e-5)
+        self.assertEqual(len(le.user_cache), 1)
+        np.testing.assert_allclose(le.get_scores(10, [5, 7]), le.model.decision_function([[2, 5, 2], [2, 7, 2]]),
+                                   rtol=1e-5)
+        np.testing.assert_array_equal(le.user_cache.get(10)[0], [100, 120, 5, 7])
+        linear = LinearEnsemble([IdModel(), ConstantModel(1.)], weights=[0.5, 0.5], user_cache_bytes=2**20)
+        np.testing.assert_allclose(linear.get_scores(0, [5, 7]), [3., 4.])
+        self.assertEqual(linear.get_score(0, 5), 3.)
+
+    def test_parallel_scores(self):
+        """
+        [Ensemble] Test the models scored in threads and processes give the scores of the sequential ensemble
+        """
+        popularity = Popularity(normalize=False)
+        popularity.fit(self.df.append([{"user": 12, "item": 100}]))
+        np.testing.assert_allclose(popularity.get_scores(10, [100, 120, 999]), [2., 1., 0.])
+        np.testing.assert_allclose(popularity.get_scores(99, [100, 120]), [2., 1.])
+        models = [popularity, IdModel(), ConstantModel(2.)]
+        sequential = LinearEnsemble(models, weights=[1., 0.5, 1.])
+        parallel = LinearEnsemble(models, weights=[1., 0.5, 1.], n_jobs=3)
+        try:
+            for user in (10, 12):
+                np.testing.assert_allclose(parallel.get_scores(user, [100, 110, 120]),
+                                           sequential.get_scores(user, [100, 110, 120]))
+            self.assertIsNotNone(parallel._threads)
+            self.assertIsNotNone(parallel._processes)
+        finally:
+            parallel.close()
+        timings = parallel.model_timings()
+        self.assertEqual(len(timings), 3)
+        self.assertTrue(all(calls == 2 and seconds >= 0. for _, calls, seconds in timings))
+
+    def test_unfitted_nogil_members(self):
+        """
+        [Ensemble] Test NOGIL models without a data map, like an unfitted random model, are scored with get_score
+        """
+        random = RandomModel()
+        self.assertEqual(len(random.get_scores(0, [5, 7])), 2)
+        score = LinearEnsemble([IdModel(), random], weights=[.5, .5]).get_score(0, 5)
+        self.assertTrue(2.5 <= score <= 3.)
+        df = pd.DataFrame({"user": [1, 1, 2, 3], "item": [10, 20, 10, 30]})
+        result = Evaluator(False).evaluate_model(RandomModel(), df, non_relevant_count=2)[0]
+        self.assertTrue(0. <= result <= 1.)
+
+
+class HashNoiseModel(IdModel):
+    """
+    Deterministic scores that carry no information about the items of the user
+    """
+
+    def get_score(self, user, item, **context):
+        return (int(user) * 7919 + int(item) * 104729) % 1009 / 1009.
+
+
+class TestPairwiseRank(unittest.TestCase):
+
+    def setUp(self):
+        self.df = pd.read_csv(resource_filename(testfm.__name__, "data/movielenshead.dat"), sep="::", header=None,
+                              names=["user", "item", "rating", "date", "title"])
+
+    def test_fit(self):
+        """
+        [Ensemble] Test the pairwise ensemble learns to weight the informative model and the loss goes down
+        """
+        popularity, noise = Popularity(normalize=False), HashNoiseModel()
+        popularity.fit(self.df)
+        epochs = []
+        ensemble = PairwiseRank([popularity, noise], n_negatives=3, batch_size=2000, n_iter=2, eta=0.5, seed=3,
+                                callback=lambda *epoch: epochs.append(epoch))
+        ensemble.fit(self.df)
+        self.assertEqual(len(epochs), 2)
+        self.assertLess(ensemble.history[-1][2], np.log(2.))
+        standardized = ensemble.weights * ensemble.scale
+        self.assertGreater(standardized[1], abs(standardized[2]))
+        items = self.df.item.unique()[:20]
+        features = ensemble.feature_matrix(np.repeat(1, len(items)), items, cached=False)
+        np.testing.assert_allclose(ensemble.get_scores(1, items), features.dot(ensemble.weights), rtol=1e-4)
+
 
 class Item2ItemTest(unittest.TestCase):
 
@@ -188,11 +699,10 @@ class Item2ItemTest(unittest.TestCase):
         i2i = Item2Item()
         i2i.fit(df)
 
-        self.assertEqual(i2i._items[100], set([10, 12]))
-        self.assertEqual(i2i._items[110], set([10]))
-
-        self.assertEqual(i2i._users[10], set([100, 110]))
-        self.assertEqual(i2i._users[12], set([100]))
+        users, items = i2i.data_map["user"], i2i.data_map["item"]
+        self.assertEqual(list(i2i.user_items(users[10])), [items[100], items[110]])
+        self.assertEqual(list(i2i.user_items(users[12])), [items[100]])
+        self.assertEqual(list(i2i.matrix.getcol(items[100]).nonzero()[0]), [users[10], users[12]])
 
         self.assertEqual(i2i.similarity(100, 100), 1.0)
         self.assertEqual(i2i.similarity(100, 110), 1.0/2.0)
@@ -204,6 +714,122 @@ class Item2ItemTest(unittest.TestCase):
 
         self.assertEqual(i2i.get_score(12, 110), 0.5)
 
+    def test_batch_scores(self):
+        """
+        [Item2Item] Test the batch scores and the top recommendation are the same as the single scores
+        """
+        df = pd.read_csv(resource_filename(testfm.__name__, "data/movielenshead.dat"), sep="::", header=None,
+                         names=["user", "item", "rating", "date", "title"])
+        items = df.item.unique()
+        for similarity in ("jaccard", "cosine", "conditional"):
+            i2i = Item2Item(k=3, similarity=similarity, n_neighbours=20, block_size=16)
+            i2i.fit(df)
+            scores = i2i.get_scores(1, items)
+            np.testing.assert_array_almost_equal(scores, [i2i.get_score(1, item) for item in items])
+            best, best_scores = i2i.get_top_recommendation(1, k=5)
+            np.testing.assert_array_almost_equal(best_scores, np.sort(scores)[::-1][:5])
+            self.assertEqual(i2i.get_scores(1, [-1])[0], 0.)
+
+    def test_neighbours(self):
+        """
+        [Item2Item] Test the neighbours are the most similar items, without the item itself
+        """
+        df = pd.DataFrame({"user": [1, 1, 1, 2, 2, 3], "item": [10, 20, 30, 10, 20, 30]})
+        i2i = Item2Item(similarity="cosine", n_neighbours=1)
+        i2i.fit(df)
+        items = i2i.data_map["item"]
+        self.assertEqual(i2i.neighbours[items[10], 0], items[20])
+        self.assertAlmostEqual(i2i.similarities[items[10], 0], 1.)
+        self.assertAlmostEqual(i2i.similarities[items[30], 0], 1. / np.sqrt(4.))
+
+    def test_memory_bounded_neighbours(self):
+        """
+        [Item2Item] Test the neighbours computed in parallel with a small memory budget are the same
+        """
+        df = pd.read_csv(resource_filename(testfm.__name__, "data/movielenshead.dat"), sep="::", header=None,
+                         names=["user", "item", "rating", "date", "title"])
+        i2i = Item2Item(n_neighbours=10)
+        i2i.fit(df)
+        self.assertGreater(i2i.fit_time, 0.)
+        self.assertGreater(i2i.peak_memory, 0)
+        neighbours, similarities = top_neighbours(i2i.matrix.transpose(), n_neighbours=10, n_jobs=2,
+                                                  memory_budget=200000)
+        self.assertIsInstance(neighbours, np.memmap)
+        self.assertFalse(os.path.exists(os.path.dirname(neighbours.filename)))
+        np.testing.assert_array_almost_equal(similarities, i2i.similarities)
+        np.testing.assert_array_equal(neighbours < 0, i2i.neighbours < 0)
+        items = i2i.matrix.transpose().tocsr()
+        _, similarities = similarity_block(items, np.diff(items.indptr).astype(float), "jaccard", 0, 50, 10, 100)
+        np.testing.assert_array_almost_equal(similarities, i2i.similarities[:50])
+
+
+class TestUserKNN(unittest.TestCase):
+
+    def setUp(self):
+        self.df = pd.read_csv(resource_filename(testfm.__name__, "data/movielenshead.dat"), sep="::", header=None,
+                              names=["user", "item", "rating", "date", "title"])
+
+    def test_score(self):
+        """
+        [UserKNN] Test the score is the sum of the similarities of the neighbours that consumed the item
+        """
+        df = pd.DataFrame({"user": [1, 1, 2, 2, 3], "item": [10, 20, 10, 30, 40]})
+        knn = UserKNN(k=5, similarity="jaccard")
+        knn.fit(df)
+        self.assertAlmostEqual(knn.get_score(1, 30), 1. / 3.)
+        self.assertAlmostEqual(knn.get_score(1, 40), 0.)
+        np.testing.assert_array_almost_equal(knn.get_scores(1, [10, 20, 30, 40, 50]), [1. / 3., 0., 1. / 3., 0., 0.])
+
+    def test_batch_scores(self):
+        """
+        [UserKNN] Test the batch scores and the top recommendation are the same as the single scores
+        """
+        knn = UserKNN(k=10)
+        knn.fit(self.df)
+        items = self.df.item.unique()
+        scores = knn.get_scores(1, items)
+        np.testing.assert_array_almost_equal(scores, [knn.get_score(1, item) for item in items])
+        best, best_scores = knn.get_top_recommendation(1, k=5)
+        np.testing.assert_array_almost_equal(best_scores, np.sort(scores)[::-1][:5])
+
+    def test_cache(self):
+        """
+        [UserKNN] Test the neighbours are cached and the cache stays under its limit
+        """
+        knn = UserKNN(k=10, cache_bytes=200)
+        knn.fit(self.df)
+        for user in self.df.user.unique():
+            knn.get_score(user, 1193)
+        self.assertLessEqual(knn.cache.bytes, 200)
+        self.assertGreater(len(knn.cache), 0)
+        self.assertIs(knn.neighbours(knn.data_map["user"][self.df.user.iloc[-1]]),
+                      knn.cache.get(knn.data_map["user"][self.df.user.iloc[-1]]))
+
+    def test_lru(self):
+        """
+        [UserKNN] Test the least recently used entries leave the cache first
+        """
+        cache = LRUCache(max_bytes=16)
+        cache.put(1, (np.zeros(1),))
+        cache.put(2, (np.zeros(1),))
+        cache.get(1)
+        cache.put(3, (np.zeros(1),))
+        self.assertEqual(sorted(cache.entries), [1, 3])
+        self.assertEqual(cache.bytes, 16)
+
+    def test_evaluation(self):
+        """
+        [UserKNN] Test the evaluation with batch scores ranks the held out items better than random
+        """
+        training, testing = testfm.split.holdoutByRandom(self.df, 0.8)
+        knn = UserKNN(k=20)
+        knn.fit(training)
+        random_model = RandomModel()
+        random_model.fit(training)
+        evaluator = Evaluator(False)
+        self.assertGreater(evaluator.evaluate_model(knn, testing, all_items=training.item.unique())[0],
+                           evaluator.evaluate_model(random_model, testing, all_items=training.item.unique())[0])
+
 
 class TestLSI(unittest.TestCase):
 
@@ -214,14 +840,90 @@ class TestLSI(unittest.TestCase):
 
     def test_fit(self):
         self.lsi.fit(self.df)
-        self.assertEqual(len(self.lsi._user_representation), len(self.df.user.unique()))
-        self.assertEqual(len(self.lsi._item_representation), len(self.df.item.unique()))
+        self.assertEqual(self.lsi.user_factors.shape, (len(self.df.user.unique()), 50))
+        self.assertEqual(self.lsi.item_factors.shape, (len(self.df.item.unique()), 50))
+        self.assertIsNone(LSIModel("title").user_factors)
 
     def test_score(self):
         self.lsi.fit(self.df)
         #item in the user profile (Booberang) should have higher prediction than movie not in the profile Rob Roy
         self.assertTrue(self.lsi.get_score(1, 122) > self.lsi.get_score(1, 151))
 
+    def test_batch_scores(self):
+        """
+        [LSI] Test the batch and top scores are the cosines of the single scores
+        """
+        self.lsi.fit(self.df)
+        items = [122, 151, 329, -1]
+        scores = self.lsi.get_scores(1, items)
+        for item, score in zip(items, scores):
+            self.assertAlmostEqual(self.lsi.get_score(1, item), score, places=5)
+        self.assertEqual(scores[-1], 0.)
+        top, top_scores = self.lsi.get_top_recommendations([1, 93], 3)
+        self.assertEqual(top.shape, (2, 3))
+        self.assertListEqual(list(top[1]), list(self.lsi.get_top_recommendation(93, 3)[0]))
+        self.assertAlmostEqual(top_scores[0, 0], self.lsi.get_score(1, top[0, 0]), places=5)
+        _, unseen_scores = self.lsi.get_top_recommendations([1, -1], 3)
+        np.testing.assert_array_equal(unseen_scores[1], 0.)
+        np.testing.assert_allclose(unseen_scores[0], top_scores[0])
+        strict = LSIModel("title", cold_start_strategy="raise")
+        strict.fit(self.df)
+        self.assertRaises(ValueError, strict.get_score, 1, -1)
+        self.assertRaises(ValueError, strict.get_top_recommendations, [1, -1], 3)
+
+    def test_save(self):
+        """
+        [LSI] Test a saved model is loaded with memory mapped matrices and the same scores
+        """
+        self.lsi.fit(self.df)
+        directory = tempfile.mkdtemp()
+        try:
+            self.lsi.save(directory)
+            model = LSIModel.load(directory)
+            self.assertIsInstance(model.item_factors, np.memmap)
+            self.assertAlmostEqual(model.get_score(1, 122), self.lsi.get_score(1, 122), places=6)
+            self.assertEqual(model.get_name(), self.lsi.get_name())
+        finally:
+            shutil.rmtree(directory)
+
+    def test_preprocessor(self):
+        """
+        [LSI] Test each description is tokenized once, the processes give the same term ids and small updates use none
+        """
+        descriptions = (str(title) for title in self.df.title)
+        preprocessor = TextPreprocessor(LSIModel._stopwords, n_jobs=2, chunk_size=50)
+        preprocessor.update(descriptions)
+        self.assertEqual(len(preprocessor.cache), len(self.df.title.unique()))
+        document = preprocessor.cache["Star Trek: Generations (1994)"]
+        self.assertEqual(preprocessor.words(document), ["star", "trek", "generations"])
+        pool, content_based.multiprocessing.Pool = content_based.multiprocessing.Pool, None
+        try:
+            cached = preprocessor.documents(["Star Trek: Generations (1994)"])[0]
+            preprocessor.update(["Star Trek: Nemesis (2002)"])
+        finally:
+            content_based.multiprocessing.Pool = pool
+        self.assertIs(cached, document)
+        self.assertEqual(preprocessor.words(preprocessor.cache["Star Trek: Nemesis (2002)"]),
+                         ["star", "trek", "nemesis"])
+        serial = TextPreprocessor(LSIModel._stopwords)
+        serial.update(self.df.title.unique())
+        self.assertEqual(sorted(serial.terms), sorted(preprocessor.terms))
+
+    def test_fold_in(self):
+        """
+        [LSI] Test new items and users are projected as the ones of the training set
+        """
+        self.lsi.fit(self.df)
+        self.assertEqual(self.lsi.get_score(1, -329), 0.)
+        self.lsi.add_items([-329], ["Star Trek: Generations (1994)"])
+        index = self.lsi.data_map["item"]
+        np.testing.assert_allclose(self.lsi.item_factors[index[-329]], self.lsi.item_factors[index[329]], atol=1e-6)
+        self.assertRaises(ValueError, self.lsi.add_items, [329], ["Star Trek: Generations (1994)"])
+        self.lsi.add_user(-1, self.df[self.df.user == 1].item)
+        self.assertAlmostEqual(self.lsi.get_score(-1, -329), self.lsi.get_score(1, 329), places=5)
+        self.lsi.add_user(1, [329])
+        self.assertAlmostEqual(self.lsi.get_score(1, -329), 1., places=5)
+
     def test_user_model(self):
         um = self.lsi._get_user_models(self.df)
         self.assertEqual(um[93], ["collateral", "man", "fire"])
@@ -232,6 +934,81 @@ class TestLSI(unittest.TestCase):
         self.assertEqual(im[329], ["star", "trek", "generations"])
 
 
+class TestRowBuffers(unittest.TestCase):
+
+    def test_append(self):
+        """
+        [RowBuffer] Test appending rows one at a time copies the array only when the capacity doubles
+        """
+        buffer = RowBuffer(np.zeros((2, 3), dtype=np.float32))
+        copies, data = 0, buffer.data
+        for i in range(30):
+            rows = buffer.append(np.full((1, 3), i))
+            copies, data = copies + (buffer.data is not data), buffer.data
+        self.assertEqual(copies, 4)
+        self.assertEqual(rows.shape, (32, 3))
+        np.testing.assert_array_equal(rows[2:, 0], np.arange(30))
+
+    def test_sparse(self):
+        """
+        [SparseRowBuffer] Test appended and replaced rows are read before and after they are merged
+        """
+        matrix = sp.csr_matrix(np.eye(14, 5, dtype=np.float32))
+        buffer = SparseRowBuffer(matrix)
+        rows = buffer.append(sp.csr_matrix([[0, 1, 0, 0, 1]], dtype=np.float32))
+        self.assertEqual(rows.shape, (15, 5))
+        np.testing.assert_array_equal(buffer.row_indices(14), [1, 4])
+        buffer.replace(0, sp.csr_matrix([[0, 0, 1, 1, 0]], dtype=np.float32))
+        self.assertEqual(len(buffer.pending), 1)
+        np.testing.assert_array_equal(buffer.row_indices(0), [2, 3])
+        rows = buffer.replace(1, sp.csr_matrix([[0, 0, 0, 0, 0]], dtype=np.float32))
+        self.assertEqual(len(buffer.pending), 0)
+        expected = np.eye(14, 5)
+        expected[0], expected[1] = [0, 0, 1, 1, 0], 0
+        np.testing.assert_array_equal(rows.toarray(), np.vstack((expected, [[0, 1, 0, 0, 1]])))
+        self.assertEqual(buffer.resize(7).shape, (15, 7))
+
+
+class TestHashingModel(unittest.TestCase):
+
+    def setUp(self):
+        self.df = pd.read_csv(resource_filename(testfm.__name__, "data/movielenshead.dat"), sep="::", header=None,
+                              names=["user", "item", "rating", "date", "title"])
+
+    def test_fit(self):
+        """
+        [Hashing] Test the items with the same words have the same representation and the profile items score higher
+        """
+        model = HashingModel("title", dim=64, n_features=2**16, chunk_size=100)
+        model.fit(self.df)
+        self.assertEqual(model.item_factors.shape, (len(self.df.item.unique()), 64))
+        norms = np.linalg.norm(model.item_factors, axis=1)
+        np.testing.assert_allclose(norms[model.item_norms > 0], 1., atol=1e-5)
+        self.assertTrue(model.get_score(1, 122) > model.get_score(1, 151))
+        model.add_items([-329], ["Star Trek: Generations (1994)"])
+        index = model.data_map["item"]
+        np.testing.assert_allclose(model.item_factors[index[-329]], model.item_factors[index[329]], atol=1e-6)
+        model.add_user(-1, self.df[self.df.user == 1].item)
+        self.assertAlmostEqual(model.get_score(-1, 122), model.get_score(1, 122), places=5)
+
+    def test_save(self):
+        """
+        [Hashing] Test a saved model gives the same scores and projects new items in the same space
+        """
+        model = HashingModel("title", dim=16, n_features=2**12)
+        model.fit(self.df)
+        directory = tempfile.mkdtemp()
+        try:
+            model.save(directory)
+            loaded = HashingModel.load(directory)
+            self.assertAlmostEqual(loaded.get_score(1, 122), model.get_score(1, 122), places=6)
+            for m in (model, loaded):
+                m.add_items([-1], ["Boomerang"])
+            self.assertAlmostEqual(loaded.get_score(1, -1), model.get_score(1, -1), places=6)
+        finally:
+            shutil.rmtree(directory)
+
+
 class TFIDTest(unittest.TestCase):
 
     def setUp(self):
@@ -246,8 +1023,10 @@ class TFIDTest(unittest.TestCase):
 
         self.assertEqual(tfidf._get_item_models(self.df), {1: ["oh", "god"], 100: ["car", "very", "nice"],
                                                            110: ["sky", "sky", "blue", "nice"]})
-        self.assertEqual(tfidf._users, {10: set([100]), 11: set([100, 1]), 12: set([110])})
-        self.assertEqual(sorted(tfidf.tfidf.keys()), sorted([100, 1, 110]))
+        self.assertEqual(sorted(tfidf.data_map["item"].index), [1, 100, 110])
+        self.assertEqual(tfidf.tfidf.shape, (3, len(tfidf.preprocessor.terms)))
+        items = tfidf.data_map["item"].index.values
+        self.assertEqual(sorted(items[tfidf.user_items(tfidf.data_map["user"][11])]), [1, 100])
 
     def test_item_model(self):
         tfidf = TFIDFModel("desc")
@@ -265,6 +1044,42 @@ class TFIDTest(unittest.TestCase):
         #the closes item to 1 (in user 10 profile) is 100, so the score should be equal to the similarity
         self.assertAlmostEqual(tfidf.get_score(10, 1), tfidf._sim(100, 1), places=2)
 
+    def test_batch_scores(self):
+        """
+        [TF/IDF] Test the batch scores are the sums of the k highest similarities to the items of the user
+        """
+        self.df = self.df.append({"user": 12, "item": 120, "desc": "a nice blue car"}, ignore_index=True)
+        tfidf = TFIDFModel("desc", k=2)
+        tfidf.fit(self.df)
+        items = [1, 100, 110, 120, 999]
+        scores = tfidf.get_scores(12, items)
+        self.assertAlmostEqual(scores[1], tfidf._sim(100, 110) + tfidf._sim(100, 120), places=5)
+        self.assertAlmostEqual(scores[0], 0.)
+        self.assertEqual(scores[-1], 0.)
+        for item, score in zip(items[:-1], scores):
+            self.assertAlmostEqual(tfidf.get_score(12, item), score, places=5)
+        self.assertEqual(tfidf.get_top_recommendation(12, 1)[0][0], 100)
+
+    def test_fold_in(self):
+        """
+        [TF/IDF] Test new items are merged in the neighbours and new users are scored without fitting again
+        """
+        tfidf = TFIDFModel("desc", k=2)
+        tfidf.fit(self.df)
+        tfidf.add_items([120, 130], ["a nice blue car", "my god"])
+        self.assertAlmostEqual(tfidf._sim(120, 120), 1., places=5)
+        similarities = tfidf.tfidf.dot(tfidf.tfidf.transpose()).toarray()
+        np.fill_diagonal(similarities, 0.)
+        np.testing.assert_allclose(np.sort(tfidf.similarities, axis=1),
+                                   np.sort(similarities, axis=1)[:, -tfidf.similarities.shape[1]:], atol=1e-6)
+        self.assertGreater(tfidf.get_score(12, 120), 0.)
+        self.assertAlmostEqual(tfidf.get_score(12, 120), tfidf._sim(110, 120), places=5)
+        tfidf.add_user(13, [130, 999])
+        self.assertAlmostEqual(tfidf.get_score(13, 1), tfidf._sim(130, 1), places=5)
+        tfidf.add_user(10, [1])
+        self.assertAlmostEqual(tfidf.get_score(10, 130), tfidf._sim(1, 130), places=5)
+        self.assertEqual(tfidf.get_score(10, 120), 0.)
+
 
 class SVDppTest(unittest.TestCase):
 
@@ -317,6 +1132,39 @@ class SVDppTest(unittest.TestCase):
         self.assertEqual(svdpp.imap[1], 0)
         self.assertEqual(svdpp.imap[100], 1)
         self.assertEqual(svdpp.imap[110], 2)
+        self.assertEqual(list(self.df.columns), ["item", "rating", "user"])
+        os.remove(filename)
+
+    def test_read_matrix(self):
+        svdpp = SVDpp()
+        handle, filename = tempfile.mkstemp(suffix=".mm")
+        with os.fdopen(handle, "w") as f:
+            f.write("%%MatrixMarket matrix array real general\n%In each row D factors of a single user node.\n3 2\n")
+            f.write("\n".join(str(v) for v in range(6)) + "\n")
+        m = svdpp.read_matrix(filename)
+        os.remove(filename)
+        self.assertEqual(m.dtype, np.float32)
+        np.testing.assert_array_equal(m, [[0, 1], [2, 3], [4, 5]])
+
+    def test_native(self):
+        """
+        [SVDpp] Test the in process models predict held out ratings better than the global mean and score in batch
+        """
+        self.assertEqual(CSVDpp.param_details(), SVDpp.param_details())
+        training, testing = testfm.split.holdoutByRandom(self.df_big, 0.8)
+        testing = testing[testing.user.isin(training.user) & testing.item.isin(training.item)]
+        ratings = testing.rating.values
+        baseline = np.sqrt(np.mean((ratings - training.rating.mean()) ** 2))
+        items = training.item.unique()[:20]
+        user = training.user.iloc[0]
+        for model in (CSVDpp(n_iterations=20, c_gamma=.02, n_jobs=2), CBiasedMF(n_iterations=20, c_gamma=.02)):
+            model.fit(training)
+            predictions = np.array([model.get_score(u, i) for u, i in zip(testing.user, testing.item)])
+            self.assertLess(np.sqrt(np.mean((ratings - predictions) ** 2)), baseline)
+            self.assertTrue(isinstance(model.get_score(user, items[0]), float))
+            np.testing.assert_allclose(model.get_scores(user, items), [model.get_score(user, i) for i in items],
+                                       rtol=1e-5)
+        self.assertRaises(KeyError, model.get_score, -1, items[0])
 
 
 class MeanPredTest(unittest.TestCase):
@@ -331,6 +1179,87 @@ class MeanPredTest(unittest.TestCase):
         model.fit(self.df)
 
         self.assertEqual(model.get_score(10, 100), 4.5)
+        self.assertEqual(model.get_score(11, 1), 3.)
+
+
+class PopularityTest(unittest.TestCase):
+
+    def setUp(self):
+        self.df = pd.read_csv(resource_filename(testfm.__name__, "data/movielenshead.dat"), sep="::", header=None,
+                              names=["user", "item", "rating", "date", "title"])
+
+    def test_popularity(self):
+        """
+        [Popularity] Test the scores are the (normalized) number of times each item was consumed
+        """
+        counts = self.df.item.value_counts()
+        model = Popularity(normalize=False)
+        model.fit(self.df)
+        for item in counts.index[:20]:
+            self.assertEqual(model.get_score(1, item), counts[item])
+        model = Popularity()
+        model.fit(self.df)
+        self.assertAlmostEqual(model.get_score(1, counts.index[0]), 1.)
+        self.assertAlmostEqual(model.get_score(1, counts.index[-1]), 0.)
+
+    def test_personalized_popularity(self):
+        """
+        [Popularity] Test the personalized scores are the number of times the user consumed the item
+        """
+        df = pd.DataFrame({"user": [1, 1, 1, 2], "item": [10, 10, 20, 10]})
+        model = PersonalizedPopularity()
+        model.fit(df)
+        self.assertEqual(model.get_score(1, 10), 2.)
+        self.assertEqual(model.get_score(1, 20), 1.)
+        self.assertEqual(model.get_score(2, 20), 0.)
+        self.assertEqual(model.get_score(3, 20), 0.)
+
+    def test_native_evaluation(self):
+        """
+        [Popularity] Test the baselines are evaluated by the native evaluator
+        """
+        training, testing = testfm.split.holdoutByRandom(self.df, 0.8)
+        testing = testing[testing.item.isin(training.item)]
+        for model in (Popularity(), PersonalizedPopularity()):
+            model.fit(training)
+            native = Evaluator().evaluate_model(model, testing, all_items=training.item.unique(),
+                                                non_relevant_count=None)[0]
+            self.assertTrue(0. < native <= 1.)
+
+    def test_decayed_popularity(self):
+        """
+        [Popularity] Test the streaming decayed counts match the counts computed from the whole data
+        """
+        df = self.df.sort_values("date")
+        model = DecayedPopularity(half_life=90*24*3600., n_top=10)
+        for start in xrange(0, len(df), 100):
+            model.partial_fit(df[start:start+100])
+        now = df.date.max()
+        expected = (0.5 ** ((now - df.date) / (90*24*3600.))).groupby(df.item).sum().sort_values(ascending=False)
+        for item in expected.index[:20]:
+            self.assertAlmostEqual(model.get_score(1, item) / expected[item], 1., places=4)
+        items, scores = model.get_top_recommendation(1, 5)
+        self.assertListEqual(list(items), list(expected.index[:5]))
+        self.assertEqual(model.get_score(1, -1), 0.)
+
+    def test_decayed_popularity_bounded(self):
+        """
+        [Popularity] Test only the most popular items are kept, up to the prune slack, and the old interactions fade out
+        """
+        model = DecayedPopularity(half_life=1., max_items=2)
+        model.partial_fit(pd.DataFrame({"user": [1, 2, 3], "item": [10, 10, 20], "date": [0., 0., 0.]}))
+        model.partial_fit(pd.DataFrame({"user": [1, 2, 3], "item": [30, 40, 40], "date": [100., 100., 100.]}))
+        self.assertEqual(len(model.item_ids), 2)
+        model.max_items = 4
+        model.partial_fit(pd.DataFrame({"user": [4, 5], "item": [50, 60], "date": [100., 100.]}))
+        model.partial_fit(pd.DataFrame({"user": [6], "item": [70], "date": [100.]}))
+        self.assertEqual(len(model.item_ids), 5)
+        self.assertLessEqual(len(model.item_ids), model.max_items * DecayedPopularity.PRUNE_SLACK)
+        self.assertEqual(model.data_map["user"][-1], 0)
+        self.assertEqual(list(model.get_top_recommendation(1, 2)[0]), [40, 30])
+        self.assertAlmostEqual(model.get_score(1, 40), 2.)
+        self.assertTrue(0. < Evaluator().evaluate_model(model, pd.DataFrame({"user": [1], "item": [40]}),
+                                                        all_items=[30, 40], non_relevant_count=None)[0])
 
 
 class PyTensorTest(object):